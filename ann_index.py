@@ -0,0 +1,192 @@
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+MAGIC = b"MPAN"
+VERSION = 1
+BACKEND_NAME_SIZE = 64
+
+# Lists searched per query unless the caller asks for more
+DEFAULT_PROBES = 16
+
+# Trained centroids are reused until the corpus asks for this many times as many lists
+RETRAIN_GROWTH = 2
+
+# magic, version, byte order, number of vectors, dimensions, number of lists, corpus fingerprint, backend name
+HEADER = struct.Struct(f"<4sHHIII32s{BACKEND_NAME_SIZE}s")
+
+# Byte offsets of every section, in the order they are written
+SECTIONS = ("centroids", "list_offsets", "vectors", "name_offsets", "names")
+SECTION_TABLE = struct.Struct(f"<{len(SECTIONS)}Q")
+
+BYTE_ORDERS = {"little": 0, "big": 1}
+
+
+def _align(file, size: int = 8):
+    """Pad the file with zero bytes up to the next multiple of size."""
+    padding = -file.tell() % size
+    file.write(b"\0" * padding)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors to unit length, so inner products are cosine similarities."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def train_centroids(vectors: np.ndarray, list_count: int, sample_size: int = 256) -> np.ndarray:
+    """Cluster a sample of the vectors into list_count unit-length centroids with mini-batch k-means."""
+    from sklearn.cluster import MiniBatchKMeans
+
+    # k-means only needs a few hundred points per list to place the centroids
+    rng = np.random.default_rng(0)
+    sample = vectors
+    if len(vectors) > list_count * sample_size:
+        sample = vectors[rng.choice(len(vectors), list_count * sample_size, replace=False)]
+
+    kmeans = MiniBatchKMeans(n_clusters=list_count, n_init=3, random_state=0, batch_size=4096)
+    kmeans.fit(sample)
+    return normalize(kmeans.cluster_centers_.astype(np.float32))
+
+
+def list_count_for(count: int) -> int:
+    """Return the number of lists of an index of count vectors."""
+    return max(1, math.ceil(math.sqrt(count)))
+
+
+def write_ann_index(path: str, names: list, vectors: np.ndarray, fingerprint: str, backend_name: str,
+                    list_count: int = None, centroids: np.ndarray = None):
+    """Build an inverted-file (IVF) index of the vectors and write it atomically to path.
+
+    Vectors are grouped by their nearest centroid and stored contiguously per list, so a query only reads the
+    lists closest to it. Given the centroids of a previous index, the vectors are assigned to them without
+    training new ones.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if names:
+        vectors = normalize(vectors.reshape(len(names), -1))
+    else:
+        # An empty corpus still gets an index, so searches find nothing instead of failing
+        vectors = vectors.reshape(0, vectors.shape[-1] if vectors.ndim == 2 and vectors.shape[-1] else 1)
+    count, dimensions = vectors.shape
+
+    if centroids is not None:
+        centroids = np.asarray(centroids, dtype=np.float32).reshape(-1, dimensions)
+        list_count = len(centroids)
+    else:
+        list_count = min(list_count or list_count_for(count), max(count, 1))
+        if count:
+            centroids = train_centroids(vectors, list_count)
+        else:
+            centroids = np.zeros((list_count, dimensions), dtype=np.float32)
+
+    if count and list_count > 1:
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+    else:
+        assignments = np.zeros(count, np.int64)
+
+    order = np.argsort(assignments, kind="stable")
+    list_offsets = np.zeros(list_count + 1, dtype=np.uint64)
+    list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=list_count))
+
+    encoded_names = [names[i].encode("utf-8") for i in order]
+    name_offsets = np.zeros(count + 1, dtype=np.uint64)
+    name_offsets[1:] = np.cumsum([len(name) for name in encoded_names])
+
+    sections = {}
+    handle, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp",
+                                         dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(b"\0" * (HEADER.size + SECTION_TABLE.size))
+            for section, data in (("centroids", centroids.tobytes()), ("list_offsets", list_offsets.tobytes()),
+                                  ("vectors", vectors[order].tobytes()), ("name_offsets", name_offsets.tobytes()),
+                                  ("names", b"".join(encoded_names))):
+                _align(file)
+                sections[section] = file.tell()
+                file.write(data)
+
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDERS[sys.byteorder], count, dimensions, list_count,
+                                   bytes.fromhex(fingerprint), backend_name.encode("utf-8")[:BACKEND_NAME_SIZE]))
+            file.write(SECTION_TABLE.pack(*(sections[section] for section in SECTIONS)))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class AnnIndex:
+    """A read-only, memory-mapped IVF index for approximate nearest-neighbour search over chunk embeddings."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, byte_order, self.count, self.dimensions, self.list_count, fingerprint, backend_name = \
+            HEADER.unpack_from(self.mmap, 0)
+
+        if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDERS[sys.byteorder]:
+            self.close()
+            raise ValueError(f"{path} is not a supported vector index file. Rebuild it.")
+
+        self.fingerprint = fingerprint.hex()
+        self.backend_name = backend_name.rstrip(b"\0").decode("utf-8")
+        self.sections = dict(zip(SECTIONS, SECTION_TABLE.unpack_from(self.mmap, HEADER.size)))
+
+        self.centroids = self._array("centroids", np.float32, self.list_count * self.dimensions).reshape(
+            self.list_count, self.dimensions)
+        self.list_offsets = self._array("list_offsets", np.uint64, self.list_count + 1).astype(np.int64)
+        self.vectors = self._array("vectors", np.float32, self.count * self.dimensions).reshape(
+            self.count, self.dimensions)
+        self.name_offsets = self._array("name_offsets", np.uint64, self.count + 1).astype(np.int64)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f"AnnIndex(path={self.path}, vectors={self.count}, lists={self.list_count})"
+
+    def _array(self, section: str, dtype, count: int) -> np.ndarray:
+        """Return a zero-copy array over a section."""
+        return np.frombuffer(self.mmap, dtype=dtype, count=count, offset=self.sections[section])
+
+    def close(self):
+        """Release the memory map."""
+        for name in ("centroids", "list_offsets", "vectors", "name_offsets"):
+            self.__dict__.pop(name, None)
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Arrays handed out by search are still alive, the map is released together with them
+            pass
+
+    def name(self, position: int) -> str:
+        start = self.sections["names"]
+        return self.mmap[start + self.name_offsets[position]:start + self.name_offsets[position + 1]].decode("utf-8")
+
+    def search(self, query: list, count: int = 10, probes: int = DEFAULT_PROBES) -> list:
+        """Return (chunk name, cosine similarity) pairs of the nearest vectors found in the closest lists."""
+        if not self.count or count <= 0:
+            return []
+
+        query = normalize(np.asarray(query, dtype=np.float32))
+        probes = min(probes, self.list_count)
+        lists = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+
+        positions = np.concatenate([np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists])
+        if not len(positions):
+            return []
+
+        scores = self.vectors[positions] @ query
+        count = min(count, len(positions))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.lexsort((positions[best], -scores[best]))]
+        return [(self.name(int(positions[i])), float(scores[i])) for i in best]
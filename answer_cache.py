@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_keywords(keywords: list) -> frozenset:
+    return frozenset(keyword.lower() for keyword in keywords)
+
+
+class AnswerCache:
+    """Cache answers keyed on a question's keyword set and a fingerprint of the corpus.
+
+    Entries expire after ttl seconds, the least recently used ones are evicted beyond max_entries, and all entries
+    are dropped as soon as a lookup comes with a different corpus fingerprint. A question whose keywords overlap a
+    cached question's keywords by at least the similarity threshold (Jaccard index) is served the same answer.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, similarity: float = 0.8) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.fingerprint = None
+        self.entries = OrderedDict()
+        self.keyword_index = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, key: frozenset):
+        self.entries.pop(key, None)
+        for keyword in key:
+            keys = self.keyword_index.get(keyword)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keyword_index[keyword]
+
+    def _check_fingerprint(self, fingerprint: str):
+        # The corpus changed, so every cached answer may be stale
+        if fingerprint != self.fingerprint:
+            self.entries.clear()
+            self.keyword_index.clear()
+            self.fingerprint = fingerprint
+
+    def _is_fresh(self, key: frozenset, now: float) -> bool:
+        if now - self.entries[key][1] <= self.ttl:
+            return True
+        self._remove(key)
+        return False
+
+    def _find_similar(self, key: frozenset, now: float):
+        # Only cached questions that share at least one keyword can reach the threshold
+        candidates = set()
+        for keyword in key:
+            candidates.update(self.keyword_index.get(keyword, ()))
+
+        best_key, best_similarity = None, self.similarity
+        for candidate in candidates:
+            similarity = len(key & candidate) / len(key | candidate)
+            if similarity >= best_similarity and self._is_fresh(candidate, now):
+                best_key, best_similarity = candidate, similarity
+        return best_key
+
+    def get(self, keywords: list, fingerprint: str):
+        """Return the cached answer of the same or a near-duplicate question, or None."""
+        key = normalize_keywords(keywords)
+        if not key:
+            return None
+
+        now = time.monotonic()
+        with self.lock:
+            self._check_fingerprint(fingerprint)
+
+            if key in self.entries and self._is_fresh(key, now):
+                match = key
+            else:
+                match = self._find_similar(key, now)
+
+            if match is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(match)
+            return self.entries[match][0]
+
+    def put(self, keywords: list, fingerprint: str, answer: str):
+        key = normalize_keywords(keywords)
+        if not key:
+            return
+
+        with self.lock:
+            self._check_fingerprint(fingerprint)
+            self._remove(key)
+
+            self.entries[key] = (answer, time.monotonic())
+            for keyword in key:
+                self.keyword_index.setdefault(keyword, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keyword_index.clear()
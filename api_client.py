@@ -0,0 +1,186 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class RetryPolicy:
+    """Retry failed requests with capped exponential backoff and full jitter."""
+
+    def __init__(self, attempts: int = 4, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 statuses: frozenset = RETRY_STATUSES) -> None:
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.statuses = statuses
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        """Return how long to wait before the next attempt, honouring a numeric Retry-After header."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class ApiClient:
+    """A thread-safe API client with a pooled keep-alive session, timeouts, retries and an in-flight limit."""
+
+    def __init__(self, url: str, headers: dict, timeout: tuple = (5.0, 60.0), max_in_flight: int = 8,
+                 retry: RetryPolicy = None) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        self.session = requests.Session()
+        self.session.headers.update({key: value for key, value in headers.items() if value is not None})
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def post(self, payload: dict, stream: bool = False) -> requests.Response:
+        """POST a JSON payload, retrying connection errors and retryable statuses.
+
+        A streamed response keeps its in-flight slot until it is closed, so callers must close it.
+        """
+        self.in_flight.acquire()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight.release()
+
+        try:
+            response = self._post_with_retries(payload, stream)
+        except BaseException:
+            release()
+            raise
+
+        if not stream:
+            release()
+            return response
+
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        response.close = close_and_release
+        return response
+
+    def _post_with_retries(self, payload: dict, stream: bool) -> requests.Response:
+        data = json.dumps(payload)
+        for attempt in range(self.retry.attempts):
+            last_attempt = attempt == self.retry.attempts - 1
+            try:
+                response = self.session.post(self.url, data=data, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                time.sleep(self.retry.delay(attempt))
+                continue
+
+            if response.status_code not in self.retry.statuses or last_attempt:
+                return response
+
+            retry_after = response.headers.get("Retry-After")
+            # Read the short error body first, so the connection goes back to the pool instead of being dropped
+            response.raw.drain_conn()
+            response.close()
+            time.sleep(self.retry.delay(attempt, retry_after))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncApiClient:
+    """The asyncio counterpart of ApiClient, built on a pooled aiohttp session."""
+
+    def __init__(self, url: str, headers: dict, timeout: tuple = (5.0, 60.0), max_in_flight: int = 8,
+                 retry: RetryPolicy = None) -> None:
+        # aiohttp takes a while to import and most callers only need the blocking client
+        import aiohttp
+
+        self.url = url
+        self.headers = {key: value for key, value in headers.items() if value is not None}
+        self.timeout = aiohttp.ClientTimeout(connect=timeout[0], sock_read=timeout[1])
+        self.retry = retry or RetryPolicy()
+        self.max_in_flight = max_in_flight
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        import aiohttp
+
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout, connector=connector)
+        return self.session
+
+    @asynccontextmanager
+    async def post(self, payload: dict):
+        """POST a JSON payload and yield the response; its in-flight slot is held until the block exits."""
+        async with self.in_flight:
+            response = await self._post_with_retries(json.dumps(payload))
+            try:
+                yield response
+            finally:
+                response.release()
+
+    async def post_json(self, payload: dict):
+        async with self.post(payload) as response:
+            return await response.json(content_type=None)
+
+    async def _post_with_retries(self, data: str) -> "aiohttp.ClientResponse":
+        import aiohttp
+
+        session = self._get_session()
+        for attempt in range(self.retry.attempts):
+            last_attempt = attempt == self.retry.attempts - 1
+            try:
+                response = await session.post(self.url, data=data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt))
+                continue
+
+            if response.status not in self.retry.statuses or last_attempt:
+                return response
+
+            retry_after = response.headers.get("Retry-After")
+            # Read the short error body first, so the connection goes back to the pool instead of being dropped
+            await response.read()
+            response.release()
+            await asyncio.sleep(self.retry.delay(attempt, retry_after))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
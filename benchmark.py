@@ -0,0 +1,431 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from chunking import CHUNKERS, create_chunker
+from document_search_backend import DocumentSearchBackend
+from extraction import ENGINES
+from manipulator import Manipulator, collect_files, load_documents
+from metrics import percentile
+from preprocessing import TOKENIZERS
+from text import AutoTranslator, OfflineTranslatorBackend
+from translation_cache import TranslationCache
+
+RESULTS_FOLDER = "benchmarks"
+
+# Synthetic text draws words from a fixed vocabulary with Zipf-like frequencies, so postings look like real text
+VOCABULARY_SIZE = 20_000
+SYLLABLES = ["ka", "ri", "to", "men", "sa", "lo", "pe", "da", "ngu", "bi", "ter", "an", "ol", "ve", "ma", "si",
+             "ru", "ne", "pa", "tan", "go", "li", "ber", "ca", "un", "de", "ha", "mi", "so", "ju"]
+COMMON_WORDS = ["the", "of", "and", "to", "in", "is", "that", "for", "it", "as", "with", "on", "by", "this", "are",
+                "be", "from", "or", "an", "which"]
+
+LINES_PER_PDF_PAGE = 50
+PDF_LINE_LENGTH = 90
+
+
+class SyntheticCorpus:
+    """Generate reproducible documents as pages of paragraphs, and write them as PDF or DOCX files."""
+
+    def __init__(self, seed: int = 0, pages: int = 4, words_per_page: int = 300) -> None:
+        self.random = random.Random(seed)
+        self.pages = pages
+        self.words_per_page = words_per_page
+        self.vocabulary = self.create_vocabulary()
+        self.weights = [1 / rank for rank in range(1, len(self.vocabulary) + 1)]
+
+    def create_vocabulary(self) -> list:
+        words = dict.fromkeys(COMMON_WORDS)
+        while len(words) < VOCABULARY_SIZE:
+            length = self.random.randint(1, 4)
+            words["".join(self.random.choice(SYLLABLES) for _ in range(length))] = None
+        return list(words)
+
+    def sentence(self) -> str:
+        words = self.random.choices(self.vocabulary, self.weights, k=self.random.randint(6, 20))
+        return " ".join(words).capitalize() + "."
+
+    def page(self) -> list:
+        """Return the paragraphs of one page."""
+        paragraphs, count = [], 0
+        while count < self.words_per_page:
+            paragraph = " ".join(self.sentence() for _ in range(self.random.randint(2, 6)))
+            paragraphs.append(paragraph)
+            count += len(paragraph.split())
+        return paragraphs
+
+    def document(self) -> list:
+        return [self.page() for _ in range(self.pages)]
+
+    def query(self) -> list:
+        # Questions use the less common words, like a user naming what they are looking for
+        return self.random.sample(self.vocabulary[len(COMMON_WORDS):2000], self.random.randint(2, 5))
+
+
+def pages_to_documents(pages: list) -> list:
+    """Turn generated pages into the elements a document loader yields."""
+    from langchain.schema import Document
+
+    return [Document(page_content=paragraph, metadata={"page_number": page_number})
+            for page_number, paragraphs in enumerate(pages, start=1) for paragraph in paragraphs]
+
+
+def write_pdf(path: str, pages: list):
+    """Write the pages as a plain text PDF using the built-in Helvetica font."""
+    page_lines = []
+    for paragraphs in pages:
+        lines = []
+        for paragraph in paragraphs:
+            line = ""
+            for word in paragraph.split():
+                if line and len(line) + len(word) >= PDF_LINE_LENGTH:
+                    lines.append(line)
+                    line = ""
+                line = f"{line} {word}" if line else word
+            lines.extend([line, ""])
+        while lines and not lines[-1]:
+            lines.pop()
+        # Long pages continue on extra PDF pages, like a real document would
+        page_lines.extend(lines[start:start + LINES_PER_PDF_PAGE] for start in range(0, len(lines), LINES_PER_PDF_PAGE))
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in page_lines:
+        text = "".join("(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") Tj T* "
+                       for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 800 Td {text}ET".encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, content in enumerate(objects, start=1):
+            offsets.append(file.tell())
+            file.write(b"%d 0 obj\n" % number + content + b"\nendobj\n")
+        xref = file.tell()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        file.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+        file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+
+
+def write_docx(path: str, pages: list):
+    """Write the pages as a DOCX file with one paragraph per paragraph and a page break between pages."""
+    body = []
+    for page_number, paragraphs in enumerate(pages):
+        if page_number:
+            body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        body.extend(f"<w:p><w:r><w:t>{escape(paragraph)}</w:t></w:r></w:p>" for paragraph in paragraphs)
+
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{"".join(body)}</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", DOCX_RELATIONSHIPS)
+        archive.writestr("word/document.xml", document)
+
+
+def memory_mb() -> float:
+    """Return the resident memory of the process in MiB."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # Peak instead of current memory where /proc is not available; macOS reports bytes, Linux KiB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def latency_stats(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {"count": len(latencies), "mean_ms": sum(latencies) / len(latencies) * 1000,
+            **{f"p{round(quantile * 100)}_ms": percentile(latencies, quantile) * 1000
+               for quantile in (0.5, 0.95, 0.99)}}
+
+
+def git_revision() -> dict:
+    # The revision of this checkout, wherever the benchmark is started from
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+class Benchmark:
+    """Measure ingestion, preprocessing and search on corpora of several sizes in a scratch folder.
+
+    Translation and embedding calls go to local stubs, so the numbers only depend on this code and the machine.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.corpus = SyntheticCorpus(args.seed, args.pages, args.words_per_page)
+        # Absolute, since every corpus size runs in its own scratch folder
+        self.fixtures = [os.path.abspath(path) for path in collect_files(args.fixtures)] if args.fixtures else None
+
+    def create_manipulator(self) -> Manipulator:
+        manipulator = Manipulator()
+        manipulator.backend = DocumentSearchBackend(self.args.tokenizer, self.args.workers)
+        manipulator.backend.translator = AutoTranslator(OfflineTranslatorBackend(), TranslationCache(":memory:"))
+        return manipulator
+
+    def load(self, path: str):
+        # Every run extracts again, so the extraction cache of an earlier size or run never hides the engine's cost
+        return load_documents(path, use_cache=False, engine=self.args.engine, workers=self.args.workers)
+
+    def source_documents(self, size: int, folder: str) -> list:
+        """Return (source, element loader) pairs of the corpus, writing synthetic files if needed."""
+        if self.fixtures is not None:
+            return [(path, lambda path=path: self.load(path)) for path in self.fixtures[:size]]
+
+        sources = []
+        for number in range(size):
+            pages = self.corpus.document()
+            if self.args.source == "pages":
+                sources.append((f"document-{number}", lambda pages=pages: pages_to_documents(pages)))
+                continue
+
+            path = os.path.join(folder, f"document-{number}.{self.args.formats[number % len(self.args.formats)]}")
+            (write_pdf if path.endswith(".pdf") else write_docx)(path, pages)
+            sources.append((path, lambda path=path: self.load(path)))
+        return sources
+
+    def run_size(self, size: int) -> dict:
+        result = {"documents": size}
+        manipulator = self.create_manipulator()
+        backend = manipulator.backend
+        chunker = create_chunker(self.args.chunking, self.args.max_word, self.args.overlap)
+
+        sources = self.source_documents(size, os.path.abspath("corpus"))
+        result["documents"] = len(sources)
+
+        start = time.perf_counter()
+        chunks = 0
+        for source, load in sources:
+            chunks += manipulator.read_and_split(load(), chunker, source=source, update_index=False)
+        elapsed = time.perf_counter() - start
+        chunk_store = backend.get_chunk_store()
+        result["read_and_split"] = {"seconds": elapsed, "chunks": chunks, "documents_per_second": len(sources) / elapsed,
+                                    "chunks_per_second": chunks / elapsed,
+                                    "megabytes_per_second": chunk_store.live_bytes / (1 << 20) / elapsed,
+                                    "memory_mb": memory_mb()}
+
+        start = time.perf_counter()
+        corpora = backend.process_documents(backend.get_text_files())
+        elapsed = time.perf_counter() - start
+        tokens = sum(sum(corpus.lengths) for corpus in corpora.values())
+        result["process_documents"] = {"seconds": elapsed, "tokens": tokens, "tokens_per_second": tokens / elapsed,
+                                       "memory_mb": memory_mb()}
+        del corpora
+
+        start = time.perf_counter()
+        backend.build_index()
+        index = backend.load_index()
+        result["build_index"] = {"seconds": time.perf_counter() - start,
+                                 "index_bytes": sum(os.path.getsize(shard.path) for shard in index.shard_list),
+                                 "terms": index.term_count,
+                                 "shards": {language: len(shard) for language, shard in index.shards.items()},
+                                 "memory_mb": memory_mb()}
+
+        queries = [self.corpus.query() for _ in range(self.args.queries)]
+        # One untimed pass, so lazy imports and cold caches are not charged to the first query
+        for keywords in queries:
+            backend.find_top_documents(keywords, index, self.args.count)
+
+        latencies = []
+        for _ in range(self.args.repeat):
+            for keywords in queries:
+                start = time.perf_counter()
+                backend.find_top_documents(keywords, index, self.args.count)
+                latencies.append(time.perf_counter() - start)
+        result["find_top_documents"] = dict(latency_stats(latencies), memory_mb=memory_mb())
+
+        if self.args.hybrid:
+            result["hybrid_search"] = self.run_hybrid(backend, queries)
+
+        backend.close_index()
+        return result
+
+    def run_hybrid(self, backend: DocumentSearchBackend, queries: list) -> dict:
+        from embedding_store import EmbeddingStore, HashingEmbeddingBackend
+        from retrieval import HybridRetriever
+
+        retriever = HybridRetriever(backend, EmbeddingStore(HashingEmbeddingBackend(), ":memory:"))
+        start = time.perf_counter()
+        retriever.build_ann_index()
+        build_seconds = time.perf_counter() - start
+
+        questions = [" ".join(keywords) for keywords in queries]
+        retriever.search(questions[0], self.args.count)
+
+        latencies = []
+        for _ in range(self.args.repeat):
+            for question in questions:
+                start = time.perf_counter()
+                retriever.search(question, self.args.count)
+                latencies.append(time.perf_counter() - start)
+
+        retriever.close()
+        return dict(latency_stats(latencies), build_seconds=build_seconds, memory_mb=memory_mb())
+
+    def run(self) -> dict:
+        report = {
+            **git_revision(),
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {name: value for name, value in vars(self.args).items() if name not in ("output", "compare")},
+            "results": [],
+        }
+
+        working_directory = os.getcwd()
+        for size in self.args.sizes:
+            # The backend reads and writes relative to the working directory, so each size gets a fresh one
+            scratch = tempfile.mkdtemp(prefix=f"benchmark-{size}-")
+            try:
+                os.chdir(scratch)
+                os.makedirs("corpus")
+                print(f"Benchmarking {size} document(s) in '{scratch}'...")
+                result = self.run_size(size)
+            finally:
+                os.chdir(working_directory)
+                if not self.args.keep:
+                    shutil.rmtree(scratch, ignore_errors=True)
+
+            report["results"].append(result)
+            print_result(result)
+
+        return report
+
+
+def print_result(result: dict):
+    read_and_split = result["read_and_split"]
+    search = result["find_top_documents"]
+    print(f"  {result['documents']} document(s), {read_and_split['chunks']} chunk(s): "
+          f"read_and_split {read_and_split['seconds']:.2f}s ({read_and_split['chunks_per_second']:.0f} chunks/s), "
+          f"process_documents {result['process_documents']['seconds']:.2f}s, "
+          f"build_index {result['build_index']['seconds']:.2f}s, "
+          f"find_top_documents p50 {search['p50_ms']:.2f}ms p99 {search['p99_ms']:.2f}ms, "
+          f"{search['memory_mb']:.0f} MiB")
+
+
+def flatten(result: dict) -> dict:
+    return {f"{stage}.{name}": value for stage, values in result.items() if isinstance(values, dict)
+            for name, value in values.items()}
+
+
+def compare(old_path: str, new_path: str):
+    """Print the change of every measured value between two result files, matching runs by corpus size."""
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+
+    print(f"{(old.get('commit') or '?')[:10]} -> {(new.get('commit') or '?')[:10]}")
+    old_results = {result["documents"]: result for result in old["results"]}
+    for result in new["results"]:
+        previous = old_results.get(result["documents"])
+        if previous is None:
+            continue
+
+        print(f"{result['documents']} document(s):")
+        old_values = flatten(previous)
+        for name, value in flatten(result).items():
+            before = old_values.get(name)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                print(f"  {name:<40} {before:>14.4f} {value:>14.4f} {(value - before) / before:>+8.1%}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion and search on synthetic or fixture corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000], help="Corpus sizes in documents (default: 100 1000)")
+    parser.add_argument("--source", choices=["files", "pages"], default="files", help="'files' writes and extracts synthetic PDF/DOCX files, 'pages' feeds the generated pages straight to the chunker (default: files)")
+    parser.add_argument("--formats", choices=["pdf", "docx"], nargs="+", default=["pdf", "docx"], help="File formats of the synthetic documents, used in turn (default: pdf docx)")
+    parser.add_argument("--engine", choices=ENGINES, default="auto", help="PDF extraction engine (default: auto)")
+    parser.add_argument("--fixtures", type=str, nargs="+", metavar="PATH", help="Directories or glob patterns of PDF/Word files to use instead of a synthetic corpus; each size takes the first N of them")
+    parser.add_argument("--pages", type=int, default=4, help="Pages per synthetic document (default: 4)")
+    parser.add_argument("--words-per-page", type=int, default=300, help="Words per synthetic page (default: 300)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus and queries (default: 0)")
+    parser.add_argument("--max-word", type=int, default=400, help="Maximum words per chunk (default: 400)")
+    parser.add_argument("--chunking", choices=CHUNKERS.keys(), default="fixed", help="Chunking strategy (default: fixed)")
+    parser.add_argument("--overlap", type=int, default=0, help="Overlap of --chunking window (default: 0)")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS.keys(), default=None, help="Tokenizer of the index (default: nltk)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for preprocessing (default: number of CPUs)")
+    parser.add_argument("--queries", type=int, default=50, help="Number of distinct queries (default: 50)")
+    parser.add_argument("--repeat", type=int, default=3, help="Times every query is timed (default: 3)")
+    parser.add_argument("--count", type=int, default=3, help="Documents returned per query (default: 3)")
+    parser.add_argument("--hybrid", action="store_true", help="Also time hybrid retrieval with local hashing embeddings")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch folders of every corpus size")
+    parser.add_argument("--output", type=str, help=f"JSON file of the results (default: {RESULTS_FOLDER}/<date>-<commit>.json)")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    needs_unstructured = args.fixtures or (args.source == "files" and ("docx" in args.formats
+                                                                       or args.engine == "unstructured"))
+    if needs_unstructured and importlib.util.find_spec("unstructured") is None:
+        print("Error: Extracting PDF/DOCX files needs the 'unstructured' package. Install it, or use --formats pdf "
+              "--engine pypdf, or --source pages to benchmark without extraction.")
+        sys.exit(1)
+
+    report = Benchmark(args).run()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_FOLDER, f"{stamp}-{(report['commit'] or 'unknown')[:8]}.json")
+
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to '{output}'.")
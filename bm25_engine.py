@@ -0,0 +1,98 @@
+import numpy as np
+from scipy import sparse
+
+from inverted_index import B, K1, InvertedIndex
+
+
+class SparseBM25:
+    """BM25Okapi scoring of an InvertedIndex as sparse matrix products.
+
+    The postings are turned once into a CSR term-document matrix holding the BM25 weight of every posting, so
+    scoring a batch of queries is a single product of their term count matrix with it.
+    """
+
+    def __init__(self, index: InvertedIndex) -> None:
+        self.index = index
+        self.matrix = self._weight_matrix(index)
+
+    @staticmethod
+    def _weight_matrix(index: InvertedIndex) -> sparse.csr_matrix:
+        # Copy out of the memory map, so the index can still be closed while the engine is alive
+        indptr = np.array(index.postings_offsets, dtype=np.int64)
+        doc_ids = np.array(index.postings_docs, dtype=np.int32)
+        frequencies = np.array(index.postings_freqs, dtype=np.float64)
+        doc_lengths = np.array(index.doc_lengths, dtype=np.float64)
+        idf = np.array(index.idf, dtype=np.float64)
+
+        if not index.postings_count:
+            return sparse.csr_matrix((index.term_count, index.doc_count), dtype=np.float64)
+
+        length_norm = K1 * (1 - B + B * doc_lengths / index.average_length)
+        term_ids = np.repeat(np.arange(index.term_count), np.diff(indptr))
+        weights = idf[term_ids] * frequencies * (K1 + 1) / (frequencies + length_norm[doc_ids])
+
+        return sparse.csr_matrix((weights, doc_ids, indptr), shape=(index.term_count, index.doc_count))
+
+    def query_matrix(self, queries: list) -> sparse.csr_matrix:
+        """Count the known terms of every query, one row per query."""
+        rows, columns = [], []
+        for row, keywords in enumerate(queries):
+            for keyword in keywords:
+                term_id = self.index.term_id(keyword)
+                if term_id is not None:
+                    rows.append(row)
+                    columns.append(term_id)
+
+        # Repeated keywords are summed, so they count as often as BM25Okapi.get_scores counts them
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(queries), self.index.term_count))
+
+    def get_batch_scores(self, queries: list) -> np.ndarray:
+        """Return the score of every document for every query, as a queries x documents array."""
+        return (self.query_matrix(queries) @ self.matrix).toarray()
+
+    def get_scores(self, keywords: list) -> np.ndarray:
+        return self.get_batch_scores([keywords])[0]
+
+    @staticmethod
+    def top_k(scores: np.ndarray, count: int) -> list:
+        """Return (doc_id, score) pairs of the highest scores, breaking ties by the lowest document id."""
+        count = min(count, len(scores))
+        if count <= 0:
+            return []
+
+        if count < len(scores):
+            # Keep every document that ties with the k-th score, so ties are broken the same way as a full sort
+            threshold = scores[np.argpartition(-scores, count - 1)[count - 1]]
+            candidates = np.flatnonzero(scores >= threshold)
+        else:
+            candidates = np.arange(len(scores))
+
+        order = np.lexsort((candidates, -scores[candidates]))[:count]
+        return [(int(candidates[i]), float(scores[candidates[i]])) for i in order]
+
+    def matching_documents(self, term_ids) -> np.ndarray:
+        """Return the sorted ids of the documents containing at least one of the terms."""
+        indptr, indices = self.matrix.indptr, self.matrix.indices
+        postings = [indices[indptr[term_id]:indptr[term_id + 1]] for term_id in term_ids]
+        return np.unique(np.concatenate(postings)) if postings else np.zeros(0, dtype=np.int64)
+
+    def top_matches_batch(self, queries: list, count: int = 3) -> list:
+        """Return (doc_id, score) pairs of the best documents containing a keyword of every query.
+
+        Unlike top_documents, documents without any keyword are left out, and matching documents are kept whatever
+        the sign of their score.
+        """
+        query_matrix = self.query_matrix(queries)
+        scores = (query_matrix @ self.matrix).toarray()
+
+        tops = []
+        for row, row_scores in enumerate(scores):
+            candidates = self.matching_documents(query_matrix.indices[query_matrix.indptr[row]:
+                                                                      query_matrix.indptr[row + 1]])
+            # Candidates are sorted, so ties are still broken by the lowest document id
+            tops.append([(int(candidates[i]), score) for i, score in self.top_k(row_scores[candidates], count)])
+        return tops
+
+    def top_documents(self, keywords: list, count: int = 3) -> list:
+        """Return (doc_id, score) pairs of the best documents, ranked like BM25Okapi.get_scores would rank them."""
+        return self.top_k(self.get_scores(keywords), count)
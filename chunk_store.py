@@ -0,0 +1,303 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b"MPCS"
+VERSION = 1
+
+# magic, version, generation; the data file and its offset index share the generation of the last compaction
+HEADER = struct.Struct("<4sH16s")
+
+# operation, data offset, length in bytes, SHA-256 digest of the text, length of the name that follows
+RECORD = struct.Struct("<BQI32sH")
+PUT = 1
+DELETE = 0
+
+
+def _write_header(file, generation: bytes):
+    file.write(HEADER.pack(MAGIC, VERSION, generation))
+
+
+def _read_header(file, path: str) -> bytes:
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path} is truncated.")
+    magic, version, generation = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a supported chunk store file.")
+    return generation
+
+
+class ChunkStore:
+    """Keep the text of every chunk in one append-only data file with an append-only offset index.
+
+    The data file holds the UTF-8 texts back to back and is read through a memory map. The index is a log of put and
+    delete records that is replayed into a dict on open, giving O(1) access by chunk name. Only one process may
+    write at a time; readers in other processes pick up its records with refresh(). Replaced and deleted texts stay
+    in the data file until compact() rewrites both files.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.entries = {}
+        self.live_bytes = 0
+        self.lock = threading.RLock()
+        self.generation = None
+        self.index_position = 0
+        self.mmap = None
+        self.data_file = None
+        self.index_file = None
+
+        with self.lock:
+            self._open()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name: str):
+        return name in self.entries
+
+    def __repr__(self):
+        return f"ChunkStore(path={self.path}, chunks={len(self.entries)})"
+
+    def _open(self):
+        self._finish_compaction()
+        if not os.path.exists(self.path) or not os.path.exists(self.index_path):
+            self._create(os.urandom(16))
+
+        with open(self.path, "rb") as file:
+            self.generation = _read_header(file, self.path)
+
+        self.entries = {}
+        self.live_bytes = 0
+        self.index_position = 0
+        self._replay()
+
+        self.data_file = open(self.path, "ab")
+        self.index_file = open(self.index_path, "ab")
+
+    def _create(self, generation: bytes):
+        for path in (self.path, self.index_path):
+            with open(path, "wb") as file:
+                _write_header(file, generation)
+
+    def _finish_compaction(self):
+        # A compaction that replaced the data file but not the index yet left the new index behind
+        temp_index_path = f"{self.index_path}.tmp"
+        if not os.path.exists(temp_index_path):
+            return
+
+        with open(temp_index_path, "rb") as file:
+            generation = _read_header(file, temp_index_path)
+        with open(self.path, "rb") as file:
+            data_generation = _read_header(file, self.path)
+
+        if generation == data_generation:
+            os.replace(temp_index_path, self.index_path)
+        else:
+            os.remove(temp_index_path)
+
+    def _replay(self):
+        """Apply the index records written since the last replay."""
+        with open(self.index_path, "rb") as file:
+            if self.index_position == 0:
+                if _read_header(file, self.index_path) != self.generation:
+                    raise ValueError(f"{self.index_path} does not belong to {self.path}. Re-import the chunks.")
+                self.index_position = HEADER.size
+
+            file.seek(self.index_position)
+            data = file.read()
+
+        position = 0
+        while position + RECORD.size <= len(data):
+            operation, offset, length, digest, name_length = RECORD.unpack_from(data, position)
+            end = position + RECORD.size + name_length
+            if end > len(data):
+                # A record still being written, or cut short by a crash and truncated by the next append
+                break
+            name = data[position + RECORD.size:end].decode("utf-8")
+
+            previous = self.entries.pop(name, None)
+            if previous is not None:
+                self.live_bytes -= previous[1]
+            if operation == PUT:
+                self.entries[name] = (offset, length, digest)
+                self.live_bytes += length
+            position = end
+
+        self.index_position += position
+
+    def _append_records(self, records: list):
+        self.index_file.write(b"".join(
+            RECORD.pack(operation, offset, length, digest, len(encoded)) + encoded
+            for operation, offset, length, digest, encoded in records
+        ))
+        self.index_file.flush()
+
+    def _prepare_append(self):
+        # Drop a record left incomplete by a crashed writer, so new records are not appended after it
+        self._replay()
+        if os.path.getsize(self.index_path) > self.index_position:
+            self.index_file.truncate(self.index_position)
+
+    def _map(self, end: int):
+        """Return the memory map of the data file, or None if another process compacted it meanwhile."""
+        # The data file only grows between compactions, so remap once a read goes past the mapped size
+        if self.mmap is None or end > len(self.mmap):
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            with open(self.path, "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if HEADER.unpack_from(data, 0)[2] != self.generation:
+                # The entries hold offsets into the old data file, so they are reloaded before reading the new one
+                data.close()
+                self.refresh()
+                return None
+            self.mmap = data
+        return self.mmap
+
+    def _read(self, name: str) -> bytes:
+        while True:
+            offset, length, _ = self.entries[name]
+            data = self._map(offset + length)
+            if data is not None:
+                return data[offset:offset + length]
+
+    def refresh(self):
+        """Pick up chunks written by another process, reopening the store if it was compacted meanwhile."""
+        with self.lock:
+            with open(self.path, "rb") as file:
+                generation = _read_header(file, self.path)
+
+            if generation != self.generation:
+                self.close()
+                self._open()
+            else:
+                self._replay()
+
+    def names(self) -> list:
+        return list(self.entries)
+
+    def digest(self, name: str) -> str:
+        """Return the SHA-256 hex digest of a chunk's text."""
+        return self.entries[name][2].hex()
+
+    def get(self, name: str) -> str:
+        with self.lock:
+            return self._read(name).decode("utf-8")
+
+    def get_many(self, names: list) -> list:
+        with self.lock:
+            return [self.get(name) for name in names]
+
+    def put_many(self, items: list) -> int:
+        """Append (name, text) pairs whose text changed and return how many were written."""
+        with self.lock:
+            self._prepare_append()
+            records = []
+            self.data_file.seek(0, os.SEEK_END)
+            offset = self.data_file.tell()
+            for name, text in items:
+                encoded = text.encode("utf-8")
+                digest = hashlib.sha256(encoded).digest()
+
+                current = self.entries.get(name)
+                if current is not None and current[2] == digest:
+                    continue
+
+                self.data_file.write(encoded)
+                records.append((PUT, offset, len(encoded), digest, name.encode("utf-8")))
+                offset += len(encoded)
+
+            if not records:
+                return 0
+
+            # The texts must be on disk before the index points at them
+            self.data_file.flush()
+            self._append_records(records)
+            self._replay()
+            return len(records)
+
+    def put(self, name: str, text: str) -> bool:
+        return self.put_many([(name, text)]) == 1
+
+    def delete_many(self, names: list) -> int:
+        with self.lock:
+            self._prepare_append()
+            records = [(DELETE, 0, 0, b"\0" * 32, name.encode("utf-8")) for name in names if name in self.entries]
+            if records:
+                self._append_records(records)
+                self._replay()
+            return len(records)
+
+    def delete(self, name: str) -> bool:
+        return self.delete_many([name]) == 1
+
+    def dead_bytes(self) -> int:
+        """Return the size of the replaced and deleted texts that compaction would reclaim."""
+        with self.lock:
+            return os.path.getsize(self.path) - HEADER.size - self.live_bytes
+
+    def compact(self) -> int:
+        """Rewrite the data file and index with only the live chunks and return the number of bytes reclaimed."""
+        with self.lock:
+            reclaimed = self.dead_bytes()
+            generation = os.urandom(16)
+            temp_path = f"{self.path}.tmp"
+            temp_index_path = f"{self.index_path}.tmp"
+
+            records = []
+            with open(temp_path, "wb") as file:
+                _write_header(file, generation)
+                for name in list(self.entries):
+                    text = self._read(name)
+                    records.append((PUT, file.tell(), len(text), self.entries[name][2], name.encode("utf-8")))
+                    file.write(text)
+
+            with open(temp_index_path, "wb") as file:
+                _write_header(file, generation)
+                file.write(b"".join(RECORD.pack(operation, offset, length, digest, len(encoded)) + encoded
+                                    for operation, offset, length, digest, encoded in records))
+
+            self.close()
+            os.replace(temp_path, self.path)
+            os.replace(temp_index_path, self.index_path)
+            self._open()
+            return reclaimed
+
+    def export(self, folder_path: str) -> int:
+        """Write every chunk to a plain text file named after it and return how many were written."""
+        os.makedirs(folder_path, exist_ok=True)
+        with self.lock:
+            for name in self.entries:
+                with open(os.path.join(folder_path, name), "w", encoding="utf-8") as file:
+                    file.write(self.get(name))
+            return len(self.entries)
+
+    def import_folder(self, folder_path: str) -> int:
+        """Add the .txt files of a folder, named after their file names, and return how many were written."""
+        items = []
+        for file_name in sorted(os.listdir(folder_path)):
+            if file_name.endswith(".txt"):
+                with open(os.path.join(folder_path, file_name), "r", encoding="utf-8") as file:
+                    items.append((file_name, file.read()))
+        return self.put_many(items)
+
+    def clear(self):
+        """Remove every chunk and start a new, empty store."""
+        with self.lock:
+            self.close()
+            self._create(os.urandom(16))
+            self._open()
+
+    def close(self):
+        with self.lock:
+            for handle in (self.mmap, self.data_file, self.index_file):
+                if handle is not None:
+                    handle.close()
+            self.mmap = self.data_file = self.index_file = None
@@ -0,0 +1,162 @@
+import re
+from collections import namedtuple
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+WORD_PATTERN = re.compile(r"\S+")
+SENTENCE_END_PATTERN = re.compile(r"[.!?][\"')\]]*$")
+
+# Separator between the elements of a document in its extracted text, which byte offsets refer to
+ELEMENT_SEPARATOR = b"\n\n"
+
+# A word of a source document: its position among all words, its page, and its UTF-8 byte span in the extracted
+# text; boundary is set on the last word of a sentence or of an element (title, list item, paragraph)
+Word = namedtuple("Word", ["index", "text", "page", "byte_start", "byte_end", "boundary"])
+
+# A chunk of a source document. words holds the words while chunking, and only their number once written
+Chunk = namedtuple("Chunk", ["offset", "words", "page_start", "page_end", "byte_start", "byte_end"])
+
+
+def iter_words(documents: Iterable["Document"]) -> Iterator[Word]:
+    """Yield the words of a document's elements one at a time, with their page and byte offsets."""
+    index = 0
+    base = 0
+
+    for document in documents:
+        text = document.page_content
+        page = (document.metadata or {}).get("page_number")
+
+        matches = list(WORD_PATTERN.finditer(text))
+        # Byte offsets are counted incrementally, so the text is never re-encoded from its start
+        char_position, byte_position = 0, base
+        for position, match in enumerate(matches):
+            byte_position += len(text[char_position:match.start()].encode("utf-8"))
+            byte_start = byte_position
+            byte_position += len(match.group().encode("utf-8"))
+            char_position = match.end()
+
+            boundary = position == len(matches) - 1 or bool(SENTENCE_END_PATTERN.search(match.group()))
+            yield Word(index, match.group(), page, byte_start, byte_position, boundary)
+            index += 1
+
+        base = byte_position + len(text[char_position:].encode("utf-8")) + len(ELEMENT_SEPARATOR)
+
+
+def make_chunk(words: list) -> Chunk:
+    pages = [word.page for word in words if word.page is not None]
+    return Chunk(words[0].index, [word.text for word in words], min(pages, default=None), max(pages, default=None),
+                 words[0].byte_start, words[-1].byte_end)
+
+
+class Chunker:
+    """Split the elements of a source document into chunks of at most max_words words."""
+
+    name = "base"
+
+    def __init__(self, max_words: int) -> None:
+        self.max_words = max_words
+
+    def split(self, documents: Iterable["Document"]) -> Iterator[Chunk]:
+        raise NotImplementedError
+
+
+class FixedWordChunker(Chunker):
+    """Cut every max_words words, regardless of sentences and pages."""
+
+    name = "fixed"
+
+    def split(self, documents: Iterable["Document"]) -> Iterator[Chunk]:
+        chunk = []
+        for word in iter_words(documents):
+            chunk.append(word)
+            if len(chunk) == self.max_words:
+                yield make_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            yield make_chunk(chunk)
+
+
+class SentenceChunker(Chunker):
+    """Pack whole sentences into chunks, splitting a sentence only when it alone exceeds max_words."""
+
+    name = "sentence"
+    page_aligned = False
+
+    def split(self, documents: Iterable["Document"]) -> Iterator[Chunk]:
+        chunk, sentence = [], []
+        page = None
+
+        for word in iter_words(documents):
+            if self.page_aligned and word.page != page and (chunk or sentence):
+                # A page starts a new chunk, even in the middle of a sentence
+                yield make_chunk(chunk + sentence)
+                chunk, sentence = [], []
+            page = word.page
+
+            sentence.append(word)
+            if len(sentence) == self.max_words:
+                if chunk:
+                    yield make_chunk(chunk)
+                yield make_chunk(sentence)
+                chunk, sentence = [], []
+            elif word.boundary:
+                if len(chunk) + len(sentence) > self.max_words:
+                    yield make_chunk(chunk)
+                    chunk = []
+                chunk += sentence
+                sentence = []
+
+        if len(chunk) + len(sentence) > self.max_words:
+            yield make_chunk(chunk)
+            chunk = []
+        if chunk or sentence:
+            yield make_chunk(chunk + sentence)
+
+
+class PageChunker(SentenceChunker):
+    """Pack whole sentences like SentenceChunker, but never let a chunk span two pages."""
+
+    name = "page"
+    page_aligned = True
+
+
+class SlidingWindowChunker(Chunker):
+    """Cut windows of max_words words that overlap the previous window by overlap words."""
+
+    name = "window"
+
+    def __init__(self, max_words: int, overlap: int) -> None:
+        super().__init__(max_words)
+        if not 0 <= overlap < max_words:
+            raise ValueError("The overlap must be at least 0 and smaller than the maximum number of words.")
+        self.overlap = overlap
+
+    def split(self, documents: Iterable["Document"]) -> Iterator[Chunk]:
+        window = []
+        new_words = 0
+        for word in iter_words(documents):
+            window.append(word)
+            new_words += 1
+            if len(window) == self.max_words:
+                yield make_chunk(window)
+                window = window[self.max_words - self.overlap:]
+                new_words = 0
+
+        # Only emit the tail if it holds words that no earlier window covered
+        if new_words:
+            yield make_chunk(window)
+
+
+CHUNKERS = {chunker.name: chunker for chunker in (FixedWordChunker, SentenceChunker, PageChunker,
+                                                   SlidingWindowChunker)}
+
+
+def create_chunker(strategy: str, max_words: int, overlap: int = 0) -> Chunker:
+    if strategy not in CHUNKERS:
+        raise ValueError(f"Unknown chunking strategy '{strategy}'. Choose one of: {', '.join(CHUNKERS)}.")
+    if strategy == SlidingWindowChunker.name:
+        return SlidingWindowChunker(max_words, overlap)
+    return CHUNKERS[strategy](max_words)
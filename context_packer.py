@@ -0,0 +1,125 @@
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+from inverted_index import B, EPSILON, K1
+
+# Tokens the chat format adds around every message, and once to prime the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+PARAGRAPH_PATTERN = re.compile(r"\n\s*\n")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = None):
+    """Return the tiktoken encoding of a model, or None when tiktoken cannot load one."""
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model or "gpt-3.5-turbo")
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # tiktoken is missing or could not fetch its vocabulary
+        return None
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # Without a tokenizer, over-estimate from the number of words and punctuation marks
+    return math.ceil(len(WORD_PATTERN.findall(text)) * 4 / 3)
+
+
+def split_passages(text: str) -> list:
+    """Split a chunk into paragraphs, or into sentences when it has no paragraph breaks."""
+    paragraphs = [paragraph.strip() for paragraph in PARAGRAPH_PATTERN.split(text) if paragraph.strip()]
+    if len(paragraphs) > 1:
+        return paragraphs
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+
+def bm25_scores(passages: list, keywords: list) -> list:
+    """Score tokenized passages against keywords with the same BM25Okapi formula as the search index."""
+    if not passages:
+        return []
+
+    keywords = [keyword.lower() for keyword in keywords]
+    frequencies = [Counter(passage) for passage in passages]
+    average_length = sum(len(passage) for passage in passages) / len(passages) or 1.0
+
+    document_frequency = Counter(term for frequency in frequencies for term in frequency)
+    idf = {term: math.log(len(passages) - count + 0.5) - math.log(count + 0.5)
+           for term, count in document_frequency.items()}
+    floor = EPSILON * (sum(idf.values()) / len(idf)) if idf else 0.0
+    idf = {term: value if value >= 0 else floor for term, value in idf.items()}
+
+    scores = []
+    for passage, frequency in zip(passages, frequencies):
+        length_norm = K1 * (1 - B + B * len(passage) / average_length)
+        scores.append(sum(
+            idf.get(keyword, 0.0) * frequency[keyword] * (K1 + 1) / (frequency[keyword] + length_norm)
+            for keyword in keywords if keyword in frequency
+        ))
+    return scores
+
+
+class ContextPacker:
+    """Fill a model's context window with the most relevant passages of the retrieved chunks.
+
+    The budget is the context window minus the tokens of the system prompt, the prompt without context, the chat
+    format overhead and the tokens reserved for the answer. Passages are added greedily by their BM25 score plus the
+    score of the chunk they came from, skipping ones that no longer fit, and are put back in document order.
+    """
+
+    def __init__(self, context_window: int = 4096, answer_tokens: int = 512, model: str = None) -> None:
+        self.context_window = context_window
+        self.answer_tokens = answer_tokens
+        self.model = model
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def budget(self, system_prompts: list, prompt_without_context: str) -> int:
+        """Return the number of tokens left for the context."""
+        used = sum(self.count_tokens(prompt) + MESSAGE_OVERHEAD for prompt in system_prompts)
+        used += self.count_tokens(prompt_without_context) + MESSAGE_OVERHEAD + REPLY_OVERHEAD
+        return max(0, self.context_window - self.answer_tokens - used)
+
+    def pack(self, documents: list, texts: list, keywords: list, budget: int) -> list:
+        """Return the context of each document that fits the budget, best documents first.
+
+        documents are search results with a 'score', texts their contents in the same order.
+        """
+        passages = []
+        for rank, (document, text) in enumerate(zip(documents, texts)):
+            for position, passage in enumerate(split_passages(text)):
+                passages.append((rank, position, passage, document["score"]))
+
+        tokenized = [[word.lower() for word in WORD_PATTERN.findall(passage)] for _, _, passage, _ in passages]
+        scores = bm25_scores(tokenized, keywords)
+
+        order = sorted(range(len(passages)),
+                       key=lambda i: (-(scores[i] + passages[i][3]), passages[i][0], passages[i][1]))
+
+        selected = []
+        remaining = budget
+        for i in order:
+            # Passages are joined with one space or blank line, counted as one token
+            cost = self.count_tokens(passages[i][2]) + 1
+            if cost <= remaining:
+                selected.append(i)
+                remaining -= cost
+
+        contexts = {}
+        for i in sorted(selected, key=lambda i: (passages[i][0], passages[i][1])):
+            contexts.setdefault(passages[i][0], []).append(passages[i][2])
+
+        return [" ".join(contexts[rank]) for rank in sorted(contexts)]
@@ -0,0 +1,152 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from context_packer import MESSAGE_OVERHEAD, count_tokens
+
+# Tokens of history sent with every request, of which the summary of older turns may take up to SUMMARY_TOKENS
+HISTORY_TOKENS = 1024
+SUMMARY_TOKENS = 256
+
+# Most recent turns sent in full
+HISTORY_TURNS = 6
+
+# Words of a question or answer kept in the summary
+SUMMARY_WORDS = 30
+
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def first_sentence(text: str, max_words: int = SUMMARY_WORDS) -> str:
+    """Return the first sentence of a text, shortened to max_words."""
+    sentence = SENTENCE_PATTERN.split(text.strip(), 1)[0]
+    words = sentence.split()
+    if len(words) > max_words:
+        return " ".join(words[:max_words]) + " ..."
+    return " ".join(words)
+
+
+class ConversationMemory:
+    """The messages of one conversation, held to a token budget however long it runs.
+
+    System prompts are pinned and sent with every request. The most recent turns are sent in full, at most window
+    of them and only while they fit the budget; older turns are compacted into a summary message of their first
+    sentences, which forgets its oldest lines beyond summary_tokens.
+    """
+
+    def __init__(self, system_prompts: list, budget: int = HISTORY_TOKENS, window: int = HISTORY_TURNS,
+                 summary_tokens: int = SUMMARY_TOKENS, model: str = None) -> None:
+        self.pinned = [{"role": "system", "content": prompt} for prompt in system_prompts]
+        self.budget = budget
+        self.window = window
+        self.summary_tokens = min(summary_tokens, budget)
+        self.model = model
+        self.turns = deque()
+        self.summary = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.turns)
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.model) + MESSAGE_OVERHEAD
+
+    def tokens(self) -> int:
+        """Return the tokens of history sent with the next request: the summary and the recent turns."""
+        with self.lock:
+            return self._tokens()
+
+    def _tokens(self) -> int:
+        summary = sum(tokens for _, tokens in self.summary)
+        return (summary + MESSAGE_OVERHEAD if summary else 0) + sum(tokens for _, _, tokens in self.turns)
+
+    def messages(self, question: str) -> list:
+        """Return the messages of a request: the pinned prompts, the summary, the recent turns and the question."""
+        with self.lock:
+            messages = list(self.pinned)
+            if self.summary:
+                messages.append({"role": "system",
+                                 "content": SUMMARY_HEADER + "\n".join(line for line, _ in self.summary)})
+            for turn_question, answer, _ in self.turns:
+                messages.append({"role": "user", "content": turn_question})
+                messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": question})
+        return messages
+
+    def add_turn(self, question: str, answer: str) -> int:
+        """Remember a question and its answer, and return how many older turns were compacted into the summary."""
+        tokens = self.count_tokens(question) + self.count_tokens(answer)
+        with self.lock:
+            self.turns.append((question, answer, tokens))
+            return self._compact()
+
+    def _compact(self) -> int:
+        compacted = 0
+        turn_tokens = sum(tokens for _, _, tokens in self.turns)
+        while self.turns and (len(self.turns) > self.window or turn_tokens > self.budget - self.summary_tokens):
+            question, answer, tokens = self.turns.popleft()
+            turn_tokens -= tokens
+            self._summarize(question, answer)
+            compacted += 1
+        return compacted
+
+    def _summarize(self, question: str, answer: str):
+        line = f"- User: {first_sentence(question)} Assistant: {first_sentence(answer)}"
+        # Lines are joined with a newline, counted as one token
+        self.summary.append((line, count_tokens(line, self.model) + 1))
+
+        summary_tokens = sum(tokens for _, tokens in self.summary)
+        while self.summary and summary_tokens + MESSAGE_OVERHEAD > self.summary_tokens:
+            summary_tokens -= self.summary.popleft()[1]
+
+    def clear(self):
+        with self.lock:
+            self.turns.clear()
+            self.summary.clear()
+
+
+class ConversationStore:
+    """The conversation memories of concurrent sessions, by session key.
+
+    Sessions idle for longer than ttl seconds start over, and the least recently used ones are dropped beyond
+    max_sessions. Continued sessions count as hits and new ones as misses.
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 3600.0) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, key, create) -> ConversationMemory:
+        """Return the memory of a session, calling create() for a new or expired one."""
+        now = time.time()
+        with self.lock:
+            entry = self.sessions.pop(key, None)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.hits += 1
+                memory = entry[0]
+            else:
+                self.misses += 1
+                memory = create()
+
+            self.sessions[key] = (memory, now)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return memory
+
+    def remove(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
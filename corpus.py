@@ -0,0 +1,91 @@
+import array
+from collections import Counter
+
+
+class Vocabulary:
+    """Intern terms to consecutive integer ids, so every distinct term is stored once for the whole corpus."""
+
+    __slots__ = ("ids", "terms")
+
+    def __init__(self) -> None:
+        self.ids = {}
+        self.terms = []
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term: str):
+        return term in self.ids
+
+    def id(self, term: str) -> int:
+        """Return the id of a term, adding it to the vocabulary if it is new."""
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def term(self, term_id: int) -> str:
+        return self.terms[term_id]
+
+
+class Document:
+    """A search result or corpus entry with only its id, name and score."""
+
+    __slots__ = ("id", "name", "score")
+
+    def __init__(self, id: int, name: str, score: float = 0.0):
+        self.id = id
+        self.name = name
+        self.score = score
+
+    def __repr__(self):
+        return f"Document(name={self.name}, score={self.score})"
+
+
+class Corpus:
+    """Tokenized documents stored as runs of (term id, frequency) pairs in shared arrays.
+
+    Document i owns term_ids[offsets[i]:offsets[i + 1]] and the matching freqs, in the order its terms first
+    occur, which is all BM25 needs. Instead of a list of token strings per document, a document costs about eight
+    bytes per distinct term, and the term strings are shared through the vocabulary.
+    """
+
+    def __init__(self, vocabulary: Vocabulary = None) -> None:
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.names = []
+        self.lengths = array.array("I")
+        self.offsets = array.array("Q", [0])
+        self.term_ids = array.array("I")
+        self.freqs = array.array("I")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (self.document(doc_id) for doc_id in range(len(self.names)))
+
+    def add(self, name: str, tokens: list) -> int:
+        """Add a tokenized document and return its id."""
+        for term, frequency in Counter(tokens).items():
+            self.term_ids.append(self.vocabulary.id(term))
+            self.freqs.append(frequency)
+
+        self.names.append(name)
+        self.lengths.append(len(tokens))
+        self.offsets.append(len(self.term_ids))
+        return len(self.names) - 1
+
+    def document(self, doc_id: int) -> Document:
+        return Document(doc_id, self.names[doc_id])
+
+    def term_frequencies(self, doc_id: int):
+        """Yield the (term, frequency) pairs of a document."""
+        terms = self.vocabulary.terms
+        start, end = self.offsets[doc_id], self.offsets[doc_id + 1]
+        for term_id, frequency in zip(self.term_ids[start:end], self.freqs[start:end]):
+            yield terms[term_id], frequency
+
+    def nbytes(self) -> int:
+        """Return the size of the arrays in bytes, excluding the names and the vocabulary."""
+        return sum(values.itemsize * len(values) for values in (self.lengths, self.offsets, self.term_ids, self.freqs))
@@ -1,57 +1,145 @@
 import argparse
+from functools import partial
 
-from llama_index import GPTVectorStoreIndex, LLMPredictor, ServiceContext, SimpleDirectoryReader, QuestionAnswerPrompt
 from rich.console import Console
+from answer_cache import AnswerCache
 from document_search_backend import DocumentSearchBackend
-from langchain import OpenAI
-from langchain.chat_models import ChatOpenAI
+from embedding_store import EmbeddingBackend, EmbeddingStore, OpenAIEmbeddingBackend
+from manifest import content_hash
+from metrics import metrics
+from retrieval import RRF_K, HybridRetriever
+
+QA_PROMPT_TEMPLATE = (
+    "You are an AI assistant here to help. Use the following context snippet to answer the question at the end.\n"
+    "If you don't know the answer, simply say that you don't know. DO NOT attempt to make up an answer.\n"
+    "If the question is not related to the context, politely state that you are only set to answer context-related questions.\n"
+    "If the question is not available, answer by saying that the answer is not available in the document data.\n"
+    "\n{context_str}\n"
+    "Question: {query_str}\n"
+    "Helpful Answer:\n\n"
+)
 
 
 class DocumentSearch:
-    def __init__(self, llm, folder_path):
+    def __init__(self, llm, folder_path, embedding_backend: EmbeddingBackend = None, answer_cache: AnswerCache = None,
+                 retrieval: str = "bm25", fusion_weights: dict = None, rrf_k: int = RRF_K, llm_factory=None):
         self.llm = llm
+        self.llm_factory = llm_factory
         self.folder_path = folder_path
         self.backend = DocumentSearchBackend()
+        self.answer_cache = answer_cache
+        self.embedding_backend = embedding_backend
+        self.embedding_store = None
+        self.retrieval = retrieval
+        self.fusion_weights = fusion_weights
+        self.rrf_k = rrf_k
+        self.retriever = None
         self.console = Console()
-        self.QA_PROMPT = QuestionAnswerPrompt(
-            "You are an AI assistant here to help. Use the following context snippet to answer the question at the end.\n"
-            "If you don't know the answer, simply say that you don't know. DO NOT attempt to make up an answer.\n"
-            "If the question is not related to the context, politely state that you are only set to answer context-related questions.\n"
-            "If the question is not available, answer by saying that the answer is not available in the document data.\n"
-            "\n{context_str}\n"
-            "Question: {query_str}\n"
-            "Helpful Answer:\n\n"
-        )
 
-    def search_documents(self, question):
-        keywords = self.backend.get_keywords(question)
+    def search_documents(self, question, count=3, keywords=None):
+        if keywords is None:
+            keywords = self.backend.get_keywords(question)
         self.console.print("Found keywords:", keywords)
 
-        documents = self.backend.search_documents(question)
+        with metrics.span("retrieve", retrieval=self.retrieval):
+            if self.retrieval == "bm25":
+                documents = self.backend.search_documents(question, count, keywords)
+            else:
+                documents = self.get_retriever().search(question, count, keywords)
+
         for document in documents:
-            self.console.print(f"Found top documents: {document['name']} with score {document['score']}")
+            sources = "".join(f", {source} rank {document[f'{source}_rank']}" for source in ("bm25", "vector")
+                              if f"{source}_rank" in document)
+            self.console.print(f"Found top documents: {document['name']} with score {document['score']}{sources}")
 
         return documents
 
+    def get_retriever(self) -> HybridRetriever:
+        # Created on first use, so BM25-only searches never load the vector index
+        if self.retriever is None:
+            self.retriever = HybridRetriever(self.backend, self.get_embedding_store(), self.retrieval,
+                                             self.fusion_weights, self.rrf_k)
+        return self.retriever
+
+    def get_answer_cache(self) -> AnswerCache:
+        # Created on first use, so callers that cache answers themselves never register an unused cache; a cache
+        # passed in is registered by its owner
+        if self.answer_cache is None:
+            self.answer_cache = AnswerCache()
+            metrics.register_cache("answer", self.answer_cache)
+        return self.answer_cache
+
+    def get_embedding_store(self) -> EmbeddingStore:
+        # Created on first use, so document-only callers never set up an embedding backend
+        if self.embedding_store is None:
+            self.embedding_store = EmbeddingStore(self.embedding_backend or OpenAIEmbeddingBackend())
+            metrics.register_cache("embedding", self.embedding_store)
+        return self.embedding_store
+
+    def load_nodes(self, documents):
+        from llama_index.data_structs.node import Node
+
+        texts = self.backend.read_chunks([document["name"] for document in documents])
+
+        # Chunks embedded by an earlier question or process are looked up by content hash, not re-embedded
+        vectors = self.get_embedding_store().embed([(content_hash(text), text) for text in texts])
+
+        return [
+            Node(text=text, doc_id=document["name"], embedding=vector, extra_info={"file_name": document["name"]})
+            for document, text, vector in zip(documents, texts, vectors)
+        ]
+
+    def get_llm(self):
+        # main.py passes a factory, so langchain is only imported once the first answer is generated
+        if self.llm_factory is not None and self.llm is None:
+            self.llm = self.llm_factory()
+        return self.llm
+
     def query_engine(self, documents, question):
-        llm_predictor = LLMPredictor(llm=self.llm)
-        service_context = ServiceContext.from_defaults(llm_predictor=llm_predictor, chunk_size_limit=3000)
-        load_docs = SimpleDirectoryReader(input_files=[i["location"] for i in documents]).load_data()
-        index = GPTVectorStoreIndex.from_documents(documents=load_docs, service_context=service_context)
-        query_engine = index.as_query_engine(text_qa_template=self.QA_PROMPT, streaming=False)
-        return query_engine.query(question)
+        # llama_index and langchain take seconds to import, and BM25-only callers never need them
+        from llama_index import GPTVectorStoreIndex, LLMPredictor, QuestionAnswerPrompt, ServiceContext
+        from store_embedding import StoreEmbedding
 
-    def search(self, question):
-        documents = self.search_documents(question)
-        result = self.query_engine(documents, question)
+        with metrics.span("query_engine", documents=len(documents)) as span:
+            llm_predictor = LLMPredictor(llm=self.get_llm())
+            embed_model = StoreEmbedding(self.get_embedding_store())
+            service_context = ServiceContext.from_defaults(llm_predictor=llm_predictor, embed_model=embed_model,
+                                                           chunk_size_limit=3000)
+            index = GPTVectorStoreIndex(nodes=self.load_nodes(documents), service_context=service_context)
+            query_engine = index.as_query_engine(text_qa_template=QuestionAnswerPrompt(QA_PROMPT_TEMPLATE),
+                                                 streaming=False)
+            result = query_engine.query(question)
+
+            # llama_index counts the prompt and the answer tokens together
+            span["tokens"] = llm_predictor.total_tokens_used
+            metrics.increment("tokens_sent_total", llm_predictor.total_tokens_used)
         return result
 
+    def search(self, question):
+        with metrics.span("search") as span:
+            keywords = self.backend.get_keywords(question)
+            fingerprint = self.backend.corpus_fingerprint()
+
+            cached_answer = self.get_answer_cache().get(keywords, fingerprint)
+            span["cached"] = cached_answer is not None
+            metrics.increment("searches_total", cached=span["cached"])
+            if cached_answer is not None:
+                self.console.print("Found a cached answer for a similar question.")
+                return cached_answer
+
+            documents = self.search_documents(question, keywords=keywords)
+            result = self.query_engine(documents, question)
+            self.get_answer_cache().put(keywords, fingerprint, str(result))
+            return result
+
 
 class Models:
     def __init__(self, api_key: str):
         self.api_key = api_key
 
     def instruct_gpt(self, model: str = "text-davinci-003", temperature: float = 0.0):
+        from langchain import OpenAI
+
         return OpenAI(
             openai_api_key=self.api_key,
             model=model,
@@ -59,19 +147,27 @@ class Models:
         )
 
     def chat_gpt(self, model: str = "gpt-3.5-turbo", temperature: float = 0.0):
+        from langchain.chat_models import ChatOpenAI
+
         return ChatOpenAI(
             openai_api_key=self.api_key,
             model=model,
             temperature=temperature
         )
 
-def create_gpt_models(api_key):
+def create_gpt_models(api_key, parents: list = ()):
+    factory = gpt_model_factory(api_key, parents)
+    return factory() if factory is not None else None
+
+
+def gpt_model_factory(api_key, parents: list = ()):
+    """Parse the model options and return a function creating the selected model, without importing langchain yet."""
     model_choices = {
         "davinci": "text-davinci-003",
         "chat": "gpt-3.5-turbo"
     }
 
-    parser = argparse.ArgumentParser(description="Model selection for GPT functions")
+    parser = argparse.ArgumentParser(description="Model selection for GPT functions", parents=list(parents))
     parser.add_argument("--model", type=str, default="chat", choices=model_choices.keys(), help="The GPT model to use: 'davinci' or 'chat'. Default is 'chat'.")
     parser.add_argument("--temperature", type=float, default=0.0, help="Temperature value for response generation")
     args = parser.parse_args()
@@ -79,8 +175,8 @@ def create_gpt_models(api_key):
     models = Models(api_key=api_key)
     selected_model = model_choices[args.model]
     if args.model == "best":
-        return models.instruct_gpt(model=selected_model, temperature=args.temperature)
+        return partial(models.instruct_gpt, model=selected_model, temperature=args.temperature)
     elif args.model == "chat":
-        return models.chat_gpt(model=selected_model, temperature=args.temperature)
+        return partial(models.chat_gpt, model=selected_model, temperature=args.temperature)
     else:
         print("Error: Invalid model specified. Please choose between 'davinci' and 'chat'.")
@@ -1,149 +1,394 @@
-import heapq
 import os
-import warnings
-import nltk
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from langchain.document_loaders import TextLoader
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from rank_bm25 import BM25Okapi
-from tqdm import tqdm
-from text import AutoTranslator
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, so concurrent updates there are only serialized within a process
+    fcntl = None
 
-with warnings.catch_warnings():
-    warnings.filterwarnings(
-        "ignore",
-        category=UserWarning)  # Hide download warnings
-    nltk.download('stopwords', quiet=True)
+from tqdm import tqdm
+from inverted_index import IndexBuilder, InvertedIndex, ShardedIndex, shard_path
+from chunk_store import ChunkStore
+from corpus import Corpus, Document, Vocabulary
+from metrics import metrics
+from preprocessing import DEFAULT_TOKENIZER, Preprocessor, get_tokenizer
+from text import LANGUAGE_DICT, AutoTranslator, BatchText, get_stopwords
 
 # Define constants for folder path and language dictionary
 FOLDER_PATH = "docs"
-LANGUAGE_DICT = {"id": "indonesian", "en": "english"}
+INDEX_PATH = f"{FOLDER_PATH}.index"
+INDEX_LOCK_PATH = f"{INDEX_PATH}.lock"
+MANIFEST_PATH = f"{FOLDER_PATH}.manifest.json"
+ANN_INDEX_PATH = f"{FOLDER_PATH}.ann"
+CHUNK_STORE_PATH = f"{FOLDER_PATH}.chunks"
+
+# Number of documents whose languages are detected and tokenized together by one worker
+LANGUAGE_BATCH_SIZE = 256
 
-class Document:
-    """A class to represent a document with its name, content, and score."""
+# Every language gets an index shard of its own, chunks in any other language share the last one
+OTHER_LANGUAGE = "other"
+SHARD_LANGUAGES = (*LANGUAGE_DICT.values(), OTHER_LANGUAGE)
 
-    def __init__(self, name, content):
-        self.name = name
-        self.content = content
-        self.score = 0
+IndexUpdate = namedtuple("IndexUpdate", ["added", "modified", "removed"])
+
+
+@contextmanager
+def index_lock():
+    """Hold an exclusive lock on the index shards across processes, such as the server and manipulator.py."""
+    with open(INDEX_LOCK_PATH, "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        yield
 
-    def __repr__(self):
-        return f"Document(name={self.name}, score={self.score})"
 
 class DocumentSearchBackend:
-    def __init__(self):
+    def __init__(self, tokenizer: str = None, workers: int = None):
         self.translator = AutoTranslator()
-        self.document_language = None
+        # An explicit tokenizer is used for the next index build; otherwise the one of the existing index is kept
+        self.requested_tokenizer = tokenizer
+        self.tokenizer = tokenizer or DEFAULT_TOKENIZER
+        self.workers = workers
+        self.index = None
+        self.engines = {}
+        self.chunk_store = None
+        self.lock = threading.Lock()
 
     def detect_language(self, text: str):
         """Detect the language of a text using the translator."""
         detected_language = self.translator.detect_language(text, sanitize=True)
         return LANGUAGE_DICT.get(detected_language)
 
-    def process_documents(self):
-        """Process the documents in the folder and return a list of Document objects."""
-        documents = []
-
-        file_list = self.get_text_files()
-
-        for file_name in tqdm(file_list, desc='Processing documents'):
-            texts = self.load_texts(file_name)
-
-            for text in texts:
-                document = Document(file_name, text.page_content)
-                document.content = self.tokenize_without_stopwords(document.content)
-                documents.append(document)
-
-        return documents
+    def detect_languages(self, texts: list) -> list:
+        """Detect the language of many texts in one pass using the translator's cache."""
+        detected_languages = self.translator.detect_languages(BatchText(texts), sanitize=True)
+        return [LANGUAGE_DICT.get(language) for language in detected_languages]
+
+    def process_documents(self, file_list: list = None) -> dict:
+        """Process the documents in the folder, or only the given files, and return a compact corpus per language.
+
+        The corpora of all languages share one vocabulary and are keyed by their shard language.
+        """
+        vocabulary = Vocabulary()
+        corpora = {}
+
+        if file_list is None:
+            file_list = self.get_text_files()
+
+        # Language tagging, tokenization and stopword filtering fan out across processes, in the order of the files
+        preprocessor = Preprocessor(self.tokenizer, self.workers, LANGUAGE_BATCH_SIZE)
+        texts = (self.load_text(file_name) for file_name in file_list)
+        with metrics.span("process_documents", documents=len(file_list)), \
+                tqdm(total=len(file_list), desc='Processing documents') as progress_bar:
+            for file_name, (language, tokens) in zip(file_list, preprocessor.run(texts)):
+                shard = language if language in SHARD_LANGUAGES else OTHER_LANGUAGE
+                corpus = corpora.get(shard)
+                if corpus is None:
+                    corpus = corpora[shard] = Corpus(vocabulary)
+                corpus.add(file_name, tokens)
+                progress_bar.update(1)
+        metrics.increment("documents_processed_total", sum(len(corpus) for corpus in corpora.values()))
+
+        return corpora
+
+    def get_chunk_store(self) -> ChunkStore:
+        """Open the chunk store, importing the .txt files of the folder if it does not exist yet."""
+        if self.chunk_store is None:
+            exists = os.path.exists(CHUNK_STORE_PATH)
+            self.chunk_store = ChunkStore(CHUNK_STORE_PATH)
+            if not exists and os.path.isdir(FOLDER_PATH):
+                imported = self.chunk_store.import_folder(FOLDER_PATH)
+                if imported:
+                    print(f"Imported {imported} text file(s) from '{FOLDER_PATH}' into '{CHUNK_STORE_PATH}'.")
+        return self.chunk_store
 
     def get_text_files(self):
-        """Get a list of text files in the folder."""
-        file_list = [file_name for file_name in os.listdir(FOLDER_PATH) if file_name.endswith('.txt')]
-        return file_list
-
-    def load_texts(self, file_name: str):
-        """Load texts from a file using TextLoader."""
-        text_loader = TextLoader(os.path.join(FOLDER_PATH, file_name), encoding="utf-8")
-        texts = text_loader.load()
-        return texts
-
-    def detect_document_language(self, documents: list):
-        """Detect the language of the documents using the first non-empty text."""
-        for document in documents:
-            word_count = len(document.content)
-
-            if 10 < word_count < 50:
-                self.document_language = self.detect_language(" ".join(document.content))
-                break
-
-        if self.document_language is None:
-            # Use the first document as a fallback
-            self.document_language = self.detect_language(" ".join(documents[0].content))
-
-    def tokenize_without_stopwords(self, text: str):
-        """Tokenize a text without stopwords using nltk."""
-        language = self.detect_language(text)
-        words = nltk.word_tokenize(text)
-        language_stopwords = stopwords.words(language)
+        """Get the names of all chunks, including the ones another process wrote since the last call."""
+        chunk_store = self.get_chunk_store()
+        chunk_store.refresh()
+        return chunk_store.names()
+
+    def file_fingerprint(self, file_name: str) -> tuple:
+        """Return the (mtime, size, content hash) of a chunk; the store keeps no mtime, so it is always 0."""
+        chunk_store = self.get_chunk_store()
+        return 0, chunk_store.entries[file_name][1], chunk_store.digest(file_name)
+
+    def load_text(self, file_name: str) -> str:
+        return self.get_chunk_store().get(file_name)
+
+    def read_chunks(self, names: list) -> list:
+        """Return the texts of the given chunks from the chunk store."""
+        chunk_store = self.get_chunk_store()
+        if any(name not in chunk_store for name in names):
+            # The index may already know chunks that this process has not read from the store yet
+            chunk_store.refresh()
+        return chunk_store.get_many(names)
+
+    def tokenize_without_stopwords(self, text: str, language: str = None):
+        """Tokenize a lowercased text without stopwords, detecting its language unless it is given."""
+        if language is None:
+            language = self.detect_language(text)
+        words = get_tokenizer(self.tokenizer)(text.lower())
+        language_stopwords = get_stopwords(language)
         return [word for word in words if word not in language_stopwords]
 
     def get_keywords(self, question: str) -> list:
         """Get keywords from a question by removing stopwords and punctuation."""
-        language = self.detect_language(question)
-        stopwords_language = set(stopwords.words(language))
-        custom_stopwords = {"?", "!", ".", ","}
-        stopwords_language.update(custom_stopwords)
-
-        tokens = word_tokenize(question)
-        keywords = [token for token in tokens if token not in stopwords_language]
+        # Questions must be split like the indexed documents, or their keywords may miss the index terms
+        self.load_index()
 
-        return list(set(keywords))
+        with metrics.span("get_keywords") as span:
+            language = self.detect_language(question)
+            custom_stopwords = {"?", "!", ".", ","}
+            stopwords_language = get_stopwords(language) | custom_stopwords
 
-    def find_top_documents(self, keywords: list, documents: list) -> list:
-        """Find the top documents that match the keywords using BM25Okapi."""
-        # Translate the keywords to the document language
-        translated_keywords = self.translator.auto_translate_keywords(keywords, self.document_language)
+            tokens = get_tokenizer(self.tokenizer)(question.lower())
+            keywords = list(set(token for token in tokens if token not in stopwords_language))
+            span["keywords"] = len(keywords)
 
-        # Create a BM25Okapi object with the document contents
-        bm25 = BM25Okapi([document.content for document in documents])
+        return keywords
 
-        # Get the scores for each document
-        doc_scores = bm25.get_scores(translated_keywords)
+    def write_shards(self, builders: dict, corpora: dict, fingerprints: dict):
+        """Add the tokenized documents of every language to the builder of its shard and write the shards."""
+        for language, builder in builders.items():
+            if language in corpora:
+                builder.add_corpus(corpora[language], fingerprints)
+            builder.write(shard_path(INDEX_PATH, language), language, self.tokenizer)
 
-        # Assign the scores to the document objects
-        for document, score in zip(documents, doc_scores):
-            document.score = score
-
-        # Find the top 3 documents with the highest scores
-        top_documents = heapq.nlargest(3, documents, key=lambda x: x.score)
-
-        # Return the top documents as a list
-        return top_documents
-
-    def search_documents(self, question: str) -> list:
-        """Search the documents for a question and return a list of top documents with their locations and scores."""
-
-        # Get the keywords from the question
-        keywords = self.get_keywords(question)
-
-        # Process the documents and create Document objects
-        documents = self.process_documents()
-
-        # Detect the document language
-        self.detect_document_language(documents)
-
-        # Find the top documents that match the keywords
-        top_documents = self.find_top_documents(keywords, documents)
-
-        # Prepare the result list with document names, locations, and scores
-        result = []
-        for document in top_documents:
-            result.append({
-                'name': document.name,
-                'location': os.path.join(FOLDER_PATH, document.name),
-                'score': document.score
-            })
-
-        return result[:3]  # Return only the top 3 documents
+    def build_index(self):
+        """Tokenize the documents in the folder and write an inverted index shard per language next to it."""
+        with index_lock():
+            return self._build_index()
 
+    def _build_index(self):
+        file_list = self.get_text_files()
+        fingerprints = {file_name: self.file_fingerprint(file_name) for file_name in file_list}
+
+        corpora = self.process_documents(file_list)
+        self.write_shards({language: IndexBuilder() for language in SHARD_LANGUAGES}, corpora, fingerprints)
+        self.close_index()
+        return IndexUpdate(set(file_list), set(), set())
+
+    def detect_changes(self, index: ShardedIndex):
+        """Compare the chunk store with the index and return the added, modified, removed and touched documents.
+
+        The store keeps the content hash of every chunk, so no text is read to find the changes. Touched documents
+        have the same content hash but an outdated fingerprint, such as one taken from a .txt file before the store
+        existed, so only their fingerprint needs refreshing.
+        """
+        indexed = index.document_ids()
+        added, modified, touched = set(), set(), {}
+
+        for file_name in self.get_text_files():
+            doc_id = indexed.pop(file_name, None)
+            if doc_id is None:
+                added.add(file_name)
+                continue
+
+            fingerprint = self.file_fingerprint(file_name)
+            indexed_fingerprint = index.fingerprint(doc_id)
+            if fingerprint == indexed_fingerprint:
+                continue
+
+            if fingerprint[2] == indexed_fingerprint[2]:
+                touched[file_name] = fingerprint
+            else:
+                modified.add(file_name)
+
+        removed = set(indexed)
+        return added, modified, removed, touched
+
+    def update_index(self) -> IndexUpdate:
+        """Bring the index up to date with the folder, tokenizing only the added and modified documents."""
+        # Another process may be updating the shards too; once it is done, there is nothing left to do here
+        with index_lock():
+            return self._update_index()
+
+    def _update_index(self) -> IndexUpdate:
+        if not all(os.path.exists(shard_path(INDEX_PATH, language)) for language in SHARD_LANGUAGES):
+            return self._build_index()
+
+        try:
+            index = ShardedIndex(INDEX_PATH, SHARD_LANGUAGES)
+        except ValueError:
+            return self._build_index()
+
+        if self.requested_tokenizer is not None and index.tokenizer != self.requested_tokenizer:
+            # Documents tokenized differently cannot share one index
+            index.close()
+            return self._build_index()
+        self.tokenizer = index.tokenizer
+
+        try:
+            added, modified, removed, touched = self.detect_changes(index)
+            if not (added or modified or removed or touched):
+                return IndexUpdate(set(), set(), set())
+
+            changed = sorted(added | modified)
+            fingerprints = {file_name: self.file_fingerprint(file_name) for file_name in changed}
+            corpora = self.process_documents(changed)
+
+            # A modified document may have changed language, so it is dropped from its shard and added to the new
+            # one. Only the shards that lose, gain or refresh a document are rewritten.
+            stale = modified | removed | set(touched)
+            builders = {}
+            for language, shard in index.shards.items():
+                if language in corpora or any(shard.doc_name(doc_id) in stale for doc_id in range(shard.doc_count)):
+                    builders[language] = IndexBuilder.from_index(shard, exclude=modified | removed,
+                                                                 fingerprints=touched)
+        finally:
+            index.close()
+
+        self.write_shards(builders, corpora, fingerprints)
+
+        self.close_index()
+        return IndexUpdate(added, modified, removed)
+
+    def load_index(self) -> ShardedIndex:
+        """Memory-map the index shards, building them first if they do not exist or were rewritten."""
+        with self.lock:
+            if self.index is not None and self.index.is_stale():
+                # Other threads may still be scoring with the old index, it is unmapped once they drop it
+                self.index = None
+
+            if self.index is None:
+                with metrics.span("load_index"):
+                    # Pick up documents that were added, edited or deleted since the index was written
+                    self.update_index()
+                    self.index = ShardedIndex(INDEX_PATH, SHARD_LANGUAGES)
+                    self.engines = {language: self.get_engine(shard) for language, shard in self.index.shards.items()}
+                self.tokenizer = self.index.tokenizer
+
+            return self.index
+
+    def corpus_fingerprint(self) -> str:
+        """Return a fingerprint of the indexed documents that changes whenever the corpus does."""
+        return self.load_index().corpus_fingerprint()
+
+    def close_index(self):
+        """Release the memory-mapped index, if any."""
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+            self.engines = {}
+
+    def translate_keywords(self, keywords: list, language: str = None) -> list:
+        """Translate the keywords to a shard language, or to the language of every non-empty shard if none is given."""
+        if language is not None:
+            return self.translator.auto_translate_keywords(keywords, language)
+
+        languages = [language for language, shard in self.load_index().shards.items() if len(shard)]
+        translated = [keyword for language in languages for keyword in self.translate_keywords(keywords, language)]
+        return list(dict.fromkeys(translated))
+
+    def translate_queries(self, queries: list, language: str) -> list:
+        """Translate the keywords of several queries to a language with a single translation batch."""
+        translated = iter(self.translate_keywords([keyword for keywords in queries for keyword in keywords], language))
+        return [[next(translated) for _ in keywords] for keywords in queries]
+
+    def get_engine(self, shard: InvertedIndex):
+        """Return the sparse BM25 engine of a shard, reusing the one built when the index was loaded."""
+        # scipy is only imported once an index is searched
+        from bm25_engine import SparseBM25
+
+        engine = self.engines.get(shard.language)
+        if engine is None or engine.index is not shard:
+            engine = SparseBM25(shard)
+        return engine
+
+    def search_shard(self, index: ShardedIndex, language: str, queries: list, count: int) -> list:
+        """Score the (position, keywords) queries in one shard and return their (position, doc_id, score) hits.
+
+        Every document with a keyword is a hit, including the ones BM25 scores negatively.
+        """
+        shard = index.shards[language]
+        offset = index.offsets[language]
+        with metrics.span("search_shard", language=language, queries=len(queries), documents=len(shard)):
+            tops = self.get_engine(shard).top_matches_batch([keywords for _, keywords in queries], count)
+        return [(position, offset + doc_id, score)
+                for (position, _), top in zip(queries, tops) for doc_id, score in top]
+
+    def find_top_documents(self, keywords: list, index: ShardedIndex, count: int = 3, pad: bool = True) -> list:
+        """Find the top documents that match the keywords using the BM25Okapi postings of the index."""
+        return self.find_top_documents_batch([keywords], index, count, pad)[0]
+
+    def find_top_documents_batch(self, queries: list, index: ShardedIndex, count: int = 3, pad: bool = True) -> list:
+        """Find the top documents of several keyword lists, searching the language shards in parallel.
+
+        The keywords are translated once per shard language, and a shard is only scored for the queries with a
+        translated keyword among its terms. The documents with a keyword are ranked together, whatever the sign of
+        their score, and unless pad is false followed by the first other documents when fewer than count match.
+        """
+        shards = {language: shard for language, shard in index.shards.items() if len(shard)}
+        with metrics.span("find_top_documents", queries=len(queries), documents=len(index)) as span:
+            # Translate the keywords to the language of every shard
+            with metrics.span("translate_keywords", keywords=sum(len(keywords) for keywords in queries),
+                              languages=len(shards)):
+                translations = {language: self.translate_queries(queries, language) for language in shards}
+
+            tasks = []
+            for language, shard in shards.items():
+                matching = [(position, keywords) for position, keywords in enumerate(translations[language])
+                            if any(shard.term_id(keyword) is not None for keyword in keywords)]
+                if matching:
+                    tasks.append((language, matching))
+            span["shards"] = len(tasks)
+
+            if len(tasks) > 1:
+                with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="shard") as executor:
+                    hits = list(executor.map(lambda task: self.search_shard(index, *task, count), tasks))
+            else:
+                hits = [self.search_shard(index, *task, count) for task in tasks]
+        metrics.increment("documents_scanned_total", sum(len(shards[language]) * len(matching)
+                                                         for language, matching in tasks))
+
+        ranked = [[] for _ in queries]
+        for shard_hits in hits:
+            for position, doc_id, score in shard_hits:
+                ranked[position].append((doc_id, score))
+
+        results = []
+        for top in ranked:
+            top = sorted(top, key=lambda hit: (-hit[1], hit[0]))[:count]
+            found = {doc_id for doc_id, _ in top}
+            padding = (doc_id for doc_id in range(len(index)) if doc_id not in found)
+            while pad and len(top) < min(count, len(index)):
+                top.append((next(padding), 0.0))
+            results.append([Document(doc_id, index.doc_name(doc_id), score) for doc_id, score in top])
+
+        return results
+
+    def search_documents(self, question: str, count: int = 3, keywords: list = None, pad: bool = True) -> list:
+        """Search the documents for a question and return a list of top documents with their locations and scores.
+
+        Callers that already have the keywords of the question pass them, so they are not extracted again.
+        """
+        return self.search_documents_batch([question], count, None if keywords is None else [keywords], pad)[0]
+
+    def search_documents_batch(self, questions: list, count: int = 3, queries: list = None, pad: bool = True) -> list:
+        """Search the documents for several questions at once, returning one result list per question."""
+
+        # Get the keywords from the questions
+        if queries is None:
+            queries = [self.get_keywords(question) for question in questions]
+
+        # Load the persistent index instead of re-tokenizing every document
+        index = self.load_index()
+
+        # Find the top documents that match the keywords of every question
+        results = []
+        for top_documents in self.find_top_documents_batch(queries, index, count, pad):
+            # Prepare the result list with document names, locations, and scores
+            result = []
+            for document in top_documents:
+                result.append({
+                    'name': document.name,
+                    'location': f"{CHUNK_STORE_PATH}#{document.name}",
+                    'score': document.score
+                })
+            results.append(result[:count])  # Return only the top documents
+
+        return results
@@ -0,0 +1,155 @@
+import array
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+
+EMBEDDING_STORE_PATH = os.path.join(".cache", "embeddings.sqlite3")
+
+
+class EmbeddingBackend:
+    """Turn texts into embedding vectors."""
+
+    name = "base"
+
+    def embed(self, texts: list) -> list:
+        raise NotImplementedError
+
+    def embed_query(self, query: str) -> list:
+        return self.embed([query])[0]
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+
+    def __init__(self, model: str = "text-embedding-ada-002", batch_size: int = 10) -> None:
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        self.model = OpenAIEmbedding(model=model)
+        self.batch_size = batch_size
+        self.name = f"openai:{model}"
+
+    def embed(self, texts: list) -> list:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self.model._get_text_embeddings(texts[start:start + self.batch_size]))
+        return vectors
+
+    def embed_query(self, query: str) -> list:
+        return self.model._get_query_embedding(query)
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """Deterministic local embeddings built from hashed word counts, for tests and offline use."""
+
+    def __init__(self, dimensions: int = 256) -> None:
+        self.dimensions = dimensions
+        self.name = f"hashing:{dimensions}"
+
+    def embed(self, texts: list) -> list:
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+                vector[digest % self.dimensions] += 1.0 if digest & (1 << 63) else -1.0
+
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+
+class EmbeddingStore:
+    """A persistent SQLite store of chunk embeddings keyed by content hash and embedding backend."""
+
+    def __init__(self, backend: EmbeddingBackend, path: str = EMBEDDING_STORE_PATH) -> None:
+        self.backend = backend
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "backend TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (backend, hash))"
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM embeddings WHERE backend = ?",
+                                           (self.backend.name,)).fetchone()[0]
+
+    def iter_blobs(self, hashes: list):
+        """Yield (content hash, raw float32 bytes) of the stored vectors, without building Python lists."""
+        unique_hashes = list(dict.fromkeys(hashes))
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE backend = ? AND hash IN ({placeholders})",
+                    [self.backend.name, *batch]
+                ).fetchall()
+            yield from rows
+
+    def get_many(self, hashes: list) -> dict:
+        """Return the stored vectors of the given content hashes."""
+        found = {}
+        for digest, blob in self.iter_blobs(hashes):
+            vector = array.array("f")
+            vector.frombytes(blob)
+            found[digest] = vector.tolist()
+
+        return found
+
+    def put_many(self, vectors: dict) -> None:
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (backend, hash, vector) VALUES (?, ?, ?)",
+                [(self.backend.name, digest, array.array("f", vector).tobytes()) for digest, vector in vectors.items()]
+            )
+            self.connection.commit()
+
+    def missing(self, hashes: list) -> list:
+        """Return the content hashes that have no stored vector yet."""
+        found = self.get_many(hashes)
+        return [digest for digest in dict.fromkeys(hashes) if digest not in found]
+
+    def embed(self, items: list) -> list:
+        """Return the vectors of (content hash, text) pairs, embedding only the ones that are not stored yet."""
+        vectors = self.get_many([digest for digest, _ in items])
+
+        pending = {}
+        for digest, text in items:
+            if digest not in vectors:
+                pending.setdefault(digest, text)
+
+        self.hits += len(items) - len(pending)
+        self.misses += len(pending)
+
+        if pending:
+            embedded = dict(zip(pending, self.backend.embed(list(pending.values()))))
+            self.put_many(embedded)
+            vectors.update(embedded)
+
+        return [vectors[digest] for digest, _ in items]
+
+    def prune(self, keep_hashes: set) -> int:
+        """Delete the vectors of chunks that no longer exist and return how many were removed."""
+        with self.lock:
+            rows = self.connection.execute("SELECT hash FROM embeddings WHERE backend = ?", (self.backend.name,))
+            stale = [(self.backend.name, digest) for digest, in rows if digest not in keep_hashes]
+            self.connection.executemany("DELETE FROM embeddings WHERE backend = ? AND hash = ?", stale)
+            self.connection.commit()
+        return len(stale)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
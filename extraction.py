@@ -0,0 +1,165 @@
+import importlib.util
+import os
+import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+ENGINES = ("auto", "pypdf", "unstructured")
+DEFAULT_ENGINE = "auto"
+
+# Number of consecutive pages extracted by one worker task
+PAGES_PER_TASK = 16
+
+# Blank lines separate the paragraphs of a page's text layer
+PARAGRAPH_PATTERN = re.compile(r"\n\s*\n")
+
+
+def extract_elements(file_path: str, file_type: str = "PDF") -> Iterator[tuple]:
+    """Extract (text, page number) elements of a document with unstructured, yielding them one at a time."""
+    # langchain and unstructured take seconds to import, so only the code paths that read documents load them
+    from langchain.document_loaders import UnstructuredPDFLoader, UnstructuredWordDocumentLoader
+
+    if file_type == "PDF":
+        loader = UnstructuredPDFLoader(file_path, mode="elements")
+    else:
+        loader = UnstructuredWordDocumentLoader(file_path, mode="elements")
+
+    try:
+        for document in loader.lazy_load():
+            yield document.page_content, (document.metadata or {}).get("page_number")
+    except NotImplementedError:
+        # The unstructured loaders cannot stream yet, so only keep the page number of every element
+        for element in loader._get_elements():
+            yield str(element), getattr(getattr(element, "metadata", None), "page_number", None)
+
+
+def partition_pages(reader, page_indexes: list) -> list:
+    """Extract some pages of a PDF with unstructured, by writing them to a temporary PDF of their own."""
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for page_index in page_indexes:
+        writer.add_page(reader.pages[page_index])
+
+    handle, temp_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            writer.write(file)
+        # Page numbers of the temporary PDF are mapped back to the pages of the source document
+        return [(text, page_indexes[(page_number or 1) - 1] + 1) for text, page_number in extract_elements(temp_path)]
+    finally:
+        os.remove(temp_path)
+
+
+def extract_page_range(file_path: str, start: int, stop: int, engine: str) -> tuple:
+    """Extract pages [start, stop) of a PDF and return their (text, page number) elements and the fallback pages."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    elements = []
+    empty_pages = []
+
+    if engine == "unstructured":
+        empty_pages = list(range(start, stop))
+    else:
+        for page_index in range(start, stop):
+            text = reader.pages[page_index].extract_text() or ""
+            paragraphs = [paragraph.strip() for paragraph in PARAGRAPH_PATTERN.split(text) if paragraph.strip()]
+            if paragraphs:
+                elements.extend((paragraph, page_index + 1) for paragraph in paragraphs)
+            else:
+                empty_pages.append(page_index)
+
+    fallback_pages = 0
+    if empty_pages and engine != "pypdf":
+        fallback_pages = len(empty_pages)
+        elements.extend(partition_pages(reader, empty_pages))
+        # A stable sort keeps the order of the elements within each page
+        elements.sort(key=lambda element: element[1])
+
+    return elements, fallback_pages
+
+
+class PdfExtractor:
+    """Extract the text of a PDF page range by page range across worker processes.
+
+    The pypdf engine only reads the text layer, unstructured parses the page layout, and auto reads the text layer
+    and only sends the pages without any text, such as scanned ones, to unstructured.
+    """
+
+    def __init__(self, engine: str = DEFAULT_ENGINE, workers: int = None, pages_per_task: int = PAGES_PER_TASK):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown extraction engine '{engine}'. Choose one of: {', '.join(ENGINES)}.")
+
+        self.engine = engine
+        self.workers = workers or os.cpu_count()
+        self.pages_per_task = pages_per_task
+        self.pages = 0
+        self.fallback_pages = 0
+
+    def fallback_available(self) -> bool:
+        return self.engine == "pypdf" or importlib.util.find_spec("unstructured") is not None
+
+    def extract(self, file_path: str) -> Iterator[tuple]:
+        """Yield the (text, page number) elements of a PDF in page order."""
+        from pypdf import PdfReader
+
+        engine = self.engine
+        if engine == "auto" and not self.fallback_available():
+            print("Warning: unstructured is not installed, pages without a text layer are skipped.")
+            engine = "pypdf"
+
+        self.pages = len(PdfReader(file_path).pages)
+        self.fallback_pages = 0
+        ranges = [(start, min(start + self.pages_per_task, self.pages))
+                  for start in range(0, self.pages, self.pages_per_task)]
+
+        if len(ranges) <= 1 or self.workers <= 1:
+            for start, stop in ranges:
+                elements, fallback_pages = extract_page_range(file_path, start, stop, engine)
+                self.fallback_pages += fallback_pages
+                yield from elements
+            return
+
+        workers = min(self.workers, len(ranges))
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for start, stop in ranges:
+                pending.append(executor.submit(extract_page_range, file_path, start, stop, engine))
+                # Results are consumed in page order; at most two ranges per worker are in flight, so finished
+                # ranges never pile up when the consumer is slower than the workers
+                while len(pending) >= workers * 2:
+                    yield from self._take(pending)
+
+            while pending:
+                yield from self._take(pending)
+
+    def _take(self, pending: deque) -> list:
+        elements, fallback_pages = pending.popleft().result()
+        self.fallback_pages += fallback_pages
+        return elements
+
+
+def compare_engines(file_path: str, workers: int = None, engines: tuple = ENGINES) -> list:
+    """Extract a PDF with every engine and return (engine, pages, fallback pages, characters, seconds) rows."""
+    rows = []
+    for engine in engines:
+        extractor = PdfExtractor(engine, workers)
+        if not extractor.fallback_available():
+            print(f"Skipping the {engine} engine, unstructured is not installed.")
+            continue
+
+        start = time.perf_counter()
+        characters = sum(len(text) for text, _ in extractor.extract(file_path))
+        rows.append((engine, extractor.pages, extractor.fallback_pages, characters, time.perf_counter() - start))
+    return rows
+
+
+def print_engine_comparison(rows: list):
+    print(f"{'engine':<14} {'pages':>6} {'fallback':>9} {'characters':>12} {'seconds':>9} {'chars/sec':>12}")
+    for engine, pages, fallback_pages, characters, seconds in rows:
+        print(f"{engine:<14} {pages:>6} {fallback_pages:>9} {characters:>12} {seconds:>9.2f} "
+              f"{characters / seconds if seconds else 0:>12.0f}")
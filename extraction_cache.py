@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from importlib import metadata
+from typing import Iterable, Iterator
+
+EXTRACTION_CACHE_PATH = os.path.join(".cache", "extractions.sqlite3")
+EXTRACTION_CACHE_SIZE = 1 << 30
+
+# Elements are stored in one block per page, split further once a page's text reaches this size
+BLOCK_SIZE = 1 << 20
+
+# Packages whose version changes the elements extracted by each engine
+ENGINE_PACKAGES = {
+    "unstructured": ("unstructured", "langchain"),
+    "pypdf": ("pypdf",),
+    "auto": ("pypdf", "unstructured", "langchain"),
+}
+
+
+def loader_version(engine: str = "unstructured") -> str:
+    """Return a key of an engine's packages' versions, read from their metadata without importing them."""
+    versions = []
+    for package in ENGINE_PACKAGES[engine]:
+        try:
+            versions.append(f"{package}-{metadata.version(package)}")
+        except metadata.PackageNotFoundError:
+            versions.append(f"{package}-none")
+    return ":".join([*versions, engine])
+
+
+class ExtractionCache:
+    """A persistent SQLite cache of the elements extracted from source documents, with LRU eviction by size.
+
+    Entries are keyed by the SHA-256 of the file's bytes and the loader version, so a moved or renamed file is
+    still found and upgrading the loader extracts again. The elements of an entry are stored as zlib-compressed JSON
+    lists of (text, page number) pairs, one block per page, and are written and read back block by block, so a large
+    document is never held in memory as a whole. The least recently used entries are evicted once they take more
+    than max_bytes.
+    """
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, max_bytes: int = EXTRACTION_CACHE_SIZE) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Batch workers write their extractions from several processes, so wait for each other's locks
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS extraction_entries ("
+            "hash TEXT NOT NULL, loader TEXT NOT NULL, source TEXT NOT NULL, blocks INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (hash, loader))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS extraction_blocks ("
+            "hash TEXT NOT NULL, loader TEXT NOT NULL, sequence INTEGER NOT NULL, elements BLOB NOT NULL, "
+            "PRIMARY KEY (hash, loader, sequence))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS extraction_entries_last_used "
+                                "ON extraction_entries (last_used)")
+        self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM extraction_entries").fetchone()[0]
+
+    def get(self, digest: str, loader: str):
+        """Return an iterator of the cached (text, page number) pairs of a file and mark it as recently used, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT blocks FROM extraction_entries WHERE hash = ? AND loader = ?",
+                                          (digest, loader)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute("UPDATE extraction_entries SET last_used = ? WHERE hash = ? AND loader = ?",
+                                    (time.time(), digest, loader))
+            self.connection.commit()
+
+        return self._read_blocks(digest, loader, row[0])
+
+    def _read_blocks(self, digest: str, loader: str, blocks: int) -> Iterator[tuple]:
+        for sequence in range(blocks):
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT elements FROM extraction_blocks WHERE hash = ? AND loader = ? AND sequence = ?",
+                    (digest, loader, sequence)).fetchone()
+            if row is None:
+                raise ValueError(f"The cached extraction {digest} was removed while it was being read.")
+            for text, page_number in json.loads(zlib.decompress(row[0])):
+                yield text, page_number
+
+    def store(self, digest: str, loader: str, source: str, elements: Iterable[tuple]) -> Iterator[tuple]:
+        """Pass the elements of a file through while storing them block by block.
+
+        Only a complete extraction becomes an entry: when the elements stop early, the stored blocks are removed.
+        """
+        with self.lock:
+            # Blocks left behind by an interrupted extraction of the same file
+            self._delete(digest, loader)
+            self.connection.commit()
+
+        block, block_size, sequence, size = [], 0, 0, 0
+        complete = False
+        try:
+            for text, page_number in elements:
+                if block and (page_number != block[-1][1] or block_size >= BLOCK_SIZE):
+                    size += self._put_block(digest, loader, sequence, block)
+                    block, block_size, sequence = [], 0, sequence + 1
+                block.append((text, page_number))
+                block_size += len(text)
+                yield text, page_number
+
+            if block:
+                size += self._put_block(digest, loader, sequence, block)
+                sequence += 1
+            # Storing an entry larger than the cache would only evict everything else
+            complete = size <= self.max_bytes
+        finally:
+            now = time.time()
+            with self.lock:
+                if complete:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO extraction_entries "
+                        "(hash, loader, source, blocks, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (digest, loader, source, sequence, size, now, now)
+                    )
+                    self.evict()
+                else:
+                    self._delete(digest, loader)
+                self.connection.commit()
+
+    def _put_block(self, digest: str, loader: str, sequence: int, block: list) -> int:
+        blob = zlib.compress(json.dumps(block, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extraction_blocks (hash, loader, sequence, elements) VALUES (?, ?, ?, ?)",
+                (digest, loader, sequence, blob)
+            )
+            self.connection.commit()
+        return len(blob)
+
+    def _delete(self, digest: str, loader: str):
+        self.connection.execute("DELETE FROM extraction_entries WHERE hash = ? AND loader = ?", (digest, loader))
+        self.connection.execute("DELETE FROM extraction_blocks WHERE hash = ? AND loader = ?", (digest, loader))
+
+    def evict(self) -> None:
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM extraction_entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        stale = []
+        for digest, loader, size in self.connection.execute(
+                "SELECT hash, loader, size FROM extraction_entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            stale.append((digest, loader))
+            total -= size
+        for digest, loader in stale:
+            self._delete(digest, loader)
+
+    def entries(self) -> list:
+        """Return (source, hash, loader, size, created, last_used) of every entry, most recently used first."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT source, hash, loader, size, created, last_used FROM extraction_entries ORDER BY last_used DESC"
+            ).fetchall()
+
+    def total_bytes(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM extraction_entries").fetchone()[0]
+
+    def clear(self) -> int:
+        """Delete every entry and return how many were removed."""
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM extraction_entries").rowcount
+            # Also drops the blocks of extractions that were interrupted by a crash
+            self.connection.execute("DELETE FROM extraction_blocks")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+        return removed
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,411 @@
+import array
+import bisect
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from collections import Counter
+
+from corpus import Corpus
+
+# BM25 parameters, identical to the rank_bm25.BM25Okapi defaults
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+
+MAGIC = b"MPIX"
+VERSION = 3
+HASH_SIZE = 32
+EMPTY_FINGERPRINT = (0, 0, "0" * HASH_SIZE * 2)
+
+# magic, version, byte order, number of documents, number of terms, number of postings, average document length,
+# document language, tokenizer the documents were tokenized with
+HEADER = struct.Struct("<4sHHIIQd16s16s")
+
+# Byte offsets of every section, in the order they are written
+SECTIONS = ("doc_lengths", "doc_name_offsets", "doc_names", "doc_mtimes", "doc_sizes", "doc_hashes", "term_offsets",
+            "terms", "postings_offsets", "idf", "postings_docs", "postings_freqs")
+SECTION_TABLE = struct.Struct(f"<{len(SECTIONS)}Q")
+
+BYTE_ORDERS = {"little": 0, "big": 1}
+
+
+def _align(file, size: int = 8):
+    """Pad the file with zero bytes up to the next multiple of size."""
+    padding = -file.tell() % size
+    file.write(b"\0" * padding)
+
+
+def _string_table(strings: list):
+    """Encode a list of strings into an offsets array and a single UTF-8 blob."""
+    offsets = array.array("Q", [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+class IndexBuilder:
+    """Accumulate tokenized documents and write them as a compact inverted index.
+
+    The postings of every term are kept as one array of interleaved document ids and frequencies.
+    """
+
+    def __init__(self):
+        self.doc_names = []
+        self.doc_lengths = array.array("I")
+        self.doc_mtimes = array.array("q")
+        self.doc_sizes = array.array("Q")
+        self.doc_hashes = bytearray()
+        self.postings = {}
+
+    @classmethod
+    def from_index(cls, index: "InvertedIndex", exclude: set = frozenset(), fingerprints: dict = None) -> "IndexBuilder":
+        """Load the postings of an existing index back into a builder, dropping the excluded documents.
+
+        Documents listed in fingerprints keep their postings but get the new fingerprint.
+        """
+        fingerprints = fingerprints or {}
+        builder = cls()
+        doc_ids = {}
+        for doc_id in range(index.doc_count):
+            name = index.doc_name(doc_id)
+            if name in exclude:
+                continue
+            fingerprint = fingerprints.get(name) or index.fingerprint(doc_id)
+            doc_ids[doc_id] = builder._add_entry(name, index.doc_lengths[doc_id], fingerprint)
+
+        for term_id in range(index.term_count):
+            docs, frequencies = index.postings(term_id)
+            postings = array.array("I")
+            for doc_id, frequency in zip(docs, frequencies):
+                if doc_id in doc_ids:
+                    postings.append(doc_ids[doc_id])
+                    postings.append(frequency)
+            if postings:
+                builder.postings[index.term(term_id)] = postings
+
+        return builder
+
+    def __len__(self):
+        return len(self.doc_names)
+
+    def _add_entry(self, name: str, length: int, fingerprint: tuple) -> int:
+        mtime, size, digest = fingerprint
+        self.doc_names.append(name)
+        self.doc_lengths.append(length)
+        self.doc_mtimes.append(mtime)
+        self.doc_sizes.append(size)
+        self.doc_hashes += bytes.fromhex(digest)
+        return len(self.doc_names) - 1
+
+    def _add_posting(self, term: str, doc_id: int, frequency: int):
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = array.array("I")
+        postings.append(doc_id)
+        postings.append(frequency)
+
+    def add_document(self, name: str, tokens: list, fingerprint: tuple = EMPTY_FINGERPRINT) -> int:
+        """Add a tokenized document with its (mtime, size, content hash) fingerprint and return its id."""
+        doc_id = self._add_entry(name, len(tokens), fingerprint)
+
+        for term, frequency in Counter(tokens).items():
+            self._add_posting(term, doc_id, frequency)
+
+        return doc_id
+
+    def add_corpus(self, corpus: Corpus, fingerprints: dict = None):
+        """Add every document of a corpus, with the fingerprints given by document name."""
+        fingerprints = fingerprints or {}
+        for corpus_id, name in enumerate(corpus.names):
+            doc_id = self._add_entry(name, corpus.lengths[corpus_id], fingerprints.get(name, EMPTY_FINGERPRINT))
+            for term, frequency in corpus.term_frequencies(corpus_id):
+                self._add_posting(term, doc_id, frequency)
+
+    def compute_idf(self, terms: list) -> array.array:
+        """Compute the BM25Okapi idf of each term, flooring negative values like rank_bm25 does."""
+        corpus_size = len(self.doc_names)
+        idf = array.array("d")
+        negative = []
+
+        for term in terms:
+            frequency = len(self.postings[term]) // 2
+            value = math.log(corpus_size - frequency + 0.5) - math.log(frequency + 0.5)
+            if value < 0:
+                negative.append(len(idf))
+            idf.append(value)
+
+        if idf:
+            floor = EPSILON * (sum(idf) / len(idf))
+            for position in negative:
+                idf[position] = floor
+
+        return idf
+
+    def write(self, path: str, language: str = None, tokenizer: str = "nltk"):
+        """Write the index to path atomically, so readers never see a half-written file."""
+        encoded_terms = sorted((term.encode("utf-8"), term) for term in self.postings)
+        terms = [term for _, term in encoded_terms]
+
+        doc_name_offsets, doc_names = _string_table([name.encode("utf-8") for name in self.doc_names])
+        term_offsets, term_blob = _string_table([encoded for encoded, _ in encoded_terms])
+
+        postings_offsets = array.array("Q", [0])
+        postings_docs = array.array("I")
+        postings_freqs = array.array("I")
+        for term in terms:
+            postings = self.postings[term]
+            postings_docs.extend(postings[0::2])
+            postings_freqs.extend(postings[1::2])
+            postings_offsets.append(len(postings_docs))
+
+        sections = {
+            "doc_lengths": self.doc_lengths.tobytes(),
+            "doc_name_offsets": doc_name_offsets.tobytes(),
+            "doc_names": doc_names,
+            "doc_mtimes": self.doc_mtimes.tobytes(),
+            "doc_sizes": self.doc_sizes.tobytes(),
+            "doc_hashes": bytes(self.doc_hashes),
+            "term_offsets": term_offsets.tobytes(),
+            "terms": term_blob,
+            "postings_offsets": postings_offsets.tobytes(),
+            "idf": self.compute_idf(terms).tobytes(),
+            "postings_docs": postings_docs.tobytes(),
+            "postings_freqs": postings_freqs.tobytes(),
+        }
+
+        total_length = sum(self.doc_lengths)
+        average_length = total_length / len(self.doc_names) if self.doc_names else 0.0
+        header = HEADER.pack(MAGIC, VERSION, BYTE_ORDERS[sys.byteorder], len(self.doc_names), len(terms),
+                             len(postings_docs), average_length, (language or "").encode("ascii")[:16],
+                             tokenizer.encode("ascii")[:16])
+
+        # A temporary file of its own, so writers in other processes never write into the same one
+        handle, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp",
+                                             dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(handle, "wb") as file:
+                file.write(header)
+                table_position = file.tell()
+                file.write(SECTION_TABLE.pack(*([0] * len(SECTIONS))))
+
+                offsets = []
+                for name in SECTIONS:
+                    _align(file)
+                    offsets.append(file.tell())
+                    file.write(sections[name])
+
+                file.seek(table_position)
+                file.write(SECTION_TABLE.pack(*offsets))
+
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+class InvertedIndex:
+    """A read-only, memory-mapped inverted index with the postings and BM25Okapi statistics scored by SparseBM25."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        self._corpus_fingerprint = None
+
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, byte_order, self.doc_count, self.term_count, self.postings_count, self.average_length, \
+            language, tokenizer = HEADER.unpack_from(self.mmap, 0)
+
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a supported index file. Rebuild it with manipulator.py.")
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            self.close()
+            raise ValueError(f"{path} was built on a machine with a different byte order. Rebuild it.")
+
+        self.language = language.rstrip(b"\0").decode("ascii") or None
+        self.tokenizer = tokenizer.rstrip(b"\0").decode("ascii")
+        self.sections = dict(zip(SECTIONS, SECTION_TABLE.unpack_from(self.mmap, HEADER.size)))
+
+        view = memoryview(self.mmap)
+        self.doc_lengths = self._array(view, "doc_lengths", "I", self.doc_count)
+        self.doc_name_offsets = self._array(view, "doc_name_offsets", "Q", self.doc_count + 1)
+        self.doc_mtimes = self._array(view, "doc_mtimes", "q", self.doc_count)
+        self.doc_sizes = self._array(view, "doc_sizes", "Q", self.doc_count)
+        self.term_offsets = self._array(view, "term_offsets", "Q", self.term_count + 1)
+        self.postings_offsets = self._array(view, "postings_offsets", "Q", self.term_count + 1)
+        self.idf = self._array(view, "idf", "d", self.term_count)
+        self.postings_docs = self._array(view, "postings_docs", "I", self.postings_count)
+        self.postings_freqs = self._array(view, "postings_freqs", "I", self.postings_count)
+
+    def __len__(self):
+        return self.doc_count
+
+    def __repr__(self):
+        return f"InvertedIndex(path={self.path}, documents={self.doc_count}, terms={self.term_count})"
+
+    def _array(self, view: memoryview, section: str, typecode: str, count: int) -> memoryview:
+        """Return a typed, zero-copy view of a section."""
+        start = self.sections[section]
+        return view[start:start + count * struct.calcsize(typecode)].cast(typecode)
+
+    def close(self):
+        """Release the memory map."""
+        for name in ("doc_lengths", "doc_name_offsets", "doc_mtimes", "doc_sizes", "term_offsets", "postings_offsets",
+                     "idf", "postings_docs", "postings_freqs"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self.mmap.close()
+
+    def is_stale(self) -> bool:
+        """Check whether the index file has been rewritten since it was opened."""
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return True
+
+    def doc_name(self, doc_id: int) -> str:
+        """Return the file name of a document."""
+        start = self.sections["doc_names"]
+        return self.mmap[start + self.doc_name_offsets[doc_id]:start + self.doc_name_offsets[doc_id + 1]].decode(
+            "utf-8")
+
+    def fingerprint(self, doc_id: int) -> tuple:
+        """Return the (mtime, size, content hash) a document had when it was indexed."""
+        start = self.sections["doc_hashes"] + doc_id * HASH_SIZE
+        return self.doc_mtimes[doc_id], self.doc_sizes[doc_id], self.mmap[start:start + HASH_SIZE].hex()
+
+    def content_hashes(self) -> list:
+        """Return the raw content hash of every document, in document id order."""
+        start = self.sections["doc_hashes"]
+        return [self.mmap[start + doc_id * HASH_SIZE:start + (doc_id + 1) * HASH_SIZE]
+                for doc_id in range(self.doc_count)]
+
+    def corpus_fingerprint(self) -> str:
+        """Hash the content hashes of all documents, independent of their order in the index."""
+        if self._corpus_fingerprint is None:
+            self._corpus_fingerprint = hashlib.sha256(b"".join(sorted(self.content_hashes()))).hexdigest()
+        return self._corpus_fingerprint
+
+    def document_ids(self) -> dict:
+        """Map every document name to its id."""
+        return {self.doc_name(doc_id): doc_id for doc_id in range(self.doc_count)}
+
+    def _term(self, term_id: int) -> bytes:
+        start = self.sections["terms"]
+        return self.mmap[start + self.term_offsets[term_id]:start + self.term_offsets[term_id + 1]]
+
+    def term(self, term_id: int) -> str:
+        return self._term(term_id).decode("utf-8")
+
+    def term_id(self, term: str):
+        """Binary search the sorted term table, touching only O(log n) terms."""
+        encoded = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.term_count and self._term(low) == encoded:
+            return low
+        return None
+
+    def postings(self, term_id: int):
+        """Return the document ids and term frequencies of a term."""
+        start, end = self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+        return self.postings_docs[start:end], self.postings_freqs[start:end]
+
+
+def shard_path(path: str, language: str) -> str:
+    """Return the path of the shard of an index that holds the documents of one language, like docs.english.index."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{language}{extension}"
+
+
+class ShardedIndex:
+    """The per-language shards of an index, memory-mapped and read together as one index.
+
+    Document ids run through the shards in the order of their languages: a document of the second shard has its id
+    in that shard plus the number of documents in the first one.
+    """
+
+    def __init__(self, path: str, languages: tuple):
+        self.path = path
+        self.shards = {}
+        self._corpus_fingerprint = None
+
+        try:
+            for language in languages:
+                self.shards[language] = InvertedIndex(shard_path(path, language))
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+        tokenizers = {shard.tokenizer for shard in self.shards.values()}
+        if len(tokenizers) > 1:
+            self.close()
+            raise ValueError(f"The shards of {path} were tokenized differently. Rebuild them.")
+        self.tokenizer = tokenizers.pop() if tokenizers else None
+
+        self.offsets = {}
+        self.starts = []
+        self.doc_count = 0
+        for language, shard in self.shards.items():
+            self.offsets[language] = self.doc_count
+            self.starts.append(self.doc_count)
+            self.doc_count += shard.doc_count
+        self.shard_list = list(self.shards.values())
+        self.term_count = sum(shard.term_count for shard in self.shard_list)
+
+    def __len__(self):
+        return self.doc_count
+
+    def __repr__(self):
+        shards = ", ".join(f"{language}={shard.doc_count}" for language, shard in self.shards.items())
+        return f"ShardedIndex(path={self.path}, documents={self.doc_count}, shards=({shards}))"
+
+    def close(self):
+        """Release the memory maps of all shards."""
+        for shard in self.shards.values():
+            shard.close()
+
+    def is_stale(self) -> bool:
+        return any(shard.is_stale() for shard in self.shards.values())
+
+    def locate(self, doc_id: int) -> tuple:
+        """Return the shard of a document and its id in that shard."""
+        # Empty shards share their start with the next one, so the last shard starting at or before doc_id holds it
+        position = bisect.bisect_right(self.starts, doc_id) - 1
+        return self.shard_list[position], doc_id - self.starts[position]
+
+    def doc_name(self, doc_id: int) -> str:
+        shard, shard_doc_id = self.locate(doc_id)
+        return shard.doc_name(shard_doc_id)
+
+    def fingerprint(self, doc_id: int) -> tuple:
+        shard, shard_doc_id = self.locate(doc_id)
+        return shard.fingerprint(shard_doc_id)
+
+    def corpus_fingerprint(self) -> str:
+        """Hash the content hashes of all documents, the same way a single index of them would."""
+        if self._corpus_fingerprint is None:
+            digests = sorted(digest for shard in self.shards.values() for digest in shard.content_hashes())
+            self._corpus_fingerprint = hashlib.sha256(b"".join(digests)).hexdigest()
+        return self._corpus_fingerprint
+
+    def document_ids(self) -> dict:
+        """Map every document name to its id across the shards."""
+        return {name: self.offsets[language] + doc_id
+                for language, shard in self.shards.items() for name, doc_id in shard.document_ids().items()}
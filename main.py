@@ -1,11 +1,16 @@
+# Imported first, so --profile-startup times every other import
+from startup import add_startup_arguments, report_startup
+
+import argparse
 import os
 import signal
 import sys
 
 from dotenv import load_dotenv
-from langchain.chat_models import ChatOpenAI
 from rich.console import Console
-from document_search import DocumentSearch, create_gpt_models
+from document_search import DocumentSearch, gpt_model_factory
+from retrieval import MISSING_ANN_INDEX, add_retrieval_arguments, ann_index_missing
+from server import QueryServer, add_server_arguments
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, lambda signal, frame: print("Program terminated gracefully.") or sys.exit(0))
@@ -18,10 +23,33 @@ if __name__ == "__main__":
         print("Error: OpenAI API key not found. Please set the environment variable 'OPENAI_API_KEY'.")
         sys.exit(1)
 
-    llm = create_gpt_models(openai_api_key)
+    server_parser = argparse.ArgumentParser(add_help=False)
+    add_server_arguments(server_parser)
+    add_retrieval_arguments(server_parser)
+    add_startup_arguments(server_parser)
+    server_args, _ = server_parser.parse_known_args()
+
+    if ann_index_missing(server_args.retrieval):
+        print(f"Error: {MISSING_ANN_INDEX}")
+        sys.exit(1)
+
+    # The model is created on the first question, so the prompt does not wait for langchain to import
+    llm_factory = gpt_model_factory(openai_api_key, parents=[server_parser])
     console = Console()
-    doc_search = DocumentSearch(llm, folder_path)
+    doc_search = DocumentSearch(None, folder_path, retrieval=server_args.retrieval, rrf_k=server_args.rrf_k,
+                                fusion_weights={"bm25": server_args.bm25_weight, "vector": server_args.vector_weight},
+                                llm_factory=llm_factory)
+
+    if server_args.serve:
+        # Load the index once, so the first request does not pay for it
+        doc_search.backend.load_index()
+        server = QueryServer(lambda request: {"answer": str(doc_search.search(request["question"]))},
+                             server_args.host, server_args.port, server_args.server_workers)
+        report_startup()
+        server.serve_forever()
+        sys.exit(0)
 
+    report_startup()
     while True:
         question = console.input("[bold green]Question:[/] [green]")
         if question == "exit":
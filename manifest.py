@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+def content_hash(text: str) -> str:
+    """Return the SHA-256 hex digest of a chunk's text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """Return the SHA-256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkManifest:
+    """Record the content hash, source document and word offset of every chunk in the chunk store."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks = {}
+        self.load()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, name: str):
+        return name in self.chunks
+
+    def load(self):
+        """Read the manifest from disk, starting empty if it does not exist."""
+        if not os.path.exists(self.path):
+            self.chunks = {}
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version in {self.path}.")
+        self.chunks = data["chunks"]
+
+    def save(self):
+        """Write the manifest atomically."""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"version": MANIFEST_VERSION, "chunks": self.chunks}, file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def get(self, name: str):
+        return self.chunks.get(name)
+
+    def add(self, name: str, digest: str, source: str, offset: int, words: int, pages: tuple = None,
+            byte_range: tuple = None):
+        """Record a chunk written from source, starting at the given word offset.
+
+        pages is the (first, last) page of the chunk and byte_range its (start, end) UTF-8 byte offsets in the
+        extracted text of the source, with the elements of the source separated by a blank line.
+        """
+        entry = {"hash": digest, "source": source, "offset": offset, "words": words}
+        if pages is not None and pages[0] is not None:
+            entry["pages"] = list(pages)
+        if byte_range is not None:
+            entry["bytes"] = list(byte_range)
+        self.chunks[name] = entry
+
+    def remove(self, name: str):
+        self.chunks.pop(name, None)
+
+    def chunks_for(self, source: str) -> list:
+        """Return the names of the chunks that were written from source."""
+        return [name for name, entry in self.chunks.items() if entry["source"] == source]
+
+    def sources(self) -> set:
+        return {entry["source"] for entry in self.chunks.values()}
+
+    def clear(self):
+        self.chunks = {}
@@ -1,86 +1,274 @@
+# Imported first, so --profile-startup times every other import
+from startup import add_startup_arguments, report_startup
+
 import argparse
+import glob
 import os
 import textwrap
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import TYPE_CHECKING, Iterable, Iterator
 
+from chunking import CHUNKERS, Chunk, Chunker, create_chunker
 from directory import remove_all_items
+from document_search_backend import ANN_INDEX_PATH, DocumentSearchBackend, INDEX_PATH, MANIFEST_PATH, SHARD_LANGUAGES
+from extraction import DEFAULT_ENGINE, ENGINES, PdfExtractor, compare_engines, extract_elements, \
+    print_engine_comparison
+from extraction_cache import ExtractionCache, loader_version
+from inverted_index import shard_path
+from manifest import ChunkManifest, content_hash, file_hash
+from preprocessing import TOKENIZERS
 from tqdm import tqdm
-from langchain.document_loaders import UnstructuredPDFLoader, UnstructuredWordDocumentLoader
-from langchain.schema import Document
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+
+# Number of changed chunks appended to the chunk store at once
+STORE_BATCH_SIZE = 256
+
+
+def chunk_name(source: str, offset: int) -> str:
+    # Derive the name from the source and word offset, so re-processing a document reuses the same chunks
+    return f"{uuid.uuid5(uuid.NAMESPACE_URL, f'{source}#{offset}')}.txt"
+
+
+def render_chunks(chunks: Iterable[Chunk], wrap: bool, source: str, known_hashes: dict,
+                  lowercase: bool = False) -> Iterator[tuple]:
+    """Yield (name, hash, chunk, text) for the chunks of a source document.
+
+    text is None for chunks whose hash is already known, so unchanged chunks are neither sent back from a worker
+    nor rewritten. The yielded chunks only hold the number of their words.
+    """
+    for chunk in chunks:
+        text_part = " ".join(chunk.words)
+
+        if wrap:
+            # Wrap the text into paragraphs with a width of 70 characters
+            text_part = textwrap.fill(text_part, width=70)
+        if lowercase:
+            text_part = text_part.lower()
+
+        name = chunk_name(source, chunk.offset)
+        digest = content_hash(text_part)
+        text = None if known_hashes.get(name) == digest else text_part
+
+        yield name, digest, chunk._replace(words=len(chunk.words)), text
 
 
 class Manipulator:
     def __init__(self, args: argparse.Namespace = None) -> None:
         self.folder_path = "docs"
         self.args = args
-        self.create_folder()
+        self.backend = DocumentSearchBackend(args.tokenizer, args.workers) if args else DocumentSearchBackend()
 
-    def create_folder(self):
-        try:
-            if not os.path.exists(self.folder_path):
-                os.makedirs(self.folder_path)
-                print("The 'docs' folder has been created successfully.")
-            else:
-                print("The 'docs' folder already exists.")
-        except OSError as e:
-            print(f"An error occurred while creating the 'docs' folder: {str(e)}")
+    def create_chunker(self) -> Chunker:
+        return create_chunker(self.args.chunking, self.args.max_word, self.args.overlap)
 
-    def read_and_split(self, documents: list[Document], max_words_per_file: int, wrap: bool = False):
-        remove_all_items(self.folder_path)
+    def store_chunks(self, rendered: Iterable[tuple]) -> list:
+        """Append the changed chunks to the chunk store and return the (name, hash, chunk) entries of all of them."""
+        chunk_store = self.backend.get_chunk_store()
+        entries = []
+        pending = []
 
-        # Combine all page contents from the documents into a single string
-        words = " ".join(document.page_content for document in documents).split()
+        for name, digest, chunk, text in rendered:
+            entries.append((name, digest, chunk))
+            if text is not None:
+                pending.append((name, text))
+            if len(pending) >= STORE_BATCH_SIZE:
+                chunk_store.put_many(pending)
+                pending = []
 
-        # Calculate the number of files needed to accommodate the words
-        num_files = (len(words) + max_words_per_file - 1) // max_words_per_file
+        chunk_store.put_many(pending)
+        return entries
 
-        # Iterate over the number of files to write the split text content
-        for i in tqdm(range(num_files), desc="Writing document"):
-            # Generate a unique file name using UUID
-            txt_file = os.path.join(self.folder_path, f"{uuid.uuid4()}.txt")
+    def read_and_split(self, documents: Iterable["Document"], chunker: Chunker, wrap: bool = False,
+                       source: str = None, update_index: bool = True, lowercase: bool = False) -> int:
+        manifest = ChunkManifest(MANIFEST_PATH)
+        source = os.path.abspath(source) if source else "unknown"
+        known_hashes = self.known_hashes(manifest, source)
 
-            with open(txt_file, "w", encoding="utf-8") as file:
-                # Determine the start and end indices of the words for the current file
-                start_index = i * max_words_per_file
-                end_index = min((i + 1) * max_words_per_file, len(words))
+        # Pages are consumed one at a time and chunks are appended to the store in small batches
+        chunks = tqdm(chunker.split(documents), desc="Writing document", unit="chunk")
+        entries = self.store_chunks(render_chunks(chunks, wrap, source, known_hashes, lowercase))
 
-                # Extract the relevant words for the current file
-                text_part = " ".join(words[start_index:end_index])
+        self.record_chunks(manifest, source, entries)
+        manifest.save()
+        if update_index:
+            self.update_index()
 
-                if wrap:
-                    # Wrap the text into paragraphs with a width of 70 characters
-                    wrapped_text = textwrap.fill(text_part, width=70)
-                    file.write(wrapped_text.lower())
-                else:
-                    # Write the text without wrapping
-                    file.write(text_part.lower())
+        return len(entries)
+
+    def known_hashes(self, manifest: ChunkManifest, source: str) -> dict:
+        """Return the hashes of the chunks of a source that are still in the chunk store."""
+        chunk_store = self.backend.get_chunk_store()
+        return {name: manifest.get(name)["hash"] for name in manifest.chunks_for(source) if name in chunk_store}
+
+    def record_chunks(self, manifest: ChunkManifest, source: str, entries: list):
+        # Chunks previously written from this source that were not written again are stale
+        stale_chunks = set(manifest.chunks_for(source))
+
+        for name, digest, chunk in entries:
+            stale_chunks.discard(name)
+            manifest.add(name, digest, source, chunk.offset, chunk.words, (chunk.page_start, chunk.page_end),
+                         (chunk.byte_start, chunk.byte_end))
+
+        self.backend.get_chunk_store().delete_many(list(stale_chunks))
+        for name in stale_chunks:
+            manifest.remove(name)
+
+    def update_index(self):
+        print("Updating the search index...")
+        update = self.backend.update_index()
+        shards = ", ".join(f"'{shard_path(INDEX_PATH, language)}'" for language in SHARD_LANGUAGES)
+        print(f"The search index has been saved to {shards} ({len(update.added)} added, "
+              f"{len(update.modified)} modified, {len(update.removed)} removed).")
+
+        # Replaced and removed chunks are reclaimed once they take more space than the live ones
+        chunk_store = self.backend.get_chunk_store()
+        if chunk_store.dead_bytes() > chunk_store.live_bytes:
+            print(f"Compacting the chunk store, {chunk_store.compact()} bytes reclaimed.")
+
+    def embed_chunks(self, batch_size: int = 100):
+        from embedding_store import EmbeddingStore, OpenAIEmbeddingBackend
+        from retrieval import HybridRetriever
+
+        manifest = ChunkManifest(MANIFEST_PATH)
+        store = EmbeddingStore(OpenAIEmbeddingBackend())
+
+        # Only chunks whose content hash has no stored vector are sent to the embedding backend
+        names = {entry["hash"]: name for name, entry in manifest.chunks.items()}
+        missing = store.missing(list(names))
+        print(f"Embedding {len(missing)} new chunk(s), {len(names) - len(missing)} already stored.")
+
+        for start in tqdm(range(0, len(missing), batch_size), desc="Embedding chunks"):
+            digests = missing[start:start + batch_size]
+            store.embed(list(zip(digests, self.backend.read_chunks([names[digest] for digest in digests]))))
+
+        # Build the vector index now, so the first hybrid search does not have to
+        HybridRetriever(self.backend, store).build_ann_index()
+        print(f"The vector index has been saved to '{ANN_INDEX_PATH}'.")
+
+    def remove_index(self):
+        shards = [shard_path(INDEX_PATH, language) for language in SHARD_LANGUAGES]
+        for path in (INDEX_PATH, *shards, MANIFEST_PATH, ANN_INDEX_PATH):
+            if os.path.exists(path):
+                os.remove(path)
 
     def process_pdf(self, file_path: str):
-        pdf_reader = UnstructuredPDFLoader(file_path)
-        documents = pdf_reader.load_and_split()
-        self.read_and_split(documents, self.args.max_word, self.args.wrap)
+        documents = load_documents(file_path, not self.args.no_extraction_cache, self.args.engine, self.args.workers)
+        self.read_and_split(documents, self.create_chunker(), self.args.wrap, source=file_path,
+                            lowercase=self.args.lowercase)
 
     def process_word(self, file_path: str):
-        word_reader = UnstructuredWordDocumentLoader(file_path)
-        documents = word_reader.load_and_split()
-        self.read_and_split(documents, self.args.max_word, self.args.wrap)
+        self.read_and_split(load_documents(file_path, not self.args.no_extraction_cache), self.create_chunker(),
+                            self.args.wrap, source=file_path, lowercase=self.args.lowercase)
+
+    def show_extraction_cache(self):
+        cache = ExtractionCache()
+        entries = cache.entries()
+        print(f"Extraction cache '{cache.path}': {len(entries)} document(s), "
+              f"{cache.total_bytes() / (1 << 20):.1f} of {cache.max_bytes / (1 << 20):.0f} MiB used.")
+        for source, digest, loader, size, created, last_used in entries:
+            print(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))}  {size / 1024:>9.1f} KiB  "
+                  f"{digest[:12]}  {loader}  {source}")
+        cache.close()
+
+    def purge_extraction_cache(self):
+        cache = ExtractionCache()
+        print(f"Removed {cache.clear()} document(s) from the extraction cache.")
+        cache.close()
+
+    def process_batch(self, patterns: list, workers: int = None):
+        file_paths = collect_files(patterns)
+        if not file_paths:
+            print("No PDF or Word documents matched the given paths.")
+            return
+
+        print(f"Processing {len(file_paths)} document(s) with up to {workers or os.cpu_count()} worker(s)...")
+        manifest = ChunkManifest(MANIFEST_PATH)
+        failures = []
+        batch_start = time.perf_counter()
+        chunker = self.create_chunker()
+
+        # Workers parse and chunk the documents; the chunk store and manifest are only written here, in the parent
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for file_path in file_paths:
+                known_hashes = self.known_hashes(manifest, os.path.abspath(file_path))
+                future = executor.submit(extract_file, file_path, chunker, self.args.wrap, known_hashes,
+                                         self.args.lowercase, not self.args.no_extraction_cache, self.args.engine)
+                futures[future] = file_path
+
+            with tqdm(total=len(futures), desc="Processing documents", unit="file") as progress_bar:
+                for future in as_completed(futures):
+                    file_path = futures[future]
+                    try:
+                        rendered, elapsed = future.result()
+                        entries = self.store_chunks(rendered)
+                        self.record_chunks(manifest, os.path.abspath(file_path), entries)
+                        tqdm.write(f"OK      {file_path} ({len(entries)} chunks, {elapsed:.2f}s)")
+                    except Exception as e:
+                        failures.append((file_path, e))
+                        tqdm.write(f"FAILED  {file_path}: {type(e).__name__}: {str(e)}")
+                    progress_bar.update(1)
+
+        manifest.save()
+        self.update_index()
+
+        print(f"Processed {len(file_paths) - len(failures)} of {len(file_paths)} document(s) in "
+              f"{time.perf_counter() - batch_start:.2f}s.")
+        if failures:
+            print(f"{len(failures)} document(s) failed:")
+            for file_path, error in failures:
+                print(f"  {file_path}: {str(error)}")
 
     def run(self):
-        if not 100 <= self.args.max_word <= 700:
-            print("Maximum word limit should be between 100 and 700 (inclusive).")
+        if self.args.max_word < 20:
+            print("Maximum word limit should be at least 20.")
+            exit(0)
+        if not 0 <= self.args.overlap < self.args.max_word:
+            print("Overlap should be at least 0 and smaller than the maximum word limit.")
             exit(0)
 
         if self.args.pdf and self.args.word:
             print("Error: Cannot use both --pdf and --word arguments simultaneously.")
+        elif self.args.compare_engines:
+            if not self.args.pdf:
+                print("Error: --compare-engines needs a PDF file given with --pdf.")
+            else:
+                print_engine_comparison(compare_engines(self.args.pdf, self.args.workers))
+        elif self.args.batch:
+            self.process_batch(self.args.batch, self.args.workers)
         elif self.args.pdf:
             self.process_file(self.args.pdf, "PDF")
         elif self.args.word:
             self.process_file(self.args.word, "Word")
         elif self.args.clean:
-            remove_all_items(self.folder_path)
-        else:
+            if os.path.isdir(self.folder_path):
+                remove_all_items(self.folder_path)
+            self.backend.get_chunk_store().clear()
+            self.remove_index()
+        elif self.args.export_txt:
+            exported = self.backend.get_chunk_store().export(self.args.export_txt)
+            print(f"Exported {exported} chunk(s) to '{self.args.export_txt}'.")
+        elif self.args.cache_info:
+            self.show_extraction_cache()
+        elif self.args.purge_cache:
+            self.purge_extraction_cache()
+        elif self.args.compact:
+            print(f"Compacted the chunk store, {self.backend.get_chunk_store().compact()} bytes reclaimed.")
+        elif self.args.tokenizer:
+            # Only switching the tokenizer, which re-tokenizes the whole corpus
+            self.update_index()
+        elif not self.args.embed:
             print("No valid input provided.")
 
+        if self.args.embed and not self.args.clean:
+            self.embed_chunks()
+
     def process_file(self, file_location, file_type):
         if not file_location:
             print(f"Error: Please provide the location of the {file_type} file using the --{file_type.lower()}-location argument.")
@@ -107,6 +295,67 @@ def check_file_type(file_path):
         return "Word"
 
 
+def collect_files(patterns: list) -> list:
+    """Expand directories (recursively) and glob patterns into a sorted list of PDF and Word documents."""
+    supported_extensions = {".pdf", ".docx", ".doc"}
+    file_paths = set()
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, file_names in os.walk(pattern):
+                file_paths.update(os.path.join(root, file_name) for file_name in file_names)
+        else:
+            file_paths.update(glob.glob(pattern, recursive=True))
+
+    return sorted(path for path in file_paths
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in supported_extensions)
+
+
+def load_documents(file_path: str, use_cache: bool = True, engine: str = DEFAULT_ENGINE,
+                   workers: int = None) -> Iterator["Document"]:
+    """Yield the elements of a PDF or Word document one at a time, from the extraction cache when it has them."""
+    # Langchain's Document is what the chunkers and the rest of the pipeline expect
+    from langchain.schema import Document
+
+    if check_file_type(file_path) == "PDF":
+        extract, loader = PdfExtractor(engine, workers).extract, loader_version(engine)
+    else:
+        # Word documents have no text layer to read, so they always go through unstructured
+        extract, loader = partial(extract_elements, file_type="Word"), loader_version("unstructured")
+
+    if not use_cache:
+        for text, page_number in extract(file_path):
+            yield Document(page_content=text, metadata={"page_number": page_number})
+        return
+
+    cache = ExtractionCache()
+    elements = None
+    try:
+        # Keyed by content, so only --max-word, --chunking or --wrap changing never re-parses the document
+        digest = file_hash(file_path)
+        elements = cache.get(digest, loader)
+        if elements is None:
+            # Stored page by page while the chunks are cut, and only kept once the extraction completes
+            elements = cache.store(digest, loader, os.path.abspath(file_path), extract(file_path))
+
+        for text, page_number in elements:
+            yield Document(page_content=text, metadata={"page_number": page_number})
+    finally:
+        if elements is not None:
+            # A partly consumed extraction drops its stored blocks before the connection closes
+            elements.close()
+        cache.close()
+
+
+def extract_file(file_path: str, chunker: Chunker, wrap: bool, known_hashes: dict, lowercase: bool = False,
+                 use_cache: bool = True, engine: str = DEFAULT_ENGINE):
+    """Chunk a document in a worker process and return its rendered chunks and the time taken."""
+    start = time.perf_counter()
+    # Documents are already extracted in parallel, so the pages of each one are not
+    chunks = chunker.split(load_documents(file_path, use_cache, engine, workers=1))
+    rendered = list(render_chunks(chunks, wrap, os.path.abspath(file_path), known_hashes, lowercase))
+    return rendered, time.perf_counter() - start
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -114,11 +363,31 @@ def parse_arguments():
     file_group = parser.add_argument_group("File options")
     file_group.add_argument("--pdf", type=str, help="Path of the PDF file to be read")
     file_group.add_argument("--word", type=str, help="Path of the Word file to be read")
-    file_group.add_argument("--max-word", type=int, default=400, help="Maximum word limit per file (default: 400, min:100, max: 700)")
+    file_group.add_argument("--batch", type=str, nargs="+", metavar="PATH",
+                            help="Directories or glob patterns of PDF/Word files to add to the existing documents")
+    file_group.add_argument("--max-word", type=int, default=400, help="Maximum word limit per file (default: 400, min: 20)")
 
     process_group = parser.add_argument_group("Processing options")
-    process_group.add_argument("--clean", action="store_true", help="Remove the 'docs' folder before processing the file")
+    process_group.add_argument("--clean", action="store_true", help="Remove all chunks, the search indexes and the 'docs' folder")
+    process_group.add_argument("--export-txt", type=str, metavar="FOLDER", help="Write every chunk of the chunk store to a .txt file in FOLDER")
+    process_group.add_argument("--compact", action="store_true", help="Rewrite the chunk store without replaced and removed chunks")
     process_group.add_argument("--wrap", action="store_true", help="Wrap the text into paragraphs with a width of 70 characters")
+    process_group.add_argument("--chunking", choices=CHUNKERS.keys(), default="fixed", help="How documents are split: 'fixed' every --max-word words, 'sentence' packs whole sentences, 'page' packs sentences without crossing pages, 'window' overlapping windows (default: fixed)")
+    process_group.add_argument("--overlap", type=int, default=0, help="Words shared by consecutive chunks with --chunking window (default: 0)")
+    process_group.add_argument("--lowercase", action="store_true", help="Lowercase the chunk text (search is case-insensitive either way)")
+    process_group.add_argument("--embed", action="store_true", help="Precompute embeddings of new chunks for the vector index")
+    process_group.add_argument("--workers", type=int, default=None, help="Number of worker processes for --batch and for tokenizing chunks into the index (default: number of CPUs)")
+    process_group.add_argument("--tokenizer", choices=TOKENIZERS.keys(), default=None, help="Tokenizer of the search index: 'nltk' word_tokenize or the faster 'regex' equivalent; changing it rebuilds the index (default: keep the index's, nltk for a new one)")
+    add_startup_arguments(process_group)
+
+    extraction_group = parser.add_argument_group("Extraction options")
+    extraction_group.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE, help="PDF extraction engine: 'pypdf' reads the text layer, 'unstructured' parses the layout, 'auto' reads the text layer and uses unstructured only for pages without text (default: auto)")
+    extraction_group.add_argument("--compare-engines", action="store_true", help="Extract the --pdf file with every engine and report characters per second, without writing chunks")
+
+    cache_group = parser.add_argument_group("Extraction cache options")
+    cache_group.add_argument("--no-extraction-cache", action="store_true", help="Extract the documents again instead of reading their text from the extraction cache")
+    cache_group.add_argument("--cache-info", action="store_true", help="List the documents in the extraction cache and its size")
+    cache_group.add_argument("--purge-cache", action="store_true", help="Remove every document from the extraction cache")
 
     return parser.parse_args()
 
@@ -126,4 +395,5 @@ def parse_arguments():
 if __name__ == "__main__":
     args = parse_arguments()
     manipulator = Manipulator(args)
+    report_startup()
     manipulator.run()
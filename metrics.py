@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+
+# Prefix of every exported metric name
+NAMESPACE = "mypdf"
+
+# Number of most recent observations a histogram keeps to compute its percentiles
+SAMPLE_SIZE = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+load_dotenv()
+METRICS_LOG_PATH = os.getenv("METRICS_LOG")
+
+_current_span = ContextVar("current_span", default=None)
+
+
+def percentile(sorted_values: list, quantile: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(quantile * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class Histogram:
+    """The count and sum of all observations, with percentiles over the most recent ones."""
+
+    def __init__(self, sample_size: int = SAMPLE_SIZE) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantiles(self) -> dict:
+        values = sorted(self.samples)
+        return {quantile: percentile(values, quantile) for quantile in QUANTILES}
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """Counters, latency histograms and cache hit rates of one process, exported as Prometheus text or JSON lines.
+
+    Spans time a stage of the search and record it in the stage_seconds histogram. When a log path is set, every
+    finished span is also appended to it as a JSON line together with its parent span and attributes.
+    """
+
+    def __init__(self, log_path: str = None) -> None:
+        self.log_path = log_path
+        self.counters = {}
+        self.histograms = {}
+        self.caches = {}
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def register_cache(self, name: str, cache) -> None:
+        """Export the hits and misses of a cache; caches registered under the same name are added up."""
+        with self.lock:
+            # Held weakly, so the metrics never keep a closed cache alive
+            self.caches.setdefault(name, weakref.WeakSet()).add(cache)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time a stage of the search; the yielded dict collects attributes such as document counts."""
+        parent = _current_span.get()
+        token = _current_span.set(name)
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _current_span.reset(token)
+            self.observe("stage_seconds", duration, stage=name)
+            if error is not None:
+                self.increment("stage_errors_total", stage=name, error=error)
+            if self.log_path:
+                self.log_span(dict(span=name, parent=parent, start=started, duration=duration, error=error,
+                                   **attributes))
+
+    def log_span(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.log_lock, open(self.log_path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+    def cache_stats(self) -> dict:
+        with self.lock:
+            caches = {name: list(members) for name, members in self.caches.items()}
+
+        stats = {}
+        for name, members in caches.items():
+            hits = sum(cache.hits for cache in members)
+            misses = sum(cache.misses for cache in members)
+            stats[name] = {"hits": hits, "misses": misses,
+                           "hit_ratio": hits / (hits + misses) if hits + misses else 0.0}
+        return stats
+
+    def snapshot(self) -> list:
+        """Return every metric as a list of records, one per metric and label set."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.count, histogram.total, histogram.quantiles())
+                                for key, histogram in self.histograms.items())
+
+        records = [{"metric": name, "type": "counter", "labels": dict(labels), "value": value}
+                   for (name, labels), value in counters]
+        for (name, labels), count, total, quantiles in histograms:
+            percentiles = {f"p{round(quantile * 100)}": value for quantile, value in quantiles.items()}
+            records.append({"metric": name, "type": "histogram", "labels": dict(labels), "count": count,
+                            "sum": total, **percentiles})
+        for cache, stats in sorted(self.cache_stats().items()):
+            records.append({"metric": "cache", "type": "cache", "labels": {"cache": cache}, **stats})
+        return records
+
+    def to_json_lines(self) -> str:
+        timestamp = time.time()
+        return "".join(json.dumps(dict(record, time=timestamp), ensure_ascii=False) + "\n"
+                       for record in self.snapshot())
+
+    def to_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format; histograms become summaries."""
+        lines = []
+        typed = set()
+
+        def declare(name: str, metric_type: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        records = self.snapshot()
+        for record in records:
+            labels = _label_key(record["labels"])
+            if record["type"] == "counter":
+                name = f"{NAMESPACE}_{record['metric']}"
+                declare(name, "counter")
+                lines.append(f"{name}{_format_labels(labels)} {record['value']}")
+            elif record["type"] == "histogram":
+                name = f"{NAMESPACE}_{record['metric']}"
+                declare(name, "summary")
+                for quantile in QUANTILES:
+                    value = record[f"p{round(quantile * 100)}"]
+                    lines.append(f"{name}{_format_labels(labels, (('quantile', str(quantile)),))} {value}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {record['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {record['count']}")
+
+        # The lines of one metric must not be split by other metrics, so the caches are written field by field
+        caches = [record for record in records if record["type"] == "cache"]
+        for field, metric_type in (("hits", "counter"), ("misses", "counter"), ("hit_ratio", "gauge")):
+            name = f"{NAMESPACE}_cache_{field}" + ("_total" if metric_type == "counter" else "")
+            for record in caches:
+                declare(name, metric_type)
+                lines.append(f"{name}{_format_labels(_label_key(record['labels']))} {record[field]}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# Shared by every module of the process
+metrics = Metrics(METRICS_LOG_PATH)
+
+
+def summarize_log(path: str) -> dict:
+    """Group the spans of a JSON lines log by stage and return the count and percentiles of each."""
+    durations = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                durations.setdefault(record["span"], []).append(record["duration"])
+
+    summary = {}
+    for stage, values in durations.items():
+        values.sort()
+        summary[stage] = {"count": len(values), "total": sum(values),
+                          **{f"p{round(quantile * 100)}": percentile(values, quantile) for quantile in QUANTILES}}
+    return summary
+
+
+def print_summary(path: str):
+    try:
+        summary = summarize_log(path)
+    except FileNotFoundError:
+        print(f"Error: Span log '{path}' not found. Set METRICS_LOG in .env to record one.")
+        return
+
+    print(f"{'stage':<24} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'total':>9}")
+    for stage, stats in sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True):
+        print(f"{stage:<24} {stats['count']:>7} {stats['p50']:>8.3f}s {stats['p95']:>8.3f}s "
+              f"{stats['p99']:>8.3f}s {stats['total']:>8.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the per-stage latencies of a span log")
+    parser.add_argument("log", nargs="?", default=METRICS_LOG_PATH, help="Span log written with METRICS_LOG (default: METRICS_LOG from .env)")
+    args = parser.parse_args()
+
+    if not args.log:
+        print("Error: No span log given. Pass its path or set METRICS_LOG in .env.")
+    else:
+        print_summary(args.log)
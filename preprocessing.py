@@ -0,0 +1,307 @@
+import argparse
+import itertools
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+from text import LANGUAGE_DICT, BatchText, Text, ensure_nltk_data, get_stopwords
+
+# Number of chunks detected and tokenized together by one worker
+PREPROCESS_BATCH_SIZE = 256
+
+DEFAULT_TOKENIZER = "nltk"
+
+# Characters nltk.word_tokenize always splits off as tokens of their own
+SPLIT_CHARACTERS = r"?!;@#$%&*()\[\]{}<>«“‘„»”’"
+
+# Words keep single hyphens, apostrophes and periods inside them, and commas or colons followed by a digit
+WORD = rf"""(?:[^\s{SPLIT_CHARACTERS}"`,:.'\-]|'(?!')|-(?!-)|[,:](?=\d)|\.(?!\.))+"""
+
+TOKEN_PATTERN = re.compile(rf"""
+    (?P<ellipsis>\.{{2,}})
+  | (?P<dashes>--)
+  | (?P<backticks>`+)
+  | (?P<quote>"|'')
+  | (?P<split>[{SPLIT_CHARACTERS}])
+    # A separator is split off together with the character after it, so a second comma or colon stays glued to
+    # the word that follows
+  | (?P<separator>[,:](?!\d))(?P<glued>[,:](?:{WORD})?)?
+  | (?P<word>{WORD})
+""", re.VERBOSE)
+
+# Sentences without quotes, contractions or doubled separators only need the final period split off their tokens
+PLAIN_TOKEN_PATTERN = re.compile(rf"""\.{{2,}}|--|[{SPLIT_CHARACTERS}]|[,:](?!\d)|{WORD}""")
+PLAIN_SENTENCE_PATTERN = re.compile(r"""(?i)['"`]|[,:][,:]|cannot|gimme|gonna|gotta|lemme|wanna""")
+FINAL_PERIOD_PATTERN = re.compile(r"""[^.]\.[\]\)}>'"»”’ ]*+\s*$""")
+CLOSING_TOKENS = frozenset("])}>»”’")
+
+# Characters after which a double quote opens a quotation, including the ones nltk pads with spaces first
+OPENING_CONTEXT = set(" ([{<«“‘„`")
+
+# What may follow the period nltk splits off the end of a sentence
+SENTENCE_END_PATTERN = re.compile(r"""[\]\)}>"'»”’ ]*+\s*$""")
+
+# Characters nltk only pads with spaces after it has split off trailing quotes
+LATE_PADDED_CHARACTERS = set("*()[]{}<>-»”’\"'")
+
+# Words nltk may still split after punctuation: clitics, quotes and contractions such as "cannot" or "'tis"
+CONTRACTION_HINT = re.compile(r"(?i)'|cannot|gimme|gonna|gotta|lemme|wanna")
+
+# The substitutions nltk applies to those words, in nltk's order. Some only match next to a space, which is why
+# every word keeps the whitespace around it
+WORD_SUBSTITUTIONS = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r"(?i)(\')(?!re|ve|ll|m|t|s|d|n)(\w)\b", r"\1 \2"),
+    (r"([^'])' ", r"\1 ' "),
+    (r"([^' ])('[sS]|'[mM]|'[dD]|') ", r"\1 \2 "),
+    (r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ", r"\1 \2 "),
+    (r"(?i)\b(can)(not)\b", r" \1 \2 "),
+    (r"(?i)\b(d)('ye)\b", r" \1 \2 "),
+    (r"(?i)\b(gim)(me)\b", r" \1 \2 "),
+    (r"(?i)\b(gon)(na)\b", r" \1 \2 "),
+    (r"(?i)\b(got)(ta)\b", r" \1 \2 "),
+    (r"(?i)\b(lem)(me)\b", r" \1 \2 "),
+    (r"(?i)\b(more)('n)\b", r" \1 \2 "),
+    (r"(?i)\b(wan)(na)(?=\s)", r" \1 \2 "),
+    (r"(?i) ('t)(is)\b", r" \1 \2 "),
+    (r"(?i) ('t)(was)\b", r" \1 \2 "),
+)]
+
+
+def nltk_tokenize(text: str) -> list:
+    # nltk takes about a second to import, so it is only loaded once the first text is tokenized
+    ensure_nltk_data("punkt")
+    from nltk import word_tokenize
+
+    return word_tokenize(text)
+
+
+def _ends_sentence(sentence: str, position: int) -> bool:
+    # Only closing quotes, brackets and spaces may follow the final period of a sentence, then trailing whitespace
+    match = SENTENCE_END_PATTERN.match(sentence, position)
+    if match is None:
+        return False
+
+    for index in range(position, match.end()):
+        # A quote after a space opens a quotation and is no closing character
+        if (sentence[index] == '"' or sentence.startswith("''", index)) and sentence[index - 1] in OPENING_CONTEXT:
+            return False
+    return True
+
+
+def _padding(sentence: str, index: int) -> str:
+    # nltk pads every punctuation token with spaces, so only other whitespace next to a word survives
+    if index < 0 or index >= len(sentence) or not sentence[index].isspace():
+        return " "
+    return sentence[index]
+
+
+def _split_word(word: str, sentence: str, start: int, end: int, tokens: list):
+    if not CONTRACTION_HINT.search(word):
+        tokens.append(word)
+        return
+
+    following = sentence[end] if end < len(sentence) and sentence[end] in LATE_PADDED_CHARACTERS else None
+    # nltk only pads the end of a sentence with a space after the first two substitutions
+    last = end >= len(sentence)
+    text = _padding(sentence, start - 1) + word + (following or ("" if last else _padding(sentence, end)))
+    for position, (pattern, replacement) in enumerate(WORD_SUBSTITUTIONS):
+        if position == 2 and following:
+            # Brackets and closing quotes are only padded once trailing quotes have been split off
+            text = text[:-1] + " "
+        elif position == 2 and last:
+            text += " "
+        text = pattern.sub(replacement, text)
+    tokens.extend(text.split())
+
+
+def _emit_word(word: str, sentence: str, start: int, end: int, tokens: list):
+    # The period ending a sentence is split off, periods inside it stay part of their words
+    stripped = word.rstrip("'")
+    if stripped.endswith(".") and len(stripped) > 1 and _ends_sentence(sentence, end):
+        _split_word(stripped[:-1], sentence, start, start + len(stripped) - 1, tokens)
+        tokens.append(".")
+        tokens.extend(word[len(stripped):])
+    else:
+        _split_word(word, sentence, start, end, tokens)
+
+
+def _tokenize_plain_sentence(sentence: str) -> list:
+    tokens = PLAIN_TOKEN_PATTERN.findall(sentence)
+    if tokens and FINAL_PERIOD_PATTERN.search(sentence):
+        index = len(tokens) - 1
+        while tokens[index] in CLOSING_TOKENS:
+            index -= 1
+        word = tokens[index]
+        if len(word) > 1 and word.endswith("."):
+            tokens[index:index + 1] = [word[:-1], "."]
+    return tokens
+
+
+def _tokenize_sentence(sentence: str, tokens: list):
+    # Most sentences have no apostrophe or contraction, so their words only need checking for a final period
+    careful = CONTRACTION_HINT.search(sentence) is not None
+    start_quote_end = -1
+    for match in TOKEN_PATTERN.finditer(sentence):
+        kind = match.lastgroup
+        if kind == "word":
+            token = match.group()
+            if careful or token[-1] == ".":
+                _emit_word(token, sentence, match.start(), match.end(), tokens)
+            else:
+                tokens.append(token)
+        elif kind == "glued":
+            tokens.append(match.group("separator"))
+            _emit_word(match.group("glued"), sentence, match.start("glued"), match.end(), tokens)
+        elif kind == "quote":
+            # A quote opens a quotation at the start of a sentence, right after the one opening it, or after a
+            # space, an opening bracket or an opening quote
+            start = match.start()
+            if start == 0 and match.group() == '"':
+                start_quote_end = match.end()
+                tokens.append("``")
+            elif start == start_quote_end or (start > 0 and sentence[start - 1] in OPENING_CONTEXT):
+                tokens.append("``")
+            else:
+                tokens.append("''")
+        elif kind == "backticks":
+            # Backticks pair up into opening quotes
+            token = match.group()
+            tokens.extend(["``"] * (len(token) // 2) + ["`"] * (len(token) % 2))
+        else:
+            tokens.append(match.group())
+
+
+def regex_tokenize(text: str) -> list:
+    """Tokenize like nltk.word_tokenize, replacing its chain of Treebank substitutions by one regular expression pass.
+
+    Sentences are still split with Punkt, since nltk only splits off the period that ends a sentence.
+    """
+    ensure_nltk_data("punkt")
+    from nltk import sent_tokenize
+
+    tokens = []
+    for sentence in sent_tokenize(text):
+        if PLAIN_SENTENCE_PATTERN.search(sentence) is None:
+            tokens.extend(_tokenize_plain_sentence(sentence))
+        else:
+            _tokenize_sentence(sentence, tokens)
+    return tokens
+
+
+TOKENIZERS = {"nltk": nltk_tokenize, "regex": regex_tokenize}
+
+
+def get_tokenizer(name: str):
+    if name not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer '{name}'. Choose one of: {', '.join(TOKENIZERS)}.")
+    return TOKENIZERS[name]
+
+
+def tokenize_without_stopwords(text: str, language: str, tokenizer: str = DEFAULT_TOKENIZER) -> list:
+    """Tokenize a lowercased text and drop the stopwords of its language."""
+    language_stopwords = get_stopwords(language)
+    return [word for word in get_tokenizer(tokenizer)(text.lower()) if word not in language_stopwords]
+
+
+def preprocess_batch(texts: list, tokenizer: str = DEFAULT_TOKENIZER) -> list:
+    """Tag the language of a batch of texts and tokenize them, returning (language, tokens) pairs."""
+    detected_languages = Text().detect_languages(BatchText(texts), sanitize=True)
+    languages = [LANGUAGE_DICT.get(language) for language in detected_languages]
+    return [(language, tokenize_without_stopwords(text, language, tokenizer))
+            for text, language in zip(texts, languages)]
+
+
+class Preprocessor:
+    """Tag and tokenize texts in batches across a process pool, yielding results in input order."""
+
+    def __init__(self, tokenizer: str = DEFAULT_TOKENIZER, workers: int = None,
+                 batch_size: int = PREPROCESS_BATCH_SIZE) -> None:
+        get_tokenizer(tokenizer)
+        self.tokenizer = tokenizer
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+
+    def batches(self, texts: Iterable[str]) -> Iterator[list]:
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, texts: Iterable[str]) -> Iterator[tuple]:
+        """Yield one (language, tokens) pair per text, in the order of the texts.
+
+        Texts are read lazily, and at most two batches per worker are in flight, so the corpus never has to be
+        in memory at once.
+        """
+        batches = self.batches(texts)
+        first = next(batches, None)
+        if first is None:
+            return
+        second = next(batches, None)
+
+        # A pool is not worth starting for a single batch, as when a few chunks changed
+        if self.workers == 1 or second is None:
+            for batch in itertools.chain([first], [second] if second else [], batches):
+                yield from preprocess_batch(batch, self.tokenizer)
+            return
+
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for batch in itertools.chain([first, second], batches):
+                pending.append(executor.submit(preprocess_batch, batch, self.tokenizer))
+                # Results are taken in submission order, whichever worker finishes first
+                while len(pending) >= self.workers * 2:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
+
+
+def verify_tokenizer(texts: list, tokenizer: str = "regex", reference: str = DEFAULT_TOKENIZER) -> list:
+    """Return (position, reference tokens, tokens) for every text the two tokenizers split differently."""
+    reference_tokenize, tokenize = get_tokenizer(reference), get_tokenizer(tokenizer)
+    mismatches = []
+    for position, text in enumerate(texts):
+        expected, actual = reference_tokenize(text.lower()), tokenize(text.lower())
+        if expected != actual:
+            mismatches.append((position, expected, actual))
+    return mismatches
+
+
+def run_verification():
+    from document_search_backend import DocumentSearchBackend
+
+    parser = argparse.ArgumentParser(description="Check that a tokenizer splits the chunks exactly like nltk")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS.keys(), default="regex", help="Tokenizer to verify (default: regex)")
+    parser.add_argument("--show", type=int, default=5, help="Number of differing chunks to print (default: 5)")
+    args = parser.parse_args()
+
+    backend = DocumentSearchBackend()
+    names = backend.get_text_files()
+    texts = backend.read_chunks(names)
+
+    timings = {}
+    for name in (DEFAULT_TOKENIZER, args.tokenizer):
+        start = time.perf_counter()
+        for text in texts:
+            get_tokenizer(name)(text.lower())
+        timings[name] = time.perf_counter() - start
+
+    mismatches = verify_tokenizer(texts, args.tokenizer)
+    print(f"{len(texts) - len(mismatches)} of {len(texts)} chunk(s) tokenize identically.")
+    print(", ".join(f"{name}: {elapsed:.2f}s" for name, elapsed in timings.items()))
+
+    for position, expected, actual in mismatches[:args.show]:
+        differences = [(e, a) for e, a in zip(expected, actual) if e != a][:5]
+        print(f"  {names[position]}: {differences or 'different token count'}")
+
+
+if __name__ == "__main__":
+    run_verification()
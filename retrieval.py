@@ -0,0 +1,181 @@
+import os
+import threading
+
+import numpy as np
+from tqdm import tqdm
+
+from ann_index import RETRAIN_GROWTH, AnnIndex, list_count_for, write_ann_index
+from document_search_backend import ANN_INDEX_PATH, CHUNK_STORE_PATH, DocumentSearchBackend
+from embedding_store import EmbeddingStore
+
+# Constant of reciprocal rank fusion, 60 as in the original paper
+RRF_K = 60
+
+# Each source retrieves this many times the requested number of documents before fusion
+CANDIDATE_FACTOR = 10
+
+RETRIEVAL_MODES = ("bm25", "vector", "hybrid")
+
+MISSING_ANN_INDEX = ("The vector index has not been built. Run 'python manipulator.py --embed' first, "
+                     "or search with --retrieval bm25.")
+
+
+def ann_index_missing(mode: str, path: str = ANN_INDEX_PATH) -> bool:
+    """Return whether a retrieval mode needs the vector index and it has not been built."""
+    return mode != "bm25" and not os.path.exists(path)
+
+
+def reciprocal_rank_fusion(rankings: dict, weights: dict = None, k: int = RRF_K) -> dict:
+    """Fuse ranked lists of names into one score per name: the weighted sum of 1 / (k + rank)."""
+    weights = weights or {}
+    fused = {}
+    for source, names in rankings.items():
+        weight = weights.get(source, 1.0)
+        for rank, name in enumerate(names, start=1):
+            fused[name] = fused.get(name, 0.0) + weight / (k + rank)
+    return fused
+
+
+class HybridRetriever:
+    """Retrieve chunks from the whole corpus with BM25 and approximate nearest-neighbour search, fused with RRF.
+
+    The vector index is an IVF index over the stored chunk embeddings, built when chunks are embedded at ingest;
+    searching without one fails instead of embedding the whole corpus on the query path. When the corpus fingerprint of the inverted index changes, chunks not stored yet are embedded and all vectors
+    are assigned to the trained centroids; the centroids are only trained again for a new embedding backend or
+    once the corpus has outgrown them.
+    """
+
+    def __init__(self, backend: DocumentSearchBackend, store: EmbeddingStore, mode: str = "hybrid",
+                 weights: dict = None, rrf_k: int = RRF_K, probes: int = None, path: str = ANN_INDEX_PATH) -> None:
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}'. Choose one of: {', '.join(RETRIEVAL_MODES)}.")
+
+        self.backend = backend
+        self.store = store
+        self.mode = mode
+        self.weights = weights or {"bm25": 1.0, "vector": 1.0}
+        self.rrf_k = rrf_k
+        self.probes = probes
+        self.path = path
+        self.ann_index = None
+        self.lock = threading.Lock()
+
+    def build_ann_index(self, centroids: np.ndarray = None):
+        """Embed the chunks of the inverted index that have no stored vector and write the vector index.
+
+        Given the centroids of a previous index, the vectors are assigned to them instead of training new ones.
+        """
+        index = self.backend.load_index()
+        names = [index.doc_name(doc_id) for doc_id in range(index.doc_count)]
+        hashes = [index.fingerprint(doc_id)[2] for doc_id in range(index.doc_count)]
+
+        missing = set(self.store.missing(hashes))
+        if missing:
+            items = []
+            for name, digest in tqdm(list(zip(names, hashes)), desc="Embedding chunks"):
+                if digest in missing:
+                    items.append((digest, self.backend.read_chunks([name])[0]))
+                    missing.discard(digest)
+            self.store.embed(items)
+
+        # Fill one float32 matrix straight from the stored bytes, identical chunks share a vector
+        rows = {}
+        for position, digest in enumerate(hashes):
+            rows.setdefault(digest, []).append(position)
+
+        vectors = None
+        for digest, blob in self.store.iter_blobs(hashes):
+            vector = np.frombuffer(blob, dtype=np.float32)
+            if vectors is None:
+                vectors = np.zeros((len(hashes), len(vector)), dtype=np.float32)
+            vectors[rows[digest]] = vector
+
+        if vectors is None:
+            vectors = np.zeros((0, centroids.shape[1] if centroids is not None else 1), dtype=np.float32)
+        if centroids is not None and (vectors.shape[1] != centroids.shape[1]
+                                      or list_count_for(len(hashes)) > RETRAIN_GROWTH * len(centroids)):
+            centroids = None
+        write_ann_index(self.path, names, vectors, index.corpus_fingerprint(), self.store.backend.name,
+                        centroids=centroids)
+
+    def load_ann_index(self) -> AnnIndex:
+        """Memory-map the vector index, updating it first if the corpus changed since it was built."""
+        with self.lock:
+            fingerprint = self.backend.corpus_fingerprint()
+            if self.ann_index is not None and self.ann_index.fingerprint == fingerprint:
+                return self.ann_index
+
+            if self.ann_index is not None:
+                self.ann_index.close()
+                self.ann_index = None
+
+            centroids = None
+            if os.path.exists(self.path):
+                ann_index = AnnIndex(self.path)
+                if ann_index.backend_name == self.store.backend.name:
+                    if ann_index.fingerprint == fingerprint:
+                        self.ann_index = ann_index
+                        return ann_index
+                    # The corpus changed, keep the trained centroids so the query path does not train again
+                    if ann_index.count:
+                        centroids = ann_index.centroids.copy()
+                ann_index.close()
+
+            if centroids is None:
+                # Only an index of the same backend avoids embedding every chunk, which belongs to ingest
+                raise FileNotFoundError(MISSING_ANN_INDEX)
+            self.build_ann_index(centroids)
+            self.ann_index = AnnIndex(self.path)
+            return self.ann_index
+
+    def bm25_ranking(self, question: str, count: int, keywords: list = None) -> list:
+        # Documents without any keyword are only padding and must not earn a fusion score
+        return [(document["name"], document["score"])
+                for document in self.backend.search_documents(question, count, keywords, pad=False)]
+
+    def vector_ranking(self, question: str, count: int) -> list:
+        ann_index = self.load_ann_index()
+        query = self.store.backend.embed_query(question)
+        if self.probes is None:
+            return ann_index.search(query, count)
+        return ann_index.search(query, count, self.probes)
+
+    def search(self, question: str, count: int = 3, keywords: list = None) -> list:
+        """Return the top chunks as dicts with the fused score and the score and rank from every source."""
+        candidates = count * CANDIDATE_FACTOR
+        results = {}
+        if self.mode in ("bm25", "hybrid"):
+            results["bm25"] = self.bm25_ranking(question, candidates, keywords)
+        if self.mode in ("vector", "hybrid"):
+            results["vector"] = self.vector_ranking(question, candidates)
+
+        fused = reciprocal_rank_fusion({source: [name for name, _ in ranking] for source, ranking in results.items()},
+                                       self.weights, self.rrf_k)
+
+        scores = {source: dict(ranking) for source, ranking in results.items()}
+        ranks = {source: {name: rank for rank, (name, _) in enumerate(ranking, start=1)}
+                 for source, ranking in results.items()}
+
+        documents = []
+        for name in sorted(fused, key=lambda name: (-fused[name], name))[:count]:
+            document = {"name": name, "location": f"{CHUNK_STORE_PATH}#{name}", "score": fused[name]}
+            for source in results:
+                document[f"{source}_score"] = scores[source].get(name)
+                document[f"{source}_rank"] = ranks[source].get(name)
+            documents.append(document)
+
+        return documents
+
+    def close(self):
+        with self.lock:
+            if self.ann_index is not None:
+                self.ann_index.close()
+                self.ann_index = None
+
+
+def add_retrieval_arguments(parser, default_mode: str = "bm25"):
+    retrieval_group = parser.add_argument_group("Retrieval options")
+    retrieval_group.add_argument("--retrieval", choices=RETRIEVAL_MODES, default=default_mode, help=f"Retrieve documents with BM25, embeddings or both fused with reciprocal rank fusion (default: {default_mode})")
+    retrieval_group.add_argument("--rrf-k", type=int, default=RRF_K, help=f"Rank constant of reciprocal rank fusion (default: {RRF_K})")
+    retrieval_group.add_argument("--bm25-weight", type=float, default=1.0, help="Weight of the BM25 ranking in the fusion (default: 1.0)")
+    retrieval_group.add_argument("--vector-weight", type=float, default=1.0, help="Weight of the embedding ranking in the fusion (default: 1.0)")
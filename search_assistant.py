@@ -1,16 +1,29 @@
+# Imported first, so --profile-startup times every other import
+from startup import add_startup_arguments, report_startup
+
 import argparse
+import copy
 import json
 import os
 import signal
 import threading
 import time
+from functools import partial
 
 import requests
 from dotenv import load_dotenv
 from rich.console import Console
+from rich.live import Live
 from rich.markdown import Markdown
 
+from answer_cache import AnswerCache
+from api_client import ApiClient, RetryPolicy
+from context_packer import ContextPacker
+from conversation import HISTORY_TOKENS, HISTORY_TURNS, SUMMARY_TOKENS, ConversationMemory, ConversationStore
 from document_search import DocumentSearch
+from metrics import metrics
+from retrieval import MISSING_ANN_INDEX, add_retrieval_arguments, ann_index_missing
+from server import QueryServer, add_server_arguments
 
 load_dotenv()
 
@@ -57,6 +70,7 @@ system_content = (
     "If the question is not available, answer by saying that the answer is not available in the document data.\n"
 )
 
+# Template only: every session or request works on its own copy from create_payload
 payload = {
     "messages": [],
     "stream": True,
@@ -65,17 +79,46 @@ payload = {
     "presence_penalty": 0.0,
 }
 
+style_prompts = {
+    "concise": "This tone responds with the fewest words and characters possible. It skips extra words and "
+               "gets right to the point. Example: 'Data shows sales up 50%' instead of 'Based on the data "
+               "that we have collected, it appears that there has been an increase in sales by 50%.'",
+    "creative": "This style is characterized by a focus on imagination, expression, and originality. It often "
+                "involves using literary devices such as metaphors, imagery, and symbolism to convey meaning. "
+                "Example: 'The sunset painted the sky with a palette of fiery oranges and deep purples, "
+                "as if nature itself were an artist at work.'",
+}
 
-def prompt_template(context: list, question: str):
-    prompt_length = 65
-    query_words = question.split()
-    query_length = len(query_words)
-    total_length = query_length + len(context) + prompt_length
+# Number of top documents offered to the context packer, which keeps as many as fit
+CONTEXT_CANDIDATES = 10
 
-    if total_length > 4097:
-        context_text = " ".join(context[:len(context) - (query_length + prompt_length)])
-    else:
-        context_text = " ".join(context)
+context_packer = ContextPacker(
+    context_window=int(os.getenv("CONTEXT_WINDOW") or 4096),
+    answer_tokens=int(os.getenv("ANSWER_TOKENS") or 512),
+    model=os.getenv("MODEL")
+)
+
+document_search = None
+document_search_lock = threading.Lock()
+
+# Set from the command line before the first search
+retrieval_options = {"retrieval": "bm25"}
+
+api_client = None
+api_client_lock = threading.Lock()
+
+# One answer cache per response style, since the same question gets a different answer in another style
+answer_caches = {}
+answer_caches_lock = threading.Lock()
+
+# Internet conversations of the server, by session id and system prompts
+conversations = ConversationStore(max_sessions=int(os.getenv("MAX_SESSIONS") or 1000),
+                                  ttl=float(os.getenv("SESSION_TTL") or 3600))
+metrics.register_cache("conversation", conversations)
+
+
+def prompt_template(context: list, question: str):
+    context_text = "\n\n".join(context)
 
     return (
         "\n**Context:**\n"
@@ -85,32 +128,256 @@ def prompt_template(context: list, question: str):
     )
 
 
+def pack_context(documents: list, texts: list, question: str, keywords: list, system_prompts: list) -> list:
+    """Fit as much of the retrieved documents as the model's context window allows, best passages first."""
+    budget = context_packer.budget(system_prompts, prompt_template([], question))
+    return context_packer.pack(documents, texts, keywords, budget)
+
+
 def read_documents(documents: list):
-    texts = []
-    for document in documents:
-        with open(document["location"], "r", encoding="utf-8") as doc:
-            texts.append(doc.read())
+    return get_document_search().backend.read_chunks([document["name"] for document in documents])
+
+
+def iter_tokens(response: requests.Response):
+    """Yield the text of a streamed completion as it arrives, from server-sent events or a plain text stream."""
+    response.encoding = response.encoding or "utf-8"
+
+    if "text/event-stream" not in response.headers.get("Content-Type", ""):
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            if chunk:
+                yield chunk
+        return
+
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            yield data
+            continue
+
+        for choice in event.get("choices", []):
+            token = choice.get("delta", {}).get("content") or choice.get("text")
+            if token:
+                yield token
+
+
+class ResponseStream:
+    """Iterate the tokens of a streamed completion as they arrive and measure the time to the first one."""
+
+    def __init__(self, response: requests.Response, started: float, on_complete=None):
+        self.response = response
+        self.started = started
+        self.on_complete = on_complete
+        self.time_to_first_token = None
+        self.total_time = None
+        self.tokens = []
+
+    def __iter__(self):
+        try:
+            for token in iter_tokens(self.response):
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - self.started
+                self.tokens.append(token)
+                yield token
+        finally:
+            self.response.close()
+
+        self.total_time = time.perf_counter() - self.started
+        metrics.observe("stage_seconds", self.total_time, stage="api_call")
+        if self.time_to_first_token is not None:
+            metrics.observe("time_to_first_token_seconds", self.time_to_first_token)
+        metrics.increment("api_responses_total", status=self.response.status_code)
+        # Error bodies are shown to the user but never remembered as an answer
+        if self.on_complete is not None and self.response.ok and self.text.strip():
+            self.on_complete(self.text)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.tokens)
+
+    def read(self) -> str:
+        """Consume the rest of the stream and return the whole text."""
+        for _ in self:
+            pass
+        return self.text
+
+
+class CachedAnswer:
+    """A finished answer served from the answer cache, with the same interface as ResponseStream."""
+
+    def __init__(self, text: str, started: float):
+        self.text = text
+        self.time_to_first_token = time.perf_counter() - started
+        self.total_time = self.time_to_first_token
+
+    def __iter__(self):
+        yield self.text
+
+    def read(self) -> str:
+        return self.text
+
+
+def get_api_client() -> ApiClient:
+    # One pooled client per process, so every question reuses the same keep-alive connections
+    global api_client
+    with api_client_lock:
+        if api_client is None:
+            api_client = ApiClient(
+                API_URL,
+                HEADERS,
+                timeout=(float(os.getenv("API_CONNECT_TIMEOUT") or 5), float(os.getenv("API_READ_TIMEOUT") or 60)),
+                max_in_flight=int(os.getenv("API_MAX_IN_FLIGHT") or 8),
+                retry=RetryPolicy(attempts=int(os.getenv("API_MAX_ATTEMPTS") or 4))
+            )
+    return api_client
+
+
+def post_stream(request_payload: dict, on_complete=None) -> ResponseStream:
+    metrics.increment("tokens_sent_total", sum(context_packer.count_tokens(message["content"])
+                                               for message in request_payload["messages"]))
+    started = time.perf_counter()
+    response = get_api_client().post(request_payload, stream=True)
+    return ResponseStream(response, started, on_complete)
+
+
+def create_payload(search_type: str, style: str = "none") -> dict:
+    session_payload = copy.deepcopy(payload)
+
+    if style in style_prompts:
+        session_payload["messages"].append({"role": "system", "content": style_prompts[style]})
+
+    if search_type == "document":
+        session_payload["presence_penalty"] = 0.6
+    elif search_type == "internet":
+        session_payload["messages"].append(
+            {"role": "system", "content": "You are a helpful assistant. Please answer using Markdown."})
+        session_payload["temperature"] = 1.0
+
+    return session_payload
+
+
+def system_prompts(session_payload: dict) -> tuple:
+    return tuple(message["content"] for message in session_payload["messages"] if message["role"] == "system")
+
 
-    return texts
+def create_memory(session_payload: dict) -> ConversationMemory:
+    """Create the memory of a conversation that keeps the payload's system prompts pinned."""
+    prompts = system_prompts(session_payload)
+    # The history never takes the room of the question and the answer
+    budget = min(int(os.getenv("HISTORY_TOKENS") or HISTORY_TOKENS), context_packer.budget(list(prompts), ""))
+    return ConversationMemory(prompts, budget, window=int(os.getenv("HISTORY_TURNS") or HISTORY_TURNS),
+                              summary_tokens=int(os.getenv("SUMMARY_TOKENS") or SUMMARY_TOKENS),
+                              model=context_packer.model)
 
 
-def search_and_return_documents(question: str):
-    ds = DocumentSearch(None, "docs")
-    load_docs = ds.search_documents(question)
-    read_docs = read_documents(load_docs)
-    prompt = prompt_template(read_docs, question)
-    payload["messages"] = [{"role": "system", "content": system_content}, {"role": "user", "content": prompt}]
-    response = requests.post(API_URL, headers=HEADERS, data=json.dumps(payload))
+def get_document_search() -> DocumentSearch:
+    # One DocumentSearch per process, so the index and caches stay loaded between questions
+    global document_search
+    with document_search_lock:
+        if document_search is None:
+            document_search = DocumentSearch(None, "docs", **retrieval_options)
+    return document_search
 
-    return response.text
 
+def get_answer_cache(session_payload: dict) -> AnswerCache:
+    style = system_prompts(session_payload)
+    with answer_caches_lock:
+        if style not in answer_caches:
+            answer_caches[style] = AnswerCache()
+            metrics.register_cache("answer", answer_caches[style])
+        return answer_caches[style]
 
-def search_online(question: str):
-    payload["messages"].append({"role": "user", "content": question})
-    response = requests.post(API_URL, headers=HEADERS, data=json.dumps(payload))
-    payload["messages"].append({"role": "assistant", "content": response.text})
 
-    return response.text
+def search_and_return_documents(question: str, session_payload: dict):
+    started = time.perf_counter()
+    ds = get_document_search()
+
+    # The API call is timed by the returned stream, since its tokens arrive after this returns
+    with metrics.span("search") as span:
+        # A repeated or near-duplicate question over an unchanged corpus is answered without calling the API
+        answer_cache = get_answer_cache(session_payload)
+        question_keywords = ds.backend.get_keywords(question)
+        fingerprint = ds.backend.corpus_fingerprint()
+        cached_answer = answer_cache.get(question_keywords, fingerprint)
+        span["cached"] = cached_answer is not None
+        metrics.increment("searches_total", cached=span["cached"])
+        if cached_answer is not None:
+            return CachedAnswer(cached_answer, started)
+
+        load_docs = ds.search_documents(question, CONTEXT_CANDIDATES, question_keywords)
+        read_docs = read_documents(load_docs)
+        keywords = ds.backend.translate_keywords(question_keywords)
+        with metrics.span("pack_context", documents=len(load_docs)):
+            context = pack_context(load_docs, read_docs, question, keywords, [system_content])
+        prompt = prompt_template(context, question)
+        request_payload = dict(session_payload, messages=[{"role": "system", "content": system_content},
+                                                          {"role": "user", "content": prompt}])
+
+        return post_stream(request_payload, partial(answer_cache.put, question_keywords, fingerprint))
+
+
+def search_online(question: str, session_payload: dict, memory: ConversationMemory = None):
+    if memory is None:
+        memory = create_memory(session_payload)
+
+    # Only the pinned prompts, a summary of older turns and the recent turns are sent, so requests stay bounded
+    request_payload = dict(session_payload, messages=memory.messages(question))
+    metrics.observe("history_tokens", memory.tokens())
+
+    # The reply joins the conversation once it has been fully received
+    def remember_answer(answer: str):
+        metrics.increment("history_turns_summarized_total", memory.add_turn(question, answer))
+
+    return post_stream(request_payload, remember_answer)
+
+
+search_functions = {
+    "document": search_and_return_documents,
+    "internet": search_online,
+}
+
+
+def answer_request(request: dict) -> dict:
+    """Answer one server request with its own payload; internet requests with a session continue its conversation."""
+    search_type = request.get("type", "document")
+    if search_type not in search_functions:
+        raise ValueError("Invalid value for 'type'. Please choose between 'document' or 'internet'.")
+    style = request.get("style", "none")
+    if style != "none" and style not in style_prompts:
+        raise ValueError("Invalid value for 'style'. Please choose between 'none', 'concise' or 'creative'.")
+    session = request.get("session")
+    if session is not None and (not isinstance(session, str) or not session):
+        raise ValueError("Invalid value for 'session'. Please send a non-empty string.")
+
+    session_payload = create_payload(search_type, style)
+    if search_type == "internet" and session is not None:
+        memory = conversations.get((session, system_prompts(session_payload)),
+                                   partial(create_memory, session_payload))
+        stream = search_online(request["question"], session_payload, memory)
+    else:
+        stream = search_functions[search_type](request["question"], session_payload)
+    answer = stream.read()
+    return {"answer": answer, "time_to_first_token": stream.time_to_first_token, "total_time": stream.total_time}
+
+
+def render_stream(console: Console, stream: ResponseStream, refresh_interval: float = 0.05):
+    """Render a streamed answer as Markdown while its tokens arrive."""
+    last_update = 0.0
+    with Live(Markdown(""), console=console, refresh_per_second=20, vertical_overflow="visible") as live:
+        for _ in stream:
+            # Re-parsing the Markdown for every token is wasteful, so only refresh a few times per second
+            now = time.perf_counter()
+            if now - last_update >= refresh_interval:
+                live.update(Markdown(stream.text))
+                last_update = now
+        live.update(Markdown(stream.text))
 
 
 def signal_handler(sig, frame):
@@ -137,47 +404,53 @@ def run_search():
         help="Choose the style for the responses. Options: 'none' (standard style), 'concise' (minimal words and "
              "characters), 'creative' (imaginative and varied style)."
     )
+    add_server_arguments(parser)
+    add_retrieval_arguments(parser)
+    add_startup_arguments(parser)
     args = parser.parse_args()
+    retrieval_options.update(retrieval=args.retrieval, rrf_k=args.rrf_k,
+                             fusion_weights={"bm25": args.bm25_weight, "vector": args.vector_weight})
 
-    if args.style == "concise":
-        payload["messages"].append({
-            "role": "system",
-            "content": "This tone responds with the fewest words and characters possible. It skips extra words and "
-                       "gets right to the point. Example: 'Data shows sales up 50%' instead of 'Based on the data "
-                       "that we have collected, it appears that there has been an increase in sales by 50%.'"})
-    elif args.style == "creative":
-        payload["messages"].append({
-            "role": "system",
-            "content": "This style is characterized by a focus on imagination, expression, and originality. It often "
-                       "involves using literary devices such as metaphors, imagery, and symbolism to convey meaning. "
-                       "Example: 'The sunset painted the sky with a palette of fiery oranges and deep purples, "
-                       "as if nature itself were an artist at work.'"
-        })
+    if ann_index_missing(args.retrieval):
+        console.print(f"[red bold]{MISSING_ANN_INDEX}")
+        return
 
-    if args.type == "document":
-        payload["presence_penalty"] = 0.6
+    if args.serve:
+        # Load the index once, so the first request does not pay for it
+        get_document_search().backend.load_index()
+        server = QueryServer(answer_request, args.host, args.port, args.server_workers)
+        report_startup()
+        server.serve_forever()
+        return
 
+    if args.type == "document":
         search_type = "Document"
-        search_func = search_and_return_documents
     elif args.type == "internet":
-        payload["messages"].append(
-            {"role": "system", "content": "You are a helpful assistant. Please answer using Markdown."})
-        payload["temperature"] = 1.0
-
         search_type = "Internet"
-        search_func = search_online
     else:
         console.print("[red bold]Invalid value for --type argument. Please choose between 'document' or 'internet'.")
         return
 
+    session_payload = create_payload(args.type, args.style)
+    if args.type == "internet":
+        # The whole interactive session is one conversation
+        search_func = partial(search_online, session_payload=session_payload, memory=create_memory(session_payload))
+    else:
+        search_func = partial(search_functions[args.type], session_payload=session_payload)
+
     console.print(
         f"[green bold]To stop the program, press Ctrl+C on your keyboard while in {search_type} search mode.\n")
+    report_startup()
 
     while True:
         query = input(console.render_str(f"[white bold]({search_type}) Question[/][white]: "))
-        answer = Markdown(search_func(query))
-        console.print(f"[white bold]({search_type}) Answer[/]: {answer.markup}", end="\n\n", markup=True,
-                      highlight=True)
+        stream = search_func(query)
+        console.print(f"[white bold]({search_type}) Answer[/]:")
+        render_stream(console, stream)
+
+        if stream.time_to_first_token is not None:
+            console.print(f"[dim]First token after {stream.time_to_first_token:.2f}s, "
+                          f"complete after {stream.total_time:.2f}s[/]", end="\n\n")
 
 
 if __name__ == "__main__":
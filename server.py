@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable
+
+from metrics import metrics
+
+MAX_BODY_SIZE = 1 << 20
+KEEP_ALIVE_TIMEOUT = 30
+
+# A route result sent as is instead of as JSON
+TextResponse = namedtuple("TextResponse", ["text", "content_type"])
+
+
+class HttpError(Exception):
+
+    def __init__(self, status: HTTPStatus, message: str = None) -> None:
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class QueryServer:
+    """A long-lived asyncio HTTP server that answers questions while the search state stays loaded.
+
+    POST /search takes a JSON object and returns the JSON object produced by the handler. The handler runs on a
+    bounded thread pool, so slow searches and API calls never block the event loop, and it receives a fresh
+    request dict, so no state is shared between requests unless the handler keeps it on purpose.
+
+    GET /metrics returns the process metrics in the Prometheus text format, GET /metrics.jsonl as JSON lines.
+    """
+
+    def __init__(self, handler: Callable[[dict], dict], host: str = "127.0.0.1", port: int = 8000,
+                 max_workers: int = 8) -> None:
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query")
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("POST", "/search"): self.search,
+            ("GET", "/metrics"): self.metrics,
+            ("GET", "/metrics.jsonl"): self.metrics_json_lines,
+        }
+
+    async def health(self, body: dict) -> dict:
+        return {"status": "ok"}
+
+    async def metrics(self, body: dict) -> TextResponse:
+        return TextResponse(metrics.to_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+
+    async def metrics_json_lines(self, body: dict) -> TextResponse:
+        return TextResponse(metrics.to_json_lines(), "application/x-ndjson; charset=utf-8")
+
+    async def search(self, body: dict) -> dict:
+        if not isinstance(body.get("question"), str) or not body["question"].strip():
+            raise HttpError(HTTPStatus.BAD_REQUEST, "The request needs a non-empty 'question' string.")
+        for field in ("type", "style"):
+            if field in body and not isinstance(body[field], str):
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"The '{field}' of the request must be a string.")
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self.handler, body)
+        except ValueError as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+        if not request_line:
+            return None
+
+        try:
+            method, path, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get("content-length", "0")
+        # int() would also take signs, underscores and non-ASCII digits
+        if not (length.isascii() and length.isdigit()):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length header.")
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        return method, path.split("?", 1)[0], body, keep_alive
+
+    async def write_response(self, writer: asyncio.StreamWriter, status: HTTPStatus, content,
+                             keep_alive: bool):
+        if isinstance(content, TextResponse):
+            body, content_type = content.text.encode("utf-8"), content.content_type
+        else:
+            body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                keep_alive, route = False, None
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+
+                    method, path, body, keep_alive = request
+                    started = time.perf_counter()
+                    route = self.routes.get((method, path))
+                    if route is None:
+                        allowed = any(route_path == path for _, route_path in self.routes)
+                        raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND)
+
+                    try:
+                        content = json.loads(body) if body else {}
+                    except json.JSONDecodeError:
+                        raise HttpError(HTTPStatus.BAD_REQUEST, "The request body is not valid JSON.")
+                    if not isinstance(content, dict):
+                        raise HttpError(HTTPStatus.BAD_REQUEST, "The request body must be a JSON object.")
+
+                    status, response = HTTPStatus.OK, await route(content)
+                except HttpError as e:
+                    status, response = e.status, {"error": str(e)}
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {str(e)}"}
+
+                if route is not None:
+                    metrics.observe("request_seconds", time.perf_counter() - started, path=path)
+                metrics.increment("requests_total", status=status.value)
+
+                await self.write_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port} (POST /search, GET /health, GET /metrics)")
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def add_server_arguments(parser):
+    server_group = parser.add_argument_group("Server options")
+    server_group.add_argument("--serve", action="store_true", help="Run as a long-lived HTTP server instead of an interactive prompt")
+    server_group.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind the server to (default: 127.0.0.1)")
+    server_group.add_argument("--port", type=int, default=8000, help="Port to bind the server to (default: 8000)")
+    server_group.add_argument("--server-workers", type=int, default=8, help="Maximum number of questions answered concurrently (default: 8)")
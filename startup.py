@@ -0,0 +1,56 @@
+import builtins
+import sys
+import threading
+import time
+
+# Imported first by every command line tool, so the timings cover everything the tool imports afterwards
+STARTED = time.perf_counter()
+PROFILE_FLAG = "--profile-startup"
+
+# Number of packages listed by the startup report
+REPORT_SIZE = 10
+
+import_times = {}
+_import_stack = threading.local()
+_original_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """Time an import and charge the time not spent in nested imports to the imported top-level package."""
+    stack = _import_stack.__dict__.setdefault("children", [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        package = name if level == 0 else (globals or {}).get("__package__") or name
+        package = package.partition(".")[0]
+        import_times[package] = import_times.get(package, 0.0) + elapsed - nested
+
+
+def profiling() -> bool:
+    return builtins.__import__ is _timed_import
+
+
+def add_startup_arguments(parser):
+    parser.add_argument(PROFILE_FLAG, action="store_true", help="Report how long startup took and which imported packages took longest")
+
+
+def report_startup(label: str = "Ready"):
+    """Print the time since the process started and the slowest imported packages, if --profile-startup is set."""
+    if not profiling():
+        return
+
+    total = sum(import_times.values())
+    print(f"{label} in {time.perf_counter() - STARTED:.2f}s, {total:.2f}s of it importing {len(import_times)} package(s):")
+    for package, seconds in sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:REPORT_SIZE]:
+        print(f"  {package:<24} {seconds:.3f}s")
+
+
+if PROFILE_FLAG in sys.argv:
+    builtins.__import__ = _timed_import
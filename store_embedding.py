@@ -0,0 +1,21 @@
+from llama_index.embeddings.base import BaseEmbedding
+
+from embedding_store import EmbeddingStore
+from manifest import content_hash
+
+
+class StoreEmbedding(BaseEmbedding):
+    """Expose an EmbeddingStore to llama_index, so known chunks are looked up instead of re-embedded."""
+
+    def __init__(self, store: EmbeddingStore) -> None:
+        super().__init__()
+        self.store = store
+
+    def _get_query_embedding(self, query: str) -> list:
+        return self.store.backend.embed_query(query)
+
+    def _get_text_embedding(self, text: str) -> list:
+        return self.store.embed([(content_hash(text), text)])[0]
+
+    def _get_text_embeddings(self, texts: list) -> list:
+        return self.store.embed([(content_hash(text), text) for text in texts])
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import api_client
+from api_client import ApiClient, AsyncApiClient, RetryPolicy
+
+# Retries of the tests wait a few milliseconds at most
+FAST_RETRY = RetryPolicy(attempts=3, backoff_base=0.001, backoff_max=0.01)
+
+
+class StubServer(ThreadingHTTPServer):
+    """A local HTTP/1.1 server answering POSTs with a script of (status, headers, delay) responses."""
+
+    daemon_threads = True
+
+    def __init__(self, script: list = None) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.script = list(script or [])
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat"
+
+    def next_response(self, client_address: tuple, body: bytes) -> tuple:
+        with self.lock:
+            self.requests.append((client_address, json.loads(body)))
+            return self.script.pop(0) if self.script else (200, {}, 0.0)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status, headers, delay = self.server.next_response(self.client_address, body)
+        # Not time.sleep, which the tests replace to record the client's backoff
+        threading.Event().wait(delay)
+
+        content = json.dumps({"status": status, "attempt": len(self.server.requests)}).encode("utf-8")
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(script: list = None) -> StubServer:
+        server = StubServer(script)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff delays of the blocking client instead of waiting."""
+    delays = []
+    monkeypatch.setattr(api_client.time, "sleep", delays.append)
+    return delays
+
+
+def test_retries_server_errors_with_backoff(stub, sleeps):
+    server = stub([(503, {}, 0.0), (500, {}, 0.0)])
+    with ApiClient(server.url, {"Authorization": "Bearer test"}, retry=FAST_RETRY) as client:
+        response = client.post({"question": "halo"})
+
+    assert response.status_code == 200
+    assert response.json()["attempt"] == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= FAST_RETRY.backoff_max for delay in sleeps)
+    assert [payload for _, payload in server.requests] == [{"question": "halo"}] * 3
+
+
+def test_honours_retry_after_of_rate_limits(stub, sleeps):
+    server = stub([(429, {"Retry-After": "0.005"}, 0.0)])
+    with ApiClient(server.url, {}, retry=FAST_RETRY) as client:
+        assert client.post({}).status_code == 200
+
+    assert sleeps == [0.005]
+
+
+def test_returns_the_last_response_once_retries_run_out(stub, sleeps):
+    server = stub([(503, {}, 0.0)] * FAST_RETRY.attempts)
+    with ApiClient(server.url, {}, retry=FAST_RETRY) as client:
+        response = client.post({})
+
+    assert response.status_code == 503
+    assert len(server.requests) == FAST_RETRY.attempts
+
+
+def test_client_errors_are_not_retried(stub, sleeps):
+    server = stub([(400, {}, 0.0)])
+    with ApiClient(server.url, {}, retry=FAST_RETRY) as client:
+        assert client.post({}).status_code == 400
+
+    assert len(server.requests) == 1
+    assert sleeps == []
+
+
+def test_read_timeouts_are_retried_then_raised(stub, sleeps):
+    server = stub([(200, {}, 0.5)] * FAST_RETRY.attempts)
+    with ApiClient(server.url, {}, timeout=(1.0, 0.05), retry=FAST_RETRY) as client:
+        with pytest.raises(requests.Timeout):
+            client.post({})
+
+    assert len(server.requests) == FAST_RETRY.attempts
+    assert len(sleeps) == FAST_RETRY.attempts - 1
+
+
+def test_session_reuses_one_connection(stub):
+    server = stub()
+    with ApiClient(server.url, {}, retry=FAST_RETRY) as client:
+        for _ in range(5):
+            client.post({}).close()
+
+    assert len({address for address, _ in server.requests}) == 1
+
+
+def test_retries_reuse_the_connection(stub, sleeps):
+    server = stub([(503, {}, 0.0), (429, {}, 0.0)])
+    with ApiClient(server.url, {}, retry=FAST_RETRY) as client:
+        client.post({}, stream=True).close()
+
+    assert len(server.requests) == 3
+    assert len({address for address, _ in server.requests}) == 1
+
+
+def test_streamed_responses_hold_their_in_flight_slot(stub):
+    server = stub()
+    with ApiClient(server.url, {}, max_in_flight=1, retry=FAST_RETRY) as client:
+        response = client.post({}, stream=True)
+        assert not client.in_flight.acquire(blocking=False)
+
+        response.close()
+        assert client.in_flight.acquire(blocking=False)
+        client.in_flight.release()
+
+
+def test_async_client_retries_and_reuses_its_connection(stub):
+    server = stub([(502, {}, 0.0), (429, {"Retry-After": "0.001"}, 0.0)])
+
+    async def run():
+        async with AsyncApiClient(server.url, {"Authorization": None}, retry=FAST_RETRY) as client:
+            first = await client.post_json({"question": "halo"})
+            second = await client.post_json({"question": "lagi"})
+            return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first == {"status": 200, "attempt": 3}
+    assert second == {"status": 200, "attempt": 4}
+    assert len({address for address, _ in server.requests}) == 1
+
+
+def test_async_client_raises_timeouts_once_retries_run_out(stub):
+    server = stub([(200, {}, 0.5)] * FAST_RETRY.attempts)
+
+    async def run():
+        async with AsyncApiClient(server.url, {}, timeout=(1.0, 0.05), retry=FAST_RETRY) as client:
+            await client.post_json({})
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert len(server.requests) == FAST_RETRY.attempts
+
+
+def test_importing_the_client_does_not_import_aiohttp():
+    code = "import sys, api_client; print('aiohttp' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=api_client.__file__.rsplit("/", 1)[0] or ".").stdout
+    assert output.strip() == "False"
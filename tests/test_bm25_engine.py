@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from bm25_engine import SparseBM25
+from inverted_index import IndexBuilder, InvertedIndex
+
+# Every document mentions "sistem" and most "data", so their raw idf is negative and rank_bm25 floors it
+CORPUS = [
+    "sistem informasi data mahasiswa data nilai".split(),
+    "sistem basis data relasional".split(),
+    "sistem operasi linux kernel proses".split(),
+    "sistem data jaringan komputer data data".split(),
+    "sistem pakar diagnosa penyakit".split(),
+    "sistem data".split(),
+]
+
+# Nearly every term is in every document, so even the average idf is negative and the floor is negative too
+COMMON_CORPUS = [
+    "data sistem informasi".split(),
+    "data sistem informasi".split(),
+    "data sistem informasi jaringan".split(),
+    "data sistem".split(),
+    "data sistem informasi basis".split(),
+]
+
+# Documents with a common term score negatively, the last one has none of them and scores zero
+NEGATIVE_CORPUS = [
+    "data sistem basis".split(),
+    "data sistem data basis".split(),
+    "data sistem basis".split(),
+    "sistem data informasi basis".split(),
+    "data sistem basis".split(),
+    "jaringan".split(),
+]
+
+QUERIES = [
+    ["sistem"],
+    ["data"],
+    ["data", "data", "jaringan"],
+    ["sistem", "informasi", "basis"],
+    ["linux", "tidak", "ada"],
+    ["tidak", "ada"],
+    [],
+]
+
+
+@pytest.fixture
+def build_engine(tmp_path):
+    """Write a corpus into an inverted index and return a SparseBM25 engine over it."""
+    indexes = []
+
+    def build(corpus: list) -> SparseBM25:
+        builder = IndexBuilder()
+        for position, tokens in enumerate(corpus):
+            builder.add_document(f"doc{position}", tokens)
+        path = str(tmp_path / f"docs{len(indexes)}.index")
+        builder.write(path)
+
+        indexes.append(InvertedIndex(path))
+        return SparseBM25(indexes[-1])
+
+    yield build
+    for index in indexes:
+        index.close()
+
+
+def expected_top(scores: np.ndarray, count: int) -> list:
+    """Rank the BM25Okapi scores by score, breaking ties by the lowest document id."""
+    order = sorted(range(len(scores)), key=lambda doc_id: (-scores[doc_id], doc_id))[:count]
+    return [(doc_id, scores[doc_id]) for doc_id in order]
+
+
+@pytest.mark.parametrize("corpus", [CORPUS, COMMON_CORPUS], ids=["floored-idf", "negative-floor"])
+@pytest.mark.parametrize("keywords", QUERIES)
+def test_scores_match_bm25okapi(build_engine, corpus, keywords):
+    engine = build_engine(corpus)
+    reference = BM25Okapi(corpus)
+
+    assert np.allclose(engine.get_scores(keywords), reference.get_scores(keywords), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("corpus", [CORPUS, COMMON_CORPUS], ids=["floored-idf", "negative-floor"])
+@pytest.mark.parametrize("count", [1, 3, 10])
+def test_top_k_matches_bm25okapi(build_engine, corpus, count):
+    engine = build_engine(corpus)
+    reference = BM25Okapi(corpus)
+
+    for keywords in QUERIES:
+        top = engine.top_documents(keywords, count)
+        expected = expected_top(reference.get_scores(keywords), count)
+
+        assert [doc_id for doc_id, _ in top] == [doc_id for doc_id, _ in expected]
+        assert np.allclose([score for _, score in top], [score for _, score in expected], rtol=1e-12, atol=1e-12)
+
+
+def test_batch_scores_match_single_queries(build_engine):
+    engine = build_engine(CORPUS)
+
+    batch = engine.get_batch_scores(QUERIES)
+    for row, keywords in zip(batch, QUERIES):
+        assert np.array_equal(row, engine.get_scores(keywords))
+
+
+@pytest.mark.parametrize("corpus, negative", [(CORPUS, False), (COMMON_CORPUS, True)],
+                         ids=["floored-idf", "negative-floor"])
+def test_idf_is_floored_like_bm25okapi(build_engine, corpus, negative):
+    engine = build_engine(corpus)
+    reference = BM25Okapi(corpus)
+
+    # "sistem" is in every document, so its idf is the epsilon floor, negative when the average idf is
+    assert reference.idf["sistem"] == pytest.approx(reference.epsilon * reference.average_idf)
+    assert (reference.idf["sistem"] < 0) == negative
+    assert np.allclose(engine.get_scores(["sistem"]), reference.get_scores(["sistem"]), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("corpus", [CORPUS, NEGATIVE_CORPUS], ids=["floored-idf", "negative-scores"])
+@pytest.mark.parametrize("count", [1, 3, 10])
+def test_top_matches_keep_negative_scores(build_engine, corpus, count):
+    engine = build_engine(corpus)
+    reference = BM25Okapi(corpus)
+
+    queries = QUERIES + [["informasi", "data"]]
+    tops = engine.top_matches_batch(queries, count)
+    for keywords, top in zip(queries, tops):
+        scores = reference.get_scores(keywords)
+        matching = [doc_id for doc_id, tokens in enumerate(corpus) if set(keywords) & set(tokens)]
+        expected = sorted(matching, key=lambda doc_id: (-scores[doc_id], doc_id))[:count]
+
+        assert [doc_id for doc_id, _ in top] == expected
+        assert np.allclose([score for _, score in top], scores[expected], rtol=1e-12, atol=1e-12)
@@ -0,0 +1,105 @@
+import numpy as np
+
+from embedding_store import EmbeddingStore, HashingEmbeddingBackend
+from manifest import content_hash
+
+TEXTS = ["Sistem informasi akademik", "Basis data relasional", "Jaringan komputer", "Sistem operasi linux"]
+
+
+class RecordingBackend(HashingEmbeddingBackend):
+    """A hashing backend that remembers every text it was asked to embed."""
+
+    def __init__(self, dimensions: int = 64) -> None:
+        super().__init__(dimensions)
+        self.embedded = []
+
+    def embed(self, texts: list) -> list:
+        self.embedded.extend(texts)
+        return super().embed(texts)
+
+
+def items(texts: list) -> list:
+    return [(content_hash(text), text) for text in texts]
+
+
+def test_hashing_backend_is_deterministic():
+    backend = HashingEmbeddingBackend(64)
+
+    vectors = backend.embed(TEXTS)
+    assert vectors == HashingEmbeddingBackend(64).embed(TEXTS)
+    assert all(len(vector) == 64 for vector in vectors)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+
+
+def test_stored_chunks_are_not_embedded_again():
+    backend = RecordingBackend()
+    store = EmbeddingStore(backend, ":memory:")
+
+    store.embed(items(TEXTS[:2]))
+    backend.embedded.clear()
+    store.embed(items(TEXTS))
+
+    assert backend.embedded == TEXTS[2:]
+    assert (store.hits, store.misses) == (2, 4)
+    assert store.missing([content_hash(text) for text in TEXTS]) == []
+
+
+def test_identical_chunks_are_embedded_once():
+    backend = RecordingBackend()
+    store = EmbeddingStore(backend, ":memory:")
+
+    store.embed(items([TEXTS[0], TEXTS[1], TEXTS[0]]))
+
+    assert backend.embedded == TEXTS[:2]
+
+
+def test_vectors_come_back_in_input_order():
+    backend = RecordingBackend()
+    store = EmbeddingStore(backend, ":memory:")
+    store.embed(items(TEXTS[1::2]))
+
+    texts = [TEXTS[3], TEXTS[0], TEXTS[1], TEXTS[2], TEXTS[0]]
+    vectors = store.embed(items(texts))
+
+    # Vectors are stored as float32, so fresh and stored ones only match up to its precision
+    assert np.allclose(vectors, HashingEmbeddingBackend(64).embed(texts), atol=1e-6)
+
+
+def test_vectors_survive_a_reopen(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    store = EmbeddingStore(RecordingBackend(), path)
+    vectors = store.embed(items(TEXTS))
+    store.close()
+
+    backend = RecordingBackend()
+    store = EmbeddingStore(backend, path)
+    try:
+        assert len(store) == len(TEXTS)
+        assert np.allclose(store.embed(items(TEXTS)), vectors, atol=1e-6)
+        assert backend.embedded == []
+    finally:
+        store.close()
+
+
+def test_vectors_are_kept_per_backend(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    store = EmbeddingStore(RecordingBackend(64), path)
+    store.embed(items(TEXTS))
+    store.close()
+
+    backend = RecordingBackend(32)
+    store = EmbeddingStore(backend, path)
+    try:
+        assert len(store) == 0
+        store.embed(items(TEXTS[:1]))
+        assert backend.embedded == TEXTS[:1]
+    finally:
+        store.close()
+
+
+def test_prune_removes_vectors_of_deleted_chunks():
+    store = EmbeddingStore(RecordingBackend(), ":memory:")
+    store.embed(items(TEXTS))
+
+    assert store.prune({content_hash(text) for text in TEXTS[:1]}) == 3
+    assert store.missing([content_hash(text) for text in TEXTS]) == [content_hash(text) for text in TEXTS[1:]]
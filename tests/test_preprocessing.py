@@ -0,0 +1,61 @@
+import pytest
+
+from preprocessing import nltk_tokenize, regex_tokenize
+from text import NLTK_RESOURCES, ensure_nltk_data
+
+
+@pytest.fixture(scope="module", autouse=True)
+def punkt():
+    import nltk
+
+    ensure_nltk_data("punkt")
+    try:
+        nltk.data.find(NLTK_RESOURCES["punkt"])
+    except LookupError:
+        pytest.skip("The NLTK punkt data is not installed and could not be downloaded")
+
+
+SAMPLES = [
+    "",
+    "   ",
+    "Sistem informasi akademik.",
+    "Good muffins cost $3.88 in New York. Please buy me two of them. Thanks.",
+    "He said, \"It's fine.\" Then he left...",
+    "\"Quoted at the start,\" she said.",
+    "''Double single quotes'' and ``backticks`` and `one tick'.",
+    "I cannot go, you gonna come? Lemme see, wanna try, gotta go, gimme that.",
+    "Don't, won't, can't, shouldn't've, y'all, 'tis, 'twas, d'ye, more'n.",
+    "They're here; we'll see. I'd say I'm done, you've seen it.",
+    "The boss's car, the bosses' cars and James' book.",
+    "Wait... what?! Really?? (Yes) [no] {maybe} <tag>",
+    "Prices: 1,000 or 12:30, a,b and a:b; a,,b a::b",
+    "An em--dash and a -- spaced dash, a well-known co-op.",
+    "U.S. citizens, e.g. Mr. Smith, arrived at 5 p.m. on Jan. 3.",
+    "Unicode «quotes» and “curly” ‘single’ quotes’ end.",
+    "Ends with a quote after the period.'",
+    "Ends with a bracket after the period.)",
+    "Ellipsis at the end..",
+    "Symbols & more: 50% off @home #tag *bold*",
+    "Line one\nline two\twith a tab.",
+    # Clitics followed by a closing quote at the end of a sentence, nltk only splits off the quote
+    "x's'",
+    "It's's'",
+    "He said 'the boss's'",
+    "cannot..&>can't's'",
+    "x'd'",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_regex_tokenizer_matches_nltk(text):
+    assert regex_tokenize(text) == nltk_tokenize(text)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("x's'", ["x's", "'"]),
+    ("the boss's' car", ["the", "boss", "'s", "'", "car"]),
+    ("I cannot go.", ["I", "can", "not", "go", "."]),
+    ("\"Hi,\" she said.", ["``", "Hi", ",", "''", "she", "said", "."]),
+])
+def test_regex_tokenizer_examples(text, expected):
+    assert regex_tokenize(text) == expected
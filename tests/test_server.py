@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+from server import MAX_BODY_SIZE, QueryServer
+
+
+def exchange(request: bytes, handler=lambda body: {"answer": body["question"]}) -> tuple:
+    """Send raw bytes to a QueryServer and return the status and JSON body of its first response."""
+    server = QueryServer(handler, max_workers=1)
+
+    async def run():
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        async with listener:
+            reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname()[:2])
+            writer.write(request)
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers["content-length"]))
+            writer.close()
+            return status, json.loads(body)
+
+    try:
+        # A server waiting for more of the body than was announced fails the test instead of hanging it
+        return asyncio.run(asyncio.wait_for(run(), 5))
+    finally:
+        server.executor.shutdown()
+
+
+def post(body: bytes, length: str = None) -> bytes:
+    length = str(len(body)) if length is None else length
+    return (f"POST /search HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {length}\r\nConnection: close\r\n\r\n").encode("latin-1") + body
+
+
+def test_answers_a_question():
+    assert exchange(post(b'{"question": "apa itu BM25?"}')) == (200, {"answer": "apa itu BM25?"})
+
+
+@pytest.mark.parametrize("length", ["-1", "abc", "1_0", "+5", "", "²"])
+def test_rejects_malformed_content_length(length):
+    status, body = exchange(post(b"{}", length))
+
+    assert status == 400
+    assert body == {"error": "Invalid Content-Length header."}
+
+
+def test_rejects_bodies_over_the_limit():
+    assert exchange(post(b"", str(MAX_BODY_SIZE + 1)))[0] == 413
+
+
+@pytest.mark.parametrize("body", [b"[1, 2]", b'"question"', b"null", b"{not json"])
+def test_rejects_bodies_that_are_no_json_object(body):
+    assert exchange(post(body))[0] == 400
+
+
+@pytest.mark.parametrize("body", [{"question": ""}, {"question": 3}, {"question": "halo", "style": 1}])
+def test_rejects_invalid_fields(body):
+    assert exchange(post(json.dumps(body).encode("utf-8")))[0] == 400
+
+
+def test_handler_value_errors_are_bad_requests():
+    def handler(body):
+        raise ValueError("Invalid value for 'style'.")
+
+    assert exchange(post(b'{"question": "halo"}'), handler) == (400, {"error": "Invalid value for 'style'."})
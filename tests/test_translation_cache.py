@@ -0,0 +1,66 @@
+from text import AutoTranslator, OfflineTranslatorBackend
+from translation_cache import TranslationCache
+
+DICTIONARY = {("id", "en", "kucing"): "cat", ("id", "en", "anjing"): "dog", ("en", "id", "cat"): "kucing"}
+
+
+def test_miss_calls_the_backend_and_hit_does_not():
+    backend = OfflineTranslatorBackend(DICTIONARY)
+    translator = AutoTranslator(backend, TranslationCache(":memory:"))
+
+    assert translator.translate_batch(["kucing", "anjing"], "en", "id") == ["cat", "dog"]
+    assert backend.calls == 1
+    assert (translator.cache.hits, translator.cache.misses) == (0, 2)
+
+    assert translator.translate_batch(["anjing", "kucing"], "en", "id") == ["dog", "cat"]
+    assert backend.calls == 1
+    assert (translator.cache.hits, translator.cache.misses) == (2, 2)
+
+
+def test_only_missing_texts_are_sent():
+    backend = OfflineTranslatorBackend(DICTIONARY)
+    translator = AutoTranslator(backend, TranslationCache(":memory:"))
+    translator.translate_batch(["kucing"], "en", "id")
+
+    sent = []
+    translate_batch = backend.translate_batch
+    backend.translate_batch = lambda texts, target, source: sent.append(texts) or translate_batch(texts, target, source)
+
+    assert translator.translate_batch(["kucing", "anjing", "kucing"], "en", "id") == ["cat", "dog", "cat"]
+    assert sent == [["anjing"]]
+
+
+def test_entries_are_keyed_by_language_pair():
+    backend = OfflineTranslatorBackend(DICTIONARY)
+    translator = AutoTranslator(backend, TranslationCache(":memory:"))
+
+    assert translator.translate_batch(["cat"], "id", "en") == ["kucing"]
+    # The same text in another direction is a miss, not the cached translation
+    assert translator.translate_batch(["cat"], "en", "id") == ["cat"]
+    assert backend.calls == 2
+
+
+def test_texts_in_the_target_language_are_not_translated():
+    backend = OfflineTranslatorBackend(DICTIONARY)
+    translator = AutoTranslator(backend, TranslationCache(":memory:"))
+
+    assert translator.translate_batch(["cat"], "en", "en") == ["cat"]
+    assert backend.calls == 0
+    assert len(translator.cache) == 0
+
+
+def test_translations_persist_across_instances(tmp_path):
+    path = str(tmp_path / "translations.sqlite3")
+    cache = TranslationCache(path)
+    AutoTranslator(OfflineTranslatorBackend(DICTIONARY), cache).translate_batch(["kucing"], "en", "id")
+    cache.close()
+
+    backend = OfflineTranslatorBackend()
+    cache = TranslationCache(path)
+    try:
+        assert AutoTranslator(backend, cache).translate_batch(["kucing"], "en", "id") == ["cat"]
+        assert backend.calls == 0
+        assert cache.hits == 1
+    finally:
+        cache.close()
+
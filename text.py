@@ -1,7 +1,19 @@
+import hashlib
 import re
-import langid
+import threading
+import warnings
+from collections import OrderedDict
+from functools import lru_cache
 
-from googletrans import Translator
+from metrics import metrics
+from translation_cache import TranslationCache
+
+# Maximum number of detected languages kept per process, keyed by content hash
+LANGUAGE_CACHE_SIZE = 100_000
+
+# langid codes of the supported languages and their NLTK stopword list names
+LANGUAGE_DICT = {"id": "indonesian", "en": "english"}
+LANGUAGE_CODES = {name: code for code, name in LANGUAGE_DICT.items()}
 
 
 class BatchText:
@@ -10,17 +22,116 @@ class BatchText:
         self.batch_text = batch_text
 
 
+class LanguageCache:
+    """A bounded LRU cache of detected languages keyed by the content hash of the text."""
+
+    def __init__(self, max_size: int = LANGUAGE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key: bytes):
+        with self.lock:
+            language = self.entries.get(key)
+            if language is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return language
+
+    def put(self, key: bytes, language: str) -> None:
+        with self.lock:
+            self.entries[key] = language
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# Shared by every Text instance in the process
+language_cache = LanguageCache()
+metrics.register_cache("language", language_cache)
+
+
+# Local paths of the NLTK data packages the search needs
+NLTK_RESOURCES = {"stopwords": "corpora/stopwords", "punkt": "tokenizers/punkt"}
+
+
+@lru_cache(maxsize=None)
+def ensure_nltk_data(package: str) -> None:
+    """Check that an NLTK data package is installed, downloading it only if it is missing locally."""
+    import nltk
+
+    try:
+        nltk.data.find(NLTK_RESOURCES[package])
+    except LookupError:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=UserWarning)  # Hide download warnings
+            nltk.download(package, quiet=True)
+
+
+@lru_cache(maxsize=None)
+def get_stopwords(language: str) -> frozenset:
+    """Load the NLTK stopwords of a language once per process as a set for O(1) lookups."""
+    ensure_nltk_data("stopwords")
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words(language))
+
+
+def classify_language(text: str) -> str:
+    # langid loads its model with numpy, so it is only imported for the first text that is not cached
+    import langid
+
+    return langid.classify(text)[0]
+
+
+def create_translator():
+    # googletrans pulls in an HTTP client, so it is only imported once a text is translated
+    from googletrans import Translator
+
+    return Translator()
+
+
 class Text:
 
     def __init__(self) -> None:
-        self.translator = Translator()
+        self._translator = None
+
+    @property
+    def translator(self):
+        if self._translator is None:
+            self._translator = create_translator()
+        return self._translator
 
     def detect_language(self, text: str, sanitize: bool = False) -> str:
-        if sanitize:
-            text = self.sanitize_text(text)
+        return self.detect_languages(BatchText([text]), sanitize)[0]
+
+    def detect_languages(self, batch: BatchText, sanitize: bool = False) -> list:
+        """Classify every text of a batch in one pass, only running langid on texts that are not cached yet."""
+        texts = self.batch_sanitize_text(batch) if sanitize else batch.batch_text
+        keys = [language_cache.key(text) for text in texts]
+        languages = [language_cache.get(key) for key in keys]
+
+        # Identical texts inside the batch are classified only once
+        pending = {}
+        for key, text, language in zip(keys, texts, languages):
+            if language is None and key not in pending:
+                pending[key] = text
+
+        detected = {}
+        for key, text in pending.items():
+            detected[key] = classify_language(text)
+            language_cache.put(key, detected[key])
 
-        detected_lang = langid.classify(text)
-        return detected_lang[0]
+        return [language or detected[key] for key, language in zip(keys, languages)]
 
     def sanitize_text(self, text: str) -> str:
         return re.sub(r"[^a-zA-Z0-9]", " ", text).strip()
@@ -32,22 +143,100 @@ class Text:
         return [self.sanitize_text(text) for text in batch.batch_text]
 
 
+class TranslatorBackend:
+    """Translate batches of texts from one language to another."""
+
+    def translate_batch(self, texts: list, target: str, source: str) -> list:
+        raise NotImplementedError
+
+
+class GoogleTranslatorBackend(TranslatorBackend):
+
+    def __init__(self, translator=None) -> None:
+        self._translator = translator
+
+    @property
+    def translator(self):
+        if self._translator is None:
+            self._translator = create_translator()
+        return self._translator
+
+    def translate_batch(self, texts: list, target: str, source: str) -> list:
+        if len(texts) == 1:
+            return [self.translator.translate(texts[0], target, source).text]
+
+        # Send the whole batch as one newline-separated text, so it costs a single round trip
+        joined = "\n".join(text.replace("\n", " ") for text in texts)
+        translated = self.translator.translate(joined, target, source).text.split("\n")
+
+        if len(translated) != len(texts):
+            # The service merged or split lines, fall back to one request per text
+            return [self.translator.translate(text, target, source).text for text in texts]
+
+        return [line.strip() for line in translated]
+
+
+class OfflineTranslatorBackend(TranslatorBackend):
+    """Translate from a fixed dictionary without any network access, returning unknown texts unchanged.
+
+    Dictionary keys are either the text itself or a (source, target, text) tuple.
+    """
+
+    def __init__(self, dictionary: dict = None) -> None:
+        self.dictionary = dictionary or {}
+        self.calls = 0
+
+    def translate_batch(self, texts: list, target: str, source: str) -> list:
+        self.calls += 1
+        return [self.dictionary.get((source, target, text), self.dictionary.get(text, text)) for text in texts]
+
+
 class AutoTranslator(Text):
 
-    def __init__(self) -> None:
+    def __init__(self, backend: TranslatorBackend = None, cache: TranslationCache = None) -> None:
         super().__init__()
+        self.backend = backend or GoogleTranslatorBackend()
+        self.cache = cache if cache is not None else TranslationCache()
+        metrics.register_cache("translation", self.cache)
 
     def text_translator(self,
                         text: str,
                         target: str = "en",
                         source: str = "auto") -> str:
+        return self.translate_batch([text], target, source)[0]
+
+    def translate_batch(self,
+                        texts: list,
+                        target: str = "en",
+                        source: str = "auto") -> list:
+        """Translate texts, serving cached ones locally and sending the rest in one backend call per source."""
         if source == "auto":
-            source = self.detect_language(text)
+            sources = self.detect_languages(BatchText(texts))
+        else:
+            sources = [source] * len(texts)
+
+        translations = {}
+        pending = {}
+        for text_source, text in zip(sources, texts):
+            if text_source == target:
+                translations[(text_source, text)] = text
+            else:
+                pending.setdefault(text_source, {})[text] = None
+
+        for text_source, group in pending.items():
+            found = self.cache.get_many(text_source, target, list(group))
+            missing = [text for text in group if text not in found]
+
+            if missing:
+                with metrics.span("translate_backend", texts=len(missing), source=text_source, target=target):
+                    translated = dict(zip(missing, self.backend.translate_batch(missing, target, text_source)))
+                self.cache.put_many(text_source, target, translated)
+                found.update(translated)
 
-        translated = self.translator.translate(text, target, source)
-        text = translated.text
+            translations.update(((text_source, text), translation) for text, translation in found.items())
+
+        return [translations[(text_source, text)] for text_source, text in zip(sources, texts)]
 
-        return text
     def auto_translate_question(self, question: str, document_language: str) -> str:
         if document_language == "id":
             return self.text_translator(question, "id")
@@ -55,22 +244,21 @@ class AutoTranslator(Text):
             return self.text_translator(question)
 
     def auto_translate_keywords(self, keywords: list, document_language: str) -> list:
-        translated = []
-
-        if document_language != "id":
-            for k in keywords:
-                translated.append(self.text_translator(k))
+        """Translate keywords to the documents' language, given by code or name; other languages keep them as is."""
+        target = LANGUAGE_CODES.get(document_language, document_language)
+        if target not in LANGUAGE_DICT:
+            return list(keywords)
 
-        return translated
+        return self.translate_batch(list(keywords), target)
 
 class SanitizedTextTranslator(AutoTranslator):
 
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, backend: TranslatorBackend = None, cache: TranslationCache = None) -> None:
+        super().__init__(backend, cache)
 
-    def text_translator(self,
-                        text: str,
+    def translate_batch(self,
+                        texts: list,
                         target: str = "en",
-                        source: str = "auto") -> str:
-        text = self.sanitize_text(text)
-        return super().text_translator(text, target, source)
+                        source: str = "auto") -> list:
+        texts = [self.sanitize_text(text) for text in texts]
+        return super().translate_batch(texts, target, source)
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+import time
+
+TRANSLATION_CACHE_PATH = os.path.join(".cache", "translations.sqlite3")
+TRANSLATION_CACHE_SIZE = 50_000
+
+
+class TranslationCache:
+    """A persistent SQLite cache of translations keyed by (source, target, text) with LRU eviction."""
+
+    def __init__(self, path: str = TRANSLATION_CACHE_PATH, max_entries: int = TRANSLATION_CACHE_SIZE) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "source TEXT NOT NULL, target TEXT NOT NULL, text TEXT NOT NULL, translation TEXT NOT NULL, "
+            "last_used REAL NOT NULL, PRIMARY KEY (source, target, text))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+    def get_many(self, source: str, target: str, texts: list) -> dict:
+        """Return the cached translations of texts and mark them as recently used."""
+        if not texts:
+            return {}
+
+        found = {}
+        with self.lock:
+            unique_texts = list(dict.fromkeys(texts))
+            # Stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(unique_texts), 500):
+                batch = unique_texts[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT text, translation FROM translations WHERE source = ? AND target = ? "
+                    f"AND text IN ({placeholders})", [source, target, *batch]
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE translations SET last_used = ? WHERE source = ? AND target = ? AND text = ?",
+                    [(now, source, target, text) for text in found]
+                )
+                self.connection.commit()
+
+            self.hits += len(found)
+            self.misses += len(unique_texts) - len(found)
+
+        return found
+
+    def put_many(self, source: str, target: str, translations: dict) -> None:
+        """Store translations and evict the least recently used entries beyond max_entries."""
+        if not translations:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO translations (source, target, text, translation, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(source, target, text, translation, now) for text, translation in translations.items()]
+            )
+            self.connection.execute(
+                "DELETE FROM translations WHERE rowid IN ("
+                "SELECT rowid FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+            self.connection.commit()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM translations")
+            self.connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()